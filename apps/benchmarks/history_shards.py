@@ -0,0 +1,71 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import sys
+from argparse import ArgumentParser
+from datetime import timedelta
+from os.path import abspath, dirname
+from random import choice
+from statistics import quantiles
+from time import perf_counter, time
+from typing import List
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from routers.history_engine import HistoryEngine  # noqa: E402
+from routers.statements import INT64, Statement  # noqa: E402
+from routers.utils import battle_history_delay, get_async_db  # noqa: E402
+
+select_history_users = Statement("select_history_users", "SELECT DISTINCT UserId FROM BattleHistory LIMIT @Limit", {"Limit": INT64}, service="benchmark_history_shards", target="battle_history")
+
+
+async def worker(engine: HistoryEngine, user_ids: List[int], deadline: float, latencies: List[float], args) -> None:
+    async_database = await get_async_db()
+    now = int(time())
+    while perf_counter() < deadline:
+        start = perf_counter()
+        await engine.read(async_database, choice(user_ids), now - args.window, now, None, args.limit, timedelta(seconds=battle_history_delay))
+        latencies.append(perf_counter() - start)
+
+
+async def run(args) -> None:
+    async_database = await get_async_db()
+    rows = await select_history_users.read(async_database, {"Limit": args.users})
+    user_ids = [row[0] for row in rows]
+    if not user_ids:
+        raise SystemExit("no battle history, run the locust scenario or scripts before the benchmark")
+
+    for groups in args.groups:
+        engine = HistoryEngine(groups=groups, parallelism=args.parallelism)
+        latencies: List[float] = []
+        deadline = perf_counter() + args.duration
+        await asyncio.gather(*[worker(engine, user_ids, deadline, latencies, args) for _ in range(args.concurrency)])
+        percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+        print(f"groups: {groups:>3}, reads: {len(latencies):>6}, "
+              f"p50: {percentiles[49] * 1000:.1f}ms, p95: {percentiles[94] * 1000:.1f}ms, p99: {percentiles[98] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare latency of battle history reads by the number of shard groups")
+    parser.add_argument('-g', '--groups', action='append', default=None, type=int, help='number of shard groups to compare (repeatable)')
+    parser.add_argument('-P', '--parallelism', default=10, type=int, help='max concurrent queries per read')
+    parser.add_argument('-c', '--concurrency', default=10, type=int, help='number of concurrent reads')
+    parser.add_argument('-d', '--duration', default=30, type=int, help='seconds to read per number of shard groups')
+    parser.add_argument('-l', '--limit', default=300, type=int, help='rows per read')
+    parser.add_argument('-u', '--users', default=1000, type=int, help='number of users to pick from')
+    parser.add_argument('--window', default=72000, type=int, help='seconds between since and until')
+    arguments = parser.parse_args()
+    arguments.groups = arguments.groups or [1, 5, 10, 20, 50, 100]
+    asyncio.run(run(arguments))
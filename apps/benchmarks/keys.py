@@ -0,0 +1,56 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+from os.path import abspath, dirname
+from statistics import mean, pstdev
+from timeit import repeat
+from typing import List
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from routers.keys import KEY_BITS, KEY_STRATEGIES  # noqa: E402
+
+
+def simulate(strategy: str, keys: int, workers: int, splits: int, window: int) -> str:
+    """Spread of keys which workers write at the same time over splits, which are equal ranges of the key space"""
+    generators = [KEY_STRATEGIES[strategy]() for _ in range(workers)]
+    split_ids: List[int] = [generators[i % workers].next_key() * splits >> KEY_BITS for i in range(keys)]
+
+    loads = Counter(split_ids)
+    counts = [loads.get(split, 0) for split in range(splits)]
+    # NOTE: writes of a window arrive at the same time, a split which takes most of them is a hot spot
+    windows = [Counter(split_ids[i:i + window]) for i in range(0, keys - window + 1, window)]
+    touched = mean(len(counter) for counter in windows) / min(window, splits)
+    hottest = mean(max(counter.values()) for counter in windows) / window
+    return (f"max/mean load: {max(counts) / mean(counts):.2f}, cv: {pstdev(counts) / mean(counts):.3f}, "
+            f"splits per window: {touched:.1%}, hottest split per window: {hottest:.1%}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare the cost and the spread over splits of key strategies of routers.keys")
+    parser.add_argument('-s', '--strategy', action='append', default=None, type=str, help='strategies to compare (repeatable)')
+    parser.add_argument('-k', '--keys', default=1000000, type=int, help='keys to generate')
+    parser.add_argument('-w', '--workers', default=8, type=int, help='workers which generate keys at the same time')
+    parser.add_argument('-S', '--splits', default=1000, type=int, help='splits of the key space')
+    parser.add_argument('-W', '--window', default=1000, type=int, help='consecutive writes which arrive at the same time')
+    parser.add_argument('-n', '--number', default=100000, type=int, help='keys per measurement of the cost')
+    args = parser.parse_args()
+
+    for strategy in args.strategy or list(KEY_STRATEGIES):
+        generator = KEY_STRATEGIES[strategy]()
+        cost = min(repeat(generator.next_key, number=args.number, repeat=5)) / args.number
+        print(f"{strategy:<18} {cost * 1e9:.0f}ns/key, {simulate(strategy, args.keys, args.workers, args.splits, args.window)}")
@@ -0,0 +1,90 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from os.path import abspath, dirname
+from time import perf_counter, sleep
+from typing import Tuple
+
+from loguru import logger
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from settings import (AccessLogSampler, BackgroundSink,  # noqa: E402
+                      InterceptHandler, log_entry, patch, serialize, sink)
+
+
+def json_sink(message):
+    # NOTE: the sink before orjson and enqueue, which serialized records by json on the thread which logs them
+    print(json.dumps(log_entry(message.record)))
+
+
+def access_logger(ratio: float) -> logging.Logger:
+    access = logging.getLogger(f"uvicorn.access.{ratio:g}")
+    access.handlers = [InterceptHandler()]
+    access.propagate = False
+    access.filters = [AccessLogSampler(ratio=ratio)]
+    access.setLevel(logging.INFO)
+    return access
+
+
+def measure(log, number: int, background: BackgroundSink) -> Tuple[float, float]:
+    """Microseconds per record on the thread which logs it, and until writers in background write all records"""
+    started_at = perf_counter()
+    for _ in range(number):
+        log()
+    elapsed = perf_counter() - started_at
+    logger.complete()
+    while not background._queue.empty():
+        sleep(0.001)
+    return elapsed / number * 1e6, (perf_counter() - started_at) / number * 1e6
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare the cost of logging per request on the thread which handles the request")
+    parser.add_argument('-n', '--number', default=20000, type=int, help='records per measurement')
+    args = parser.parse_args()
+
+    # NOTE: records are written to /dev/null, and results to stderr
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    access_args = ("127.0.0.1:50000", "GET", "/api/v1/characters/1", "1.1", 200)
+    access, sampled_access = access_logger(1), access_logger(0.01)
+    background = BackgroundSink()
+    cases = [
+        ("json sink", {"sink": json_sink, "serialize": True}, lambda: logger.info("a request")),
+        ("orjson sink", {"sink": sink, "format": "{message}"}, lambda: logger.info("a request")),
+        ("loguru enqueue", {"sink": sink, "format": "{message}", "enqueue": True}, lambda: logger.info("a request")),
+        ("background sink", {"sink": background, "format": "{message}"}, lambda: logger.info("a request")),
+        ("access log", {"sink": background, "format": "{message}"}, lambda: access.info('%s - "%s %s HTTP/%s" %d', *access_args)),
+        ("access log, 1%", {"sink": background, "format": "{message}"}, lambda: sampled_access.info('%s - "%s %s HTTP/%s" %d', *access_args)),
+    ]
+    for name, handler, log in cases:
+        logger.configure(handlers=[handler], patcher=patch)
+        measure(log, args.number // 10, background)
+        caller, total = measure(log, args.number, background)
+        print(f"{name:<24} {caller:.2f}us/record on the caller, {total:.2f}us/record until written", file=sys.stderr)
+    logger.remove()
+    # NOTE: the cost which enqueue moves to the background writer
+    record = {}
+    logger.configure(handlers=[{"sink": lambda message: record.update(message.record)}], patcher=patch)
+    logger.info("a request")
+    started_at = perf_counter()
+    for _ in range(args.number):
+        serialize(record)
+    print(f"{'serialize in writer':<24} {(perf_counter() - started_at) / args.number * 1e6:.2f}us/record", file=sys.stderr)
@@ -0,0 +1,65 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from argparse import ArgumentParser
+from random import choice
+from statistics import quantiles
+from time import perf_counter
+from typing import List
+
+import httpx
+
+
+async def worker(client: httpx.AsyncClient, paths: List[str], user_ids: List[str], deadline: float, latencies: List[float], errors: List[int]) -> None:
+    while perf_counter() < deadline:
+        path = choice(paths).format(user_id=choice(user_ids) if user_ids else "")
+        start = perf_counter()
+        res = await client.get(path)
+        latencies.append(perf_counter() - start)
+        if res.status_code >= 500:
+            errors.append(res.status_code)
+
+
+async def run(args) -> None:
+    host = args.target + ":" + args.port
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=host, limits=limits, timeout=args.timeout) as client:
+        user_ids = [user["user_id"] for user in (await client.get(f"/api/{args.version}/users/")).json()]
+        paths = [f"/api/{args.version}" + path for path in args.path]
+        latencies: List[float] = []
+        errors: List[int] = []
+        deadline = perf_counter() + args.duration
+        await asyncio.gather(*[worker(client, paths, user_ids, deadline, latencies, errors) for _ in range(args.concurrency)])
+
+    percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    print(f"requests: {len(latencies)}, errors: {len(errors)}, workers: {args.workers}")
+    print(f"rps: {len(latencies) / args.duration:.1f}, rps per worker: {len(latencies) / args.duration / args.workers:.1f}")
+    print(f"latency p50: {percentiles[49] * 1000:.1f}ms, p95: {percentiles[94] * 1000:.1f}ms, p99: {percentiles[98] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="measure requests/sec of the api server")
+    parser.add_argument('-t', '--target', default='http://localhost', type=str, help='target host')
+    parser.add_argument('-p', '--port', default='8000', type=str, help='target port')
+    parser.add_argument('-v', '--version', default="v1", type=str, help='target api version')
+    parser.add_argument('-c', '--concurrency', default=100, type=int, help='number of concurrent requests')
+    parser.add_argument('-d', '--duration', default=30, type=int, help='seconds to send requests')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='number of gunicorn workers of the target')
+    parser.add_argument('--timeout', default=10.0, type=float, help='timeout seconds per request')
+    parser.add_argument('--path', action='append', default=None, type=str,
+                        help='path to request, {user_id} is replaced with a random user id (repeatable)')
+    arguments = parser.parse_args()
+    arguments.path = arguments.path or ["/users/{user_id}", "/characters/{user_id}", "/opponent_master/"]
+    asyncio.run(run(arguments))
@@ -0,0 +1,87 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os.path import abspath, dirname
+from random import randint
+from timeit import repeat
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from routers.serialization import RowEncoder  # noqa: E402
+
+
+# NOTE: the same fields as routers.characters.CharacterResponse and routers.battles.BattleHistoryResponse,
+# they are copied not to connect to Spanner by importing routers
+class CharacterResponse(BaseModel):
+    id: str
+    user_name: str
+    character_name: str
+    kind: str
+    nick_name: str
+    level: int
+    experience: int
+    strength: int
+
+
+class BattleHistoryResponse(BaseModel):
+    user_id: str
+    character_id: str
+    opponent_id: str
+    result: bool
+    created_at: str
+    updated_at: str
+
+
+def pydantic_characters(rows):
+    return JSONResponse(content=jsonable_encoder([CharacterResponse(**dict(zip(CharacterResponse.__fields__.keys(), row))).dict() for row in rows])).body
+
+
+def pydantic_histories(rows):
+    res = []
+    for row in rows:
+        result = dict(zip(BattleHistoryResponse.__fields__.keys(), row))
+        result["created_at"] = result["created_at"].isoformat()
+        result["updated_at"] = result["updated_at"].isoformat()
+        res.append(BattleHistoryResponse(**result).dict())
+    return JSONResponse(content=jsonable_encoder(res)).body
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare encoding cost per row of the pydantic path and RowEncoder")
+    parser.add_argument('-r', '--rows', default=300, type=int, help='rows per response')
+    parser.add_argument('-n', '--number', default=100, type=int, help='responses per measurement')
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    characters = [(randint(0, 1 << 63), "user", "character", "kind", "nick", 10, 100, 20) for _ in range(args.rows)]
+    histories = [(randint(0, 1 << 63), randint(0, 1 << 63), randint(0, 1 << 63), True, now, now, randint(0, 1 << 63)) for _ in range(args.rows)]
+    character_encoder = RowEncoder(tuple(CharacterResponse.__fields__), int64_as_str=("id",))
+    history_encoder = RowEncoder(tuple(BattleHistoryResponse.__fields__), int64_as_str=("user_id", "character_id", "opponent_id"), timestamps=("created_at", "updated_at"))
+
+    cases = [
+        ("characters pydantic", lambda: pydantic_characters(characters)),
+        ("characters RowEncoder", lambda: character_encoder.encode(characters)),
+        ("histories pydantic", lambda: pydantic_histories(histories)),
+        ("histories RowEncoder", lambda: history_encoder.encode(histories)),
+    ]
+    for name, case in cases:
+        best = min(repeat(case, number=args.number, repeat=5))
+        print(f"{name:<24} {best / args.number / args.rows * 1e6:.2f}us/row")
@@ -0,0 +1,57 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import signal
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from time import perf_counter, sleep
+
+import httpx
+
+MAIN = join(dirname(dirname(abspath(__file__))), "main.py")
+
+
+def measure(profile: str, url: str, timeout: float) -> float:
+    """Seconds from starting the api server by a profile until it serves the first request"""
+    env = {**os.environ, "RUNTIME_PROFILE": profile}
+    started_at = perf_counter()
+    server = subprocess.Popen([sys.executable, MAIN], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while perf_counter() - started_at < timeout:
+            try:
+                if httpx.get(url, timeout=1).status_code == 200:
+                    return perf_counter() - started_at
+            except httpx.TransportError:
+                pass
+            sleep(0.05)
+        raise SystemExit(f"the server of {profile} did not start in {timeout}s")
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare startup time of the api server by RUNTIME_PROFILE")
+    parser.add_argument('-P', '--profile', action='append', default=None, type=str, help='profiles to compare (repeatable)')
+    parser.add_argument('-u', '--url', default="http://localhost:8000/metrics", type=str, help='url which is requested until it returns 200')
+    parser.add_argument('-n', '--number', default=3, type=int, help='starts per profile')
+    parser.add_argument('--timeout', default=60.0, type=float, help='seconds to wait for a start')
+    args = parser.parse_args()
+
+    for profile in args.profile or ["dev", "stress", "prod"]:
+        elapsed = [measure(profile, args.url, args.timeout) for _ in range(args.number)]
+        print(f"{profile:<8} min: {min(elapsed):.2f}s, max: {max(elapsed):.2f}s")
@@ -0,0 +1,67 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from argparse import ArgumentParser
+from os.path import abspath, dirname
+from timeit import repeat
+
+from opentelemetry.sdk.trace.export import (BatchSpanProcessor, SpanExporter,
+                                            SpanExportResult)
+from opentelemetry.trace import NoOpTracerProvider, SpanKind
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from settings import create_tracer_provider  # noqa: E402
+
+STATEMENT_ATTRIBUTES = {"db.system": "spanner", "db.operation": "select", "db.statement": "SELECT ...", "spanner.request_tag": "action=select,service=character,target=characters"}
+
+
+class DiscardSpanExporter(SpanExporter):
+    """Drop spans after the batch processor, so only the cost in a worker is measured and not the one of a backend"""
+
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def request(tracer, statements):
+    # NOTE: the same spans as a request which runs a transaction, the server span of FastAPIInstrumentor,
+    # the span of AsyncDatabase.run_in_transaction and client spans of routers.statements
+    with tracer.start_as_current_span("GET /api/v1/characters/{user_id}", kind=SpanKind.SERVER):
+        with tracer.start_as_current_span("get_character", kind=SpanKind.CLIENT, attributes={"db.system": "spanner"}):
+            for _ in range(statements):
+                span = tracer.start_span("select_character", kind=SpanKind.CLIENT, attributes=STATEMENT_ATTRIBUTES)
+                span.set_attribute("db.rows", 1)
+                span.end()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="compare the cost of spans per request by TRACE_SAMPLE_RATIO")
+    parser.add_argument('-s', '--statements', default=3, type=int, help='statements per request')
+    parser.add_argument('-n', '--number', default=10000, type=int, help='requests per measurement')
+    parser.add_argument('-r', '--ratio', default=[1.0, 0.01, 0.0], type=float, nargs="+", help='sample ratios to compare')
+    args = parser.parse_args()
+
+    cases = [("no tracer provider", NoOpTracerProvider())]
+    for ratio in args.ratio:
+        provider = create_tracer_provider(ratio)
+        provider.add_span_processor(BatchSpanProcessor(DiscardSpanExporter()))
+        cases.append((f"ratio {ratio:g}", provider))
+    for name, provider in cases:
+        tracer = provider.get_tracer(__name__)
+        best = min(repeat(lambda: request(tracer, args.statements), number=args.number, repeat=5))
+        print(f"{name:<20} {best / args.number * 1e6:.2f}us/request")
@@ -13,12 +13,18 @@
 # limitations under the License.
 
 from fastapi import FastAPI
+from loguru import logger
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from routers.battles import router as battle_router
 from routers.character_master import router as character_master_router
 from routers.characters import router as characters_router
+from routers.hashing import password_hasher
+from routers.master_cache import character_masters, opponent_masters
+from routers.metrics import router as metrics_router
 from routers.opponent_master import router as opponent_master_router
+from routers.reset import router as reset_router
 from routers.users import router as user_router
+from routers.utils import get_async_db, get_db, get_session_pinger, spanner_provider
 from settings import StandaloneApplication, setup_gunicorn, setup_trace
 
 app = FastAPI(title="sample game api", description="sample game app for spanner-stress-test-demo", version=1.0)
@@ -29,12 +35,31 @@ app.include_router(characters_router, prefix=prefix_v1)
 app.include_router(character_master_router, prefix=prefix_v1)
 app.include_router(opponent_master_router, prefix=prefix_v1)
 app.include_router(battle_router, prefix=prefix_v1)
+app.include_router(reset_router, prefix=prefix_v1)
+# NOTE: scraped by Prometheus without API version
+app.include_router(metrics_router)
 
 
 @app.on_event("startup")
 async def startup_event():
     setup_trace()
     FastAPIInstrumentor.instrument_app(app)
+    # NOTE: uvicorn does not accept requests until startup finishes, so the first requests do not wait for sessions
+    db = await get_async_db()
+    sessions = await db.run(spanner_provider.warm_up)
+    logger.info(f"warmed up {sessions} sessions")
+    character_masters.start(get_db())
+    opponent_masters.start(get_db())
+    get_session_pinger().start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    character_masters.stop()
+    opponent_masters.stop()
+    get_session_pinger().stop()
+    password_hasher.shutdown()
+
 
 if __name__ == '__main__':
     options = setup_gunicorn()
@@ -11,3 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+from os import getenv, makedirs
+
+# NOTE: prometheus_client writes a file per worker to this directory as soon as a metric is created by a router module
+if getenv("PROMETHEUS_MULTIPROC_DIR"):
+    makedirs(getenv("PROMETHEUS_MULTIPROC_DIR", ""), exist_ok=True)
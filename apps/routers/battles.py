@@ -12,31 +12,65 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import timedelta
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from os import getenv
 from random import choice, randint, random
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from google.api_core.exceptions import FailedPrecondition
 from google.cloud import spanner
-from google.cloud.spanner_v1.database import Database
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-from .utils import (battle_history_delay, create_req_tag, epoch_to_datetime,
-                    get_db, get_entry_shard_id, get_uuid, num_shards)
+from .character_cache import character_cache
+from .database import AsyncDatabase
+from .history_cache import history_cache
+from .history_engine import BattleHistory, Cursor, battle_history_query
+from .master_cache import opponent_masters
+from .serialization import RowEncoder, RowsResponse
+from .statements import (battle_batch, insert_battle_history,
+                         read_battle_character, select_battle_character,
+                         update_battle_character)
+from .utils import (battle_history_delay, get_async_db, get_entry_shard_id,
+                    get_uuid)
 
-OpponentMasters: str = "OpponentMasters"
 Characters: str = "Characters"
-# NOTE: force to use index in select
-BattleHistory: str = "BattleHistory"
-BattleHistoryByUserId: str = "@{FORCE_INDEX=BattleHistoryByUserId}"
+# NOTE: "uniform" or "strength" to pick stronger opponents more often
+OPPONENT_SAMPLING: str = getenv("OPPONENT_SAMPLING", "uniform")
+NEXT_CURSOR_HEADER: str = "X-Next-Cursor"
+NDJSON: str = "application/x-ndjson"
+EPOCH: datetime = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 router = APIRouter(prefix="/battles", tags=["battles"])
 
 
+class BattleWriteMode(str, Enum):
+    """How to write a battle result"""
+    # NOTE: read a character by a snapshot, and then run 2 DML statements in a transaction
+    dml = "dml"
+    # NOTE: read a character by a snapshot, and then run 2 DML statements by one batch_update request
+    batch_dml = "batch_dml"
+    # NOTE: read a character in a transaction, and then commit buffered mutations with the commit request
+    mutation = "mutation"
+
+
+BATTLE_WRITE_MODE: BattleWriteMode = BattleWriteMode(getenv("BATTLE_WRITE_MODE", BattleWriteMode.dml.value))
+
+
+class HistoryFormat(str, Enum):
+    ndjson = "ndjson"
+    json = "json"
+
+
 class Battles(BaseModel):
     character_id: str = Field(..., example="111111111")
+    # NOTE: the owner of the character, the character is read by its primary key (UserId, Id) when it is given
+    user_id: Optional[str] = Field(None, example="111111111")
 
 
 class BattleResponse(BaseModel):
@@ -52,6 +86,10 @@ class BattleHistoryResponse(BaseModel):
     updated_at: str = Field(..., example="2022-10-28T18:19:52.227030+00:00")
 
 
+# NOTE: rows of history_engine have BattleHistoryId at the end, which is not a part of the response
+history_encoder = RowEncoder(tuple(BattleHistoryResponse.__fields__), int64_as_str=("user_id", "character_id", "opponent_id"), timestamps=("created_at", "updated_at"))
+
+
 class Opponent(BaseModel):
     opponent_id: str = Field(..., example="111111111")
     kind: str = Field(..., example="hoge")
@@ -88,69 +126,153 @@ battle_resp_docs: Dict[int, Dict[str, Any]] = {
 
 
 @router.post("/", tags=["battles"], response_model=BattleResponse, status_code=status.HTTP_201_CREATED, responses={**battle_resp_docs})
-def battles(battles: Battles, db: Database = Depends(get_db)) -> JSONResponse:
-    """Battle against a opponent"""
-    def battle_repository(transaction: Any) -> None:
-        update_query = f"UPDATE {Characters} SET Level=@LEVEL, Experience=@Experience, Strength=@Strength, UpdatedAt=PENDING_COMMIT_TIMESTAMP() WHERE Id=@Id AND UserId=@UserId"
-        update_params = {"Level": character.level + int(random() / 0.95), "Experience": character.experience + opponent.experience, "Strength": character.strength + randint(0, opponent.experience // 100), "Id": int(character.id), "UserId": int(character.user_id)}
-        update_params_type = {"Level": spanner.param_types.INT64, "Experience": spanner.param_types.INT64, "Strength": spanner.param_types.INT64, "Id": spanner.param_types.INT64, "UserId": spanner.param_types.INT64}
-        update_request_options = {"request_tag": create_req_tag("update", "run_battle", "characters")}
-        transaction.execute_update(update_query, params=update_params, param_types=update_params_type, request_options=update_request_options)
+async def battles(battles: Battles, write_mode: Optional[BattleWriteMode] = None, db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
+    """
+    Battle against a opponent
+
+    write_mode overrides BATTLE_WRITE_MODE to compare how to write a battle in a load test
+    """
+    characters_params = {"Id": battles.character_id}
+    character_key = (int(battles.user_id), int(battles.character_id)) if battles.user_id else None
 
-        insert_query = f"INSERT {BattleHistory} (BattleHistoryId, UserId, Id, OpponentId, Result, EntryShardId, CreatedAt, UpdatedAt) VALUES (@BattleHistoryId, @UserId, @Id, @OpponentId, @Result, @EntryShardId, PENDING_COMMIT_TIMESTAMP(), PENDING_COMMIT_TIMESTAMP())"
+    def read_character(reader: Any) -> List[Tuple]:
+        # NOTE: read by the key when the owner is known, otherwise query by Id which has no index
+        return read_battle_character.execute_read(reader, [character_key]) if character_key else select_battle_character.execute_sql(reader, characters_params)
+
+    def battle_params(character: Character) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # NOTE: keys are the same as column names, so they are used for mutations too
+        update_params = {"Level": character.level + int(random() / 0.95), "Experience": character.experience + opponent.experience, "Strength": character.strength + randint(0, opponent.experience // 100), "Id": int(character.id), "UserId": int(character.user_id)}
         insert_params = {"BattleHistoryId": get_uuid(), "UserId": int(character.user_id), "Id": int(character.id), "OpponentId": int(opponent.opponent_id), "Result": result, "EntryShardId": get_entry_shard_id(int(character.user_id))}
-        insert_params_type = {"BattleHistoryId": spanner.param_types.INT64, "UserId": spanner.param_types.INT64, "Id": spanner.param_types.INT64, "OpponentId": spanner.param_types.INT64, "Result": spanner.param_types.BOOL, "EntryShardId": spanner.param_types.INT64}
-        insert_request_options = {"request_tag": create_req_tag("insert", "run_battle", "battlehistories")}
-        transaction.execute_update(insert_query, params=insert_params, param_types=insert_params_type, request_options=insert_request_options)
-
-    with db.snapshot(multi_use=True) as snapshot:
-        characters_query = f"SELECT Id, UserId, Level, Experience, Strength FROM {Characters} WHERE Id=@Id"
-        characters_params, characters_params_type = {"Id": battles.character_id}, {"Id": spanner.param_types.INT64}
-        characters_request_options = {"request_tag": create_req_tag("select", "read_user", "users")}
-        characters = list(snapshot.execute_sql(characters_query, params=characters_params, param_types=characters_params_type, request_options=characters_request_options))
-        opponents_query = f"SELECT OpponentId, Kind, Strength, Experience FROM {OpponentMasters} TABLESAMPLE RESERVOIR (1 ROWS)"
-        opponents = list(snapshot.execute_sql(opponents_query, request_options={"request_tag": create_req_tag("select", "run_battles", "opponents")}))
-
-    if not opponents:
+        return update_params, insert_params
+
+    def battle_repository(transaction: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        update_params, insert_params = battle_params(character)
+        update_battle_character.execute_update(transaction, update_params)
+        insert_battle_history.execute_update(transaction, insert_params)
+        return update_params, insert_params
+
+    def battle_batch_repository(transaction: Any) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        update_params, insert_params = battle_params(character)
+        battle_batch.execute(transaction, (update_params, insert_params))
+        return update_params, insert_params
+
+    def battle_mutation_repository(transaction: Any) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        # NOTE: read the character in the read-write transaction to lock it until the commit
+        characters = read_character(transaction)
+        if not characters:
+            return None
+        character = Character(**dict(zip(Character.__fields__.keys(), choice(characters))))
+        update_params, insert_params = battle_params(character)
+        # NOTE: mutations are buffered in the client and sent with the commit request
+        transaction.update(table=Characters, columns=(*update_params, "UpdatedAt"), values=[(*update_params.values(), spanner.COMMIT_TIMESTAMP)])
+        transaction.insert(table=BattleHistory, columns=(*insert_params, "CreatedAt", "UpdatedAt"), values=[(*insert_params.values(), spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP)])
+        return update_params, insert_params
+
+    await opponent_masters.refresh(db)
+    # NOTE: pick an opponent from memory instead of TABLESAMPLE, which scans whole master table per battle
+    opponent_row = opponent_masters.weighted_choice() if OPPONENT_SAMPLING == "strength" else opponent_masters.choice()
+    if not opponent_row:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Any opponent masters does not found")
-    if not characters:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This character does not found")
-    opponent = Opponent(**dict(zip(Opponent.__fields__.keys(), opponents[0])))
-    character = Character(**dict(zip(Character.__fields__.keys(), choice(characters))))
+    opponent = Opponent(opponent_id=opponent_row[0], kind=opponent_row[2], strength=opponent_row[3], experience=opponent_row[4])
+
     # NOTE: decide results randomly, because this is dummy game
     result: bool = random() <= 0.5
 
-    db.run_in_transaction(battle_repository)
+    write_mode = write_mode or BATTLE_WRITE_MODE
+    try:
+        if write_mode == BattleWriteMode.mutation:
+            params, committed = await db.run_in_transaction_with_commit_timestamp(battle_mutation_repository)
+            if not params:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This character does not found")
+        else:
+            # NOTE: the values which the last battle of the character in this worker wrote, instead of a strong read
+            cached = character_cache.get(int(battles.character_id), character_key[0] if character_key else None)
+            characters = [cached] if cached else await (read_battle_character.read(db, [character_key]) if character_key else select_battle_character.read(db, characters_params))
+            if not characters:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This character does not found")
+            character = Character(**dict(zip(Character.__fields__.keys(), choice(characters))))
+
+            params, committed = await db.run_in_transaction_with_commit_timestamp(battle_batch_repository if write_mode == BattleWriteMode.batch_dml else battle_repository)
+    except FailedPrecondition as e:
+        # NOTE: the foreign key of OpponentId fails when another worker deleted the opponent after the last sweep of the cache
+        if "OpponentMasters" not in str(e):
+            raise
+        opponent_masters.discard(int(opponent.opponent_id))
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="This opponent master was deleted")
+    update_params, insert_params = params
+    character_cache.put((update_params["Id"], update_params["UserId"], update_params["Level"], update_params["Experience"], update_params["Strength"]))
+
+    # NOTE: the row is the same as the one which is read by history_engine
+    await history_cache.append((insert_params["UserId"], insert_params["Id"], insert_params["OpponentId"], result, committed, committed, insert_params["BattleHistoryId"]))
 
     return JSONResponse(content=jsonable_encoder(BattleResponse(retult=result)), status_code=status.HTTP_201_CREATED)
 
 
+def encode_cursor(updated_at: datetime, battle_history_id: int) -> str:
+    """Encode the sort key of the last row as an opaque cursor"""
+    micros = (updated_at - EPOCH) // timedelta(microseconds=1)
+    return urlsafe_b64encode(f"{micros}.{battle_history_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    try:
+        micros, battle_history_id = urlsafe_b64decode(cursor.encode()).decode().split(".")
+        return EPOCH + timedelta(microseconds=int(micros)), int(battle_history_id)
+    except (ValueError, OverflowError):
+        # NOTE: a huge number of microseconds overflows timedelta
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This cursor is invalid")
+
+
 @router.get("/history", tags=["battles"], response_model=List[Optional[BattleHistoryResponse]])
-def get_battle_histories(user_id: int, since: int, until: int, db: Database = Depends(get_db)) -> JSONResponse:
+async def get_battle_histories(user_id: int, since: int, until: int, cursor: Optional[str] = None, limit: int = Query(300, ge=1, le=1000),
+                               db: AsyncDatabase = Depends(get_async_db)) -> Response:
     """
     Append battle history
 
-    stale read from history table between since and until
+    stale read from history table between since and until.
+    When a page is full, X-Next-Cursor header has the cursor of the next page.
+    """
+    histories = await history_cache.read(db, user_id, since, until, decode_cursor(cursor) if cursor else None, limit, timedelta(seconds=battle_history_delay))
+    headers = {}
+    if len(histories) == limit:
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(histories[-1][5], histories[-1][6])
+    return RowsResponse(histories, history_encoder, headers=headers)
+
+
+@router.get("/history/stream", tags=["battles"], response_class=StreamingResponse, responses={status.HTTP_200_OK: {"content": {NDJSON: {}, "application/json": {}}}})
+def stream_battle_histories(user_id: int, since: int, until: int, cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+                            format: HistoryFormat = HistoryFormat.ndjson, db: AsyncDatabase = Depends(get_async_db)) -> StreamingResponse:
     """
-    with db.snapshot(exact_staleness=timedelta(seconds=battle_history_delay)) as snapshot:
-        query = f"""SELECT UserId, Id, OpponentId,  Result, CreatedAt, UpdatedAt FROM {BattleHistory+BattleHistoryByUserId}
-                  WHERE UserId={user_id} AND UpdatedAt BETWEEN @Since AND @Until AND EntryShardId BETWEEN 0 AND {num_shards-1}
-                  ORDER BY UpdatedAt DESC LIMIT 300"""
-        params = {"Since": epoch_to_datetime(since), "Until": epoch_to_datetime(until)}
-        params_type = {"Since": spanner.param_types.TIMESTAMP, "Until": spanner.param_types.TIMESTAMP}
-        histories = snapshot.execute_sql(query, params=params, param_types=params_type, request_options={
-            "request_tag": create_req_tag("select", "battlehistories", "battlehistory")})
-    res = []
-    for history in histories:
-        result = dict(zip(BattleHistoryResponse.__fields__.keys(), history))
-        # NOTE: need datetime to string
-        result["created_at"] = result["created_at"].isoformat()
-        result["updated_at"] = result["updated_at"].isoformat()
-        res.append(BattleHistoryResponse(**result).dict())
-    return JSONResponse(content=jsonable_encoder(res))
+    Stream battle history
+
+    rows are written as soon as Spanner returns them, so a large window of history uses constant memory.
+    format is "ndjson" (a row per line) or "json" (a JSON array).
+    """
+    # NOTE: a stream is read by one query, so the first row is written without waiting for queries of other shard groups
+    statement, params = battle_history_query(user_id, since, until, decode_cursor(cursor) if cursor else None, limit)
+
+    def _stream() -> Iterator[bytes]:
+        # NOTE: Starlette iterates a sync generator in its threadpool, and the session is returned to the pool when the generator is closed
+        with db.database.snapshot(exact_staleness=timedelta(seconds=battle_history_delay)) as snapshot:
+            rows = statement.stream(snapshot, params)
+            if format == HistoryFormat.ndjson:
+                for row in rows:
+                    yield history_encoder.encode_row(row) + b"\n"
+                return
+            separator = b"["
+            for row in rows:
+                yield separator + history_encoder.encode_row(row)
+                separator = b","
+            yield b"[]" if separator == b"[" else b"]"
+
+    rows = _stream()
+    # NOTE: Starlette cancels a stream when the client disconnects and runs the background task after the stream either way,
+    # so the generator is closed at once instead of when it is garbage collected
+    return StreamingResponse(rows, media_type=NDJSON if format == HistoryFormat.ndjson else "application/json", background=BackgroundTask(rows.close))
 
 
 @router.delete("/history", tags=["battles"], response_model=Optional[dict])
-def delete_all_battle_histories(db: Database = Depends(get_db)) -> JSONResponse:
-    db.execute_partitioned_dml(f"DELETE FROM {BattleHistory} WHERE BattleHistoryId > 0")
+async def delete_all_battle_histories(db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
+    await db.execute_partitioned_dml(f"DELETE FROM {BattleHistory} WHERE BattleHistoryId > 0")
+    await history_cache.clear()
     return JSONResponse(content=jsonable_encoder({}))
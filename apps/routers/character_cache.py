@@ -0,0 +1,71 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+from typing import Optional, Tuple
+
+from prometheus_client import Counter
+
+# NOTE: characters cached per worker for battles, 0 disables the cache and every battle reads its character
+CHARACTER_CACHE_SIZE: int = int(getenv("CHARACTER_CACHE_SIZE", "0"))
+# NOTE: seconds to use a cached character, battles of it in other workers are not seen until then
+CHARACTER_CACHE_TTL: float = float(getenv("CHARACTER_CACHE_TTL", "5"))
+
+character_cache_requests = Counter("character_cache_requests", "Lookups of character cache of battles", ["result"])
+
+
+class CharacterCache:
+    """
+    Per worker LRU of (Id, UserId, Level, Experience, Strength) of characters which battles read
+
+    After a battle commits, the values which it wrote are cached, so the next battle of the character in this worker
+    skips the read. The read of a battle is not in its write transaction, so a cached row is as stale as a strong read
+    which another worker overwrites before the commit, except that it lasts up to ttl.
+    It is used only from the event loop of a worker, so it has no lock.
+    """
+
+    def __init__(self, size: int = CHARACTER_CACHE_SIZE, ttl: float = CHARACTER_CACHE_TTL) -> None:
+        self.size = size
+        self.ttl = ttl
+        self._rows: "OrderedDict[int, Tuple[float, Tuple]]" = OrderedDict()
+        self._hits = character_cache_requests.labels("hit")
+        self._misses = character_cache_requests.labels("miss")
+
+    def get(self, character_id: int, user_id: Optional[int] = None) -> Optional[Tuple]:
+        if not self.size:
+            return None
+        cached = self._rows.get(character_id)
+        # NOTE: a character of another user is not found, the same as a keyed read
+        if cached is None or monotonic() > cached[0] or (user_id is not None and cached[1][1] != user_id):
+            self._misses.inc()
+            return None
+        self._rows.move_to_end(character_id)
+        self._hits.inc()
+        return cached[1]
+
+    def put(self, row: Tuple) -> None:
+        if not self.size:
+            return
+        self._rows[row[0]] = (monotonic() + self.ttl, row)
+        self._rows.move_to_end(row[0])
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+
+    def clear(self) -> None:
+        self._rows.clear()
+
+
+character_cache = CharacterCache()
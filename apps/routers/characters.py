@@ -16,12 +16,17 @@ from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from google.cloud import spanner
-from google.cloud.spanner_v1.database import Database
 from pydantic import BaseModel, Field
 
-from .utils import create_req_tag, get_db, get_uuid
+from .character_cache import character_cache
+from .database import AsyncDatabase
+from .group_commit import GROUP_COMMIT, group_commit_writer
+from .serialization import RowEncoder, RowsResponse
+from .statements import (count_user_characters, insert_character,
+                         select_random_characters, select_user_characters)
+from .utils import get_async_db, get_uuid
 
 TABLE: str = "Characters"
 CHARACTER_LIMIT = 300
@@ -53,68 +58,54 @@ class CharacterResponse(BaseModel):
     strength: int = Field(..., example=10)
 
 
+character_encoder = RowEncoder(tuple(CharacterResponse.__fields__), int64_as_str=("id",))
+
+
 @router.get("/", tags=["characters"], response_model=List[CharacterResponse])
-def get_rondom_characters(db: Database = Depends(get_db)) -> JSONResponse:
+async def get_rondom_characters(db: AsyncDatabase = Depends(get_async_db)) -> Response:
     """Get random 300 characters for checking test status"""
-    with db.snapshot() as snapshot:
-        query = f"""SELECT Id, Users.Name,CharacterMasters.Name, Kind, {TABLE}.Name, Level, Experience, Strength FROM {TABLE} TABLESAMPLE RESERVOIR (300 ROWS)
-                  INNER JOIN Users ON Characters.UserId=Users.UserId
-                  INNER JOIN CharacterMasters ON Characters.CharacterId=CharacterMasters.CharacterId"""
-        results = list(snapshot.execute_sql(query))
+    results = await select_random_characters.read(db)
     if not results:
         return JSONResponse(content={})
-    return JSONResponse(content=jsonable_encoder([CharacterResponse(**dict(zip(CharacterResponse.__fields__.keys(), result))).dict() for result in results]))
+    return RowsResponse(results, character_encoder)
 
 
 @router.get("/{user_id}", tags=["characters"], response_model=List[CharacterResponse], responses={status.HTTP_404_NOT_FOUND: {"description": "Character does not found", "content": {"application/json": {"example": {"detail": "This user does not exsist or have any characters"}}}}})
-def get_character(user_id: int, db: Database = Depends(get_db)) -> JSONResponse:
+async def get_character(user_id: int, db: AsyncDatabase = Depends(get_async_db)) -> Response:
     """Get characters of the user"""
-    with db.snapshot() as snapshot:
-        query = f"""SELECT Id, Users.Name,CharacterMasters.Name, Kind, {TABLE}.Name, Level, Experience, Strength FROM {TABLE}
-                  INNER JOIN Users ON Characters.UserId=Users.UserId
-                  INNER JOIN CharacterMasters ON Characters.CharacterId=CharacterMasters.CharacterId WHERE {TABLE}.UserId=@UserId"""
-        params, params_type = {"UserId": user_id}, {"UserId": spanner.param_types.INT64}
-        request_options = {"request_tag": create_req_tag("select", "read_character", "characters")}
-        results = list(snapshot.execute_sql(query, params=params, param_types=params_type, request_options=request_options))
+    results = await select_user_characters.read(db, {"UserId": user_id})
     if not results:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This user does not exsist or have any characters")
-    return JSONResponse(content=jsonable_encoder([CharacterResponse(**dict(zip(CharacterResponse.__fields__.keys(), result))).dict() for result in results]))
+    return RowsResponse(results, character_encoder)
 
 
 @router.post("/", tags=["characters"], response_model=CreateCharacterResponse, status_code=status.HTTP_201_CREATED, responses={status.HTTP_403_FORBIDDEN: {"description": "Exceeded limits of character per user", "content": {"application/json": {"example": {"detail": "This user exceeded limits of chatacters"}}}}})
-def create_characters(characters: Character, db: Database = Depends(get_db)) -> JSONResponse:
+async def create_characters(characters: Character, db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
     """Create character such as getting a monster"""
     def create_character_repository(transaction):
-        columns = ("Id", "UserId", "CharacterId", "Name", "Level", "Experience", "Strength", "CreatedAt", "UpdatedAt")
-        values = (character_id, int(characters.user_id), int(characters.character_id), characters.name, characters.level, characters.experience, characters.experience)
-        types = (spanner.param_types.INT64, spanner.param_types.INT64, spanner.param_types.INT64, spanner.param_types.STRING, spanner.param_types.INT64, spanner.param_types.INT64, spanner.param_types.INT64)
-
-        insert_query = f"INSERT {TABLE} ({','.join(columns)}) VALUES ({','.join([ '@' + c if c not in ('CreatedAt', 'UpdatedAt') else 'PENDING_COMMIT_TIMESTAMP()' for c in columns])})"
-        insert_params = {columns[i]: values[i] for i in range(len(values))}
-        insert_params_type = {columns[i]: types[i] for i in range(len(values))}
-        request_options = {"request_tag": create_req_tag("insert", "create_character", "characters")}
-
-        transaction.execute_update(insert_query, params=insert_params, param_types=insert_params_type, request_options=request_options)
-
-    with db.snapshot() as snapshot:
-        query = f"SELECT COUNT(*) FROM {TABLE} WHERE UserId=@UserId"
-        params, params_type = {"UserId": characters.user_id}, {"UserId": spanner.param_types.INT64}
-        request_options = {"request_tag": create_req_tag("select", "read_characters_per_user", "characters")}
-        cnt: int = list(snapshot.execute_sql(query, params=params, param_types=params_type, request_options=request_options))[0][0]
+        insert_character.execute_update(transaction, dict(zip(columns, values)))
+
+    cnt: int = (await count_user_characters.read(db, {"UserId": characters.user_id}))[0][0]
     # NOTE: avoid to get characters more over CHARACTER_LIMIT, because it become difficult to handle a lot of characters in this game
     if cnt >= CHARACTER_LIMIT:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="This user exceeded limits of chatacters")
 
     character_id = get_uuid()
+    columns = ("Id", "UserId", "CharacterId", "Name", "Level", "Experience", "Strength", "CreatedAt", "UpdatedAt")
+    values = (character_id, int(characters.user_id), int(characters.character_id), characters.name, characters.level, characters.experience, characters.experience)
 
-    db.run_in_transaction(create_character_repository)
+    if GROUP_COMMIT:
+        await group_commit_writer.insert(TABLE, columns, (*values, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP))
+    else:
+        await db.run_in_transaction(create_character_repository)
 
     resp = CreateCharacterResponse(id=character_id, user_id=characters.user_id, character_id=characters.character_id, name=characters.name, level=characters.level, experience=characters.experience, strength=characters.strength)
     return JSONResponse(status_code=201, content=jsonable_encoder(resp))
 
 
 @router.delete("/", tags=["characters"], response_model=Optional[dict])
-def delete_all_characters(db: Database = Depends(get_db)) -> JSONResponse:
+async def delete_all_characters(db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
     """Delete all characters"""
-    db.execute_partitioned_dml(f"DELETE FROM {TABLE} WHERE Id > 0")
+    await db.execute_partitioned_dml(f"DELETE FROM {TABLE} WHERE Id > 0")
+    character_cache.clear()
     return JSONResponse(content=jsonable_encoder({}))
@@ -0,0 +1,104 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import datetime
+from functools import partial, wraps
+from os import getenv
+from time import perf_counter
+from typing import Any, Callable, List, Tuple
+
+from google.cloud.spanner_v1.database import Database
+from google.cloud.spanner_v1.transaction import Transaction
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from prometheus_client import Counter, Histogram
+
+# NOTE: the number of threads which wait on Spanner gRPC calls per worker
+EXECUTOR_WORKERS: int = int(getenv("SPANNER_EXECUTOR_WORKERS", "64"))
+
+transaction_latency = Histogram("spanner_transaction_latency_seconds", "Seconds to run and commit a transaction including retries", ["transaction"])
+transaction_aborts = Counter("spanner_transaction_aborts", "Attempts of a transaction which were aborted and retried", ["transaction"])
+
+tracer = trace.get_tracer(__name__)
+
+
+class AsyncDatabase:
+    """Awaitable data access to Cloud Spanner
+
+    google-cloud-spanner only provides blocking APIs, so every call is offloaded to a dedicated bounded executor.
+    It keeps the event loop free, and the Starlette threadpool is no longer a cap of concurrency per worker.
+    """
+
+    def __init__(self, database: Database, max_workers: int = EXECUTOR_WORKERS) -> None:
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="spanner")
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run a blocking function in the executor, with the context of the caller such as the current span"""
+        return await get_running_loop().run_in_executor(self.executor, partial(copy_context().run, func, *args, **kwargs))
+
+    async def run_in_transaction(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run func in a read-write transaction, which is retried by the client library when it is aborted"""
+        attempts = 0
+
+        @wraps(func)
+        def _func(transaction: Transaction, *args: Any, **kwargs: Any) -> Any:
+            nonlocal attempts
+            attempts += 1
+            return func(transaction, *args, **kwargs)
+
+        def _run_in_transaction() -> Any:
+            started_at = perf_counter()
+            try:
+                # NOTE: statements of the transaction are children of this span
+                with tracer.start_as_current_span(func.__name__, kind=SpanKind.CLIENT, attributes={"db.system": "spanner"}) as span:
+                    result = self.database.run_in_transaction(_func, *args, **kwargs)
+                    span.set_attribute("spanner.attempts", attempts)
+                    return result
+            finally:
+                # NOTE: labelled by the name of func, such as create_user_repository
+                transaction_latency.labels(func.__name__).observe(perf_counter() - started_at)
+                if attempts > 1:
+                    transaction_aborts.labels(func.__name__).inc(attempts - 1)
+        return await self.run(_run_in_transaction)
+
+    async def run_in_transaction_with_commit_timestamp(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Tuple[Any, datetime]:
+        """Run func in a read-write transaction, and return the result of func and the commit timestamp"""
+        transactions: List[Transaction] = []
+
+        @wraps(func)
+        def _func(transaction: Transaction, *args: Any, **kwargs: Any) -> Any:
+            # NOTE: an aborted transaction is retried by a new one, so the last one is committed
+            transactions.append(transaction)
+            return func(transaction, *args, **kwargs)
+        result = await self.run_in_transaction(_func, *args, **kwargs)
+        return result, transactions[-1].committed
+
+    async def batch(self, func: Callable[..., Any]) -> Any:
+        """Commit mutations which func buffers to a batch, and return the commit timestamp"""
+        def _batch() -> Any:
+            with transaction_latency.labels(func.__name__).time():
+                with self.database.batch() as batch:
+                    func(batch)
+            return batch.committed
+        return await self.run(_batch)
+
+    async def execute_partitioned_dml(self, dml: str, **kwargs: Any) -> int:
+        def _execute_partitioned_dml() -> int:
+            with transaction_latency.labels("partitioned_dml").time():
+                return self.database.execute_partitioned_dml(dml, **kwargs)
+        return await self.run(_execute_partitioned_dml)
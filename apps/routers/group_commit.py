@@ -0,0 +1,109 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from asyncio import wrap_future
+from concurrent.futures import Future
+from os import getenv
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, List, Optional, Tuple
+
+from google.api_core.exceptions import AlreadyExists, ClientError
+from google.cloud.spanner_v1.database import Database
+from prometheus_client import Histogram
+
+from .database import transaction_latency
+from .utils import get_db
+
+# NOTE: coalesce single row inserts of users and characters into batch commits when it is "true"
+GROUP_COMMIT: bool = getenv("GROUP_COMMIT", "false").lower() == "true"
+GROUP_COMMIT_MAX_ROWS: int = int(getenv("GROUP_COMMIT_MAX_ROWS", "100"))
+GROUP_COMMIT_MAX_DELAY_MS: float = float(getenv("GROUP_COMMIT_MAX_DELAY_MS", "5"))
+GROUP_COMMIT_WRITERS: int = int(getenv("GROUP_COMMIT_WRITERS", "2"))
+
+group_commit_rows = Histogram("group_commit_rows", "Rows per group commit", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+Insert = Tuple[str, Tuple[str, ...], Tuple[Any, ...], Future]
+
+
+class GroupCommitWriter:
+    """
+    Per worker writer to commit inserts of concurrent requests together
+
+    Inserts which arrive within max_delay_ms after the first one are committed by one batch, up to max_rows.
+    Each request waits for its own future, which resolves to the key of the row (the first value) or an error.
+    """
+
+    def __init__(self, database: Optional[Database] = None, max_rows: int = GROUP_COMMIT_MAX_ROWS, max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS, writers: int = GROUP_COMMIT_WRITERS) -> None:
+        self.database = database
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.writers = writers
+        self._queue: "Queue[Insert]" = Queue()
+        self._threads: List[Thread] = []
+        self._lock = Lock()
+
+    def submit(self, table: str, columns: Tuple[str, ...], values: Tuple[Any, ...]) -> Future:
+        # NOTE: start threads in the first call, because they must not be created before gunicorn forks workers
+        if not self._threads:
+            with self._lock:
+                if not self._threads:
+                    # NOTE: the database of this worker, it is created after fork
+                    self.database = self.database or get_db()
+                    self._threads = [Thread(target=self._run, name=f"group-commit-{i}", daemon=True) for i in range(self.writers)]
+                    for thread in self._threads:
+                        thread.start()
+        future: Future = Future()
+        self._queue.put((table, columns, values, future))
+        return future
+
+    async def insert(self, table: str, columns: Tuple[str, ...], values: Tuple[Any, ...]) -> Any:
+        return await wrap_future(self.submit(table, columns, values))
+
+    def _run(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            deadline = monotonic() + self.max_delay
+            while len(pending) < self.max_rows:
+                try:
+                    pending.append(self._queue.get(timeout=max(deadline - monotonic(), 0)))
+                except Empty:
+                    break
+            self._commit(pending)
+
+    def _commit(self, pending: List[Insert], ambiguous: bool = False) -> None:
+        try:
+            with transaction_latency.labels("group_commit").time(), self.database.batch() as batch:
+                for table, columns, values, _ in pending:
+                    batch.insert(table=table, columns=columns, values=[values])
+        except Exception as e:
+            if len(pending) == 1:
+                # NOTE: keys are generated by the client, so the row of a retry exists only when the batch was committed after all
+                if ambiguous and isinstance(e, AlreadyExists):
+                    pending[0][3].set_result(pending[0][2][0])
+                else:
+                    pending[0][3].set_exception(e)
+                return
+            # NOTE: a bad row such as a foreign key violation fails whole batch, so commit each row to find it.
+            # A server error such as a deadline is ambiguous, the batch may have been committed.
+            for insert in pending:
+                self._commit([insert], ambiguous=not isinstance(e, ClientError))
+            return
+        group_commit_rows.observe(len(pending))
+        for _, _, values, future in pending:
+            future.set_result(values[0])
+
+
+group_commit_writer = GroupCommitWriter()
@@ -0,0 +1,114 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from asyncio import get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import cpu_count
+from multiprocessing.context import SpawnContext, SpawnProcess
+from os import getenv
+from threading import Lock
+from time import time
+from types import ModuleType
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+from prometheus_client import Histogram
+
+from .runtime import WORKERS
+
+# NOTE: "process" runs bcrypt in a process pool to keep the GIL of workers, "thread" runs it in a thread pool
+PASSWORD_HASH_BACKEND: str = getenv("PASSWORD_HASH_BACKEND", "process")
+# NOTE: bcrypt cost factor, 4 is enough for stress tests but use 12 or more in production
+PASSWORD_HASH_ROUNDS: int = int(getenv("PASSWORD_HASH_ROUNDS") or "12")
+# NOTE: pools of all gunicorn workers share the cpus
+PASSWORD_HASH_WORKERS: int = int(getenv("PASSWORD_HASH_WORKERS") or max(1, cpu_count() // WORKERS))
+# NOTE: max hashing requests which are waiting or running per worker
+PASSWORD_HASH_QUEUE: int = int(getenv("PASSWORD_HASH_QUEUE", "256"))
+
+# NOTE: this module is imported by processes of the pool, so it must not import Spanner clients
+context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=PASSWORD_HASH_ROUNDS)
+
+password_hash_queue_wait = Histogram("password_hash_queue_wait_seconds", "Seconds which a password waits for a hashing worker")
+
+
+class PasswordHashQueueFull(Exception):
+    pass
+
+
+class PasswordHashProcess(SpawnProcess):
+    def start(self) -> None:
+        # NOTE: a spawned process runs the file of __main__ again, which is main.py and imports Spanner clients,
+        # so it is started with an empty __main__ and only imports this module to hash passwords
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = ModuleType("__main__")
+        try:
+            super().start()
+        finally:
+            sys.modules["__main__"] = main
+
+
+class PasswordHashContext(SpawnContext):
+    Process = PasswordHashProcess
+
+
+def get_password_hash(password: str, submitted_at: float) -> Tuple[str, float]:
+    """Return the hash and seconds which the password waited in the queue"""
+    started_at = time()
+    return context.hash(password), started_at - submitted_at
+
+
+class PasswordHasher:
+    """Hash passwords outside the event loop with a bounded queue"""
+
+    def __init__(self, backend: str = PASSWORD_HASH_BACKEND, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_QUEUE) -> None:
+        self.backend = backend
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self._lock = Lock()
+
+    @property
+    def executor(self) -> Executor:
+        # NOTE: create the pool in a worker after fork, and spawn processes not to copy gRPC channels
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.backend == "process":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=PasswordHashContext())
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return self._executor
+
+    async def hash(self, password: str) -> str:
+        with self._lock:
+            if self._pending >= self.max_queue:
+                raise PasswordHashQueueFull()
+            self._pending += 1
+        try:
+            hashed_password, waited = await get_running_loop().run_in_executor(self.executor, get_password_hash, password, time())
+        finally:
+            with self._lock:
+                self._pending -= 1
+        password_hash_queue_wait.observe(max(waited, 0))
+        return hashed_password
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,283 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from json import dumps, loads
+from os import getenv
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+from prometheus_client import Counter
+
+from .database import AsyncDatabase
+from .history_engine import Cursor, history_engine, sort_key
+from .runtime import WORKERS
+from .utils import battle_history_delay
+
+# NOTE: "off", "memory" (a single worker) or "redis" (shared by workers), a cold user is seeded by a strong read of BATTLE_HISTORY_CACHE_SIZE rows
+BATTLE_HISTORY_CACHE: str = getenv("BATTLE_HISTORY_CACHE", "off")
+# NOTE: the number of recent battles cached per user
+BATTLE_HISTORY_CACHE_SIZE: int = int(getenv("BATTLE_HISTORY_CACHE_SIZE", "300"))
+# NOTE: the number of users cached per worker by "memory"
+BATTLE_HISTORY_CACHE_USERS: int = int(getenv("BATTLE_HISTORY_CACHE_USERS", "10000"))
+REDIS_HOST: str = getenv("REDIS_HOST", "localhost")
+REDIS_PORT: int = int(getenv("REDIS_PORT", "6379"))
+# NOTE: seconds to keep battles appended to a user who is not seeded yet, it must exceed the time between a seed read and the seed
+REDIS_SEED_WINDOW: int = 60
+
+EPOCH: datetime = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# NOTE: the cache has every battle of a user whose UpdatedAt is after this
+ALL_HISTORIES: datetime = datetime.min.replace(tzinfo=timezone.utc)
+# NOTE: until of a read to seed a cache, it covers every battle
+SEED_UNTIL: int = 4102444800
+
+battle_history_cache_requests = Counter("battle_history_cache_requests", "Lookups of battle history cache", ["result"])
+
+
+def select(rows: List[Tuple], after: datetime, since: datetime, until: datetime, cursor: Optional[Cursor], limit: int) -> Optional[List[Tuple]]:
+    """
+    Answer a history read from cached rows ordered by (UpdatedAt, BattleHistoryId) descending
+
+    Every battle after `after` is cached, so a page is exact while it only needs rows after it.
+    None means the page needs rows which may not be cached.
+    """
+    page: List[Tuple] = []
+    for row in rows:
+        if row[5] < since:
+            break
+        if row[5] <= after:
+            return None
+        if row[5] <= until and (cursor is None or sort_key(row) < cursor):
+            page.append(row)
+            if len(page) == limit:
+                return page
+    return page if since > after else None
+
+
+class HistoryCache(ABC):
+    """
+    Cache of recent battles per user, which answers history reads without Spanner
+
+    A user is seeded by a strong read of the latest `size` battles at the first page of a history read, and battles
+    which this api commits are appended after the commit. When a user has more battles than `size`, only reads
+    within the cached range are answered, the others and the rest of pages are read from Spanner.
+    """
+
+    def __init__(self, size: int = BATTLE_HISTORY_CACHE_SIZE) -> None:
+        self.size = size
+        self._hits = battle_history_cache_requests.labels("hit")
+        self._misses = battle_history_cache_requests.labels("miss")
+
+    async def read(self, db: AsyncDatabase, user_id: int, since: int, until: int, cursor: Optional[Cursor], limit: int, staleness: timedelta) -> List[Tuple]:
+        since_at, until_at = datetime.fromtimestamp(since, timezone.utc), datetime.fromtimestamp(until, timezone.utc)
+        cached = await self.get(user_id)
+        if cached is None and cursor is None and limit <= self.size:
+            rows = await history_engine.read(db, user_id, 0, SEED_UNTIL, None, self.size, timedelta(0))
+            cached = rows, ALL_HISTORIES if len(rows) < self.size else rows[-1][5]
+            await self.seed(user_id, *cached)
+        page = select(*cached, since_at, until_at, cursor, limit) if cached else None
+        if page is not None:
+            self._hits.inc()
+            return page
+        self._misses.inc()
+        return await history_engine.read(db, user_id, since, until, cursor, limit, staleness)
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[Tuple[List[Tuple], datetime]]:
+        """Return cached rows in descending order and the time after which every battle is cached"""
+
+    @abstractmethod
+    async def seed(self, user_id: int, rows: List[Tuple], after: datetime) -> None:
+        pass
+
+    @abstractmethod
+    async def append(self, row: Tuple) -> None:
+        """Add a committed battle to the cache of the user"""
+
+    @abstractmethod
+    async def clear(self) -> None:
+        pass
+
+
+class NoHistoryCache(HistoryCache):
+    async def read(self, db: AsyncDatabase, user_id: int, since: int, until: int, cursor: Optional[Cursor], limit: int, staleness: timedelta) -> List[Tuple]:
+        return await history_engine.read(db, user_id, since, until, cursor, limit, staleness)
+
+    async def get(self, user_id: int) -> Optional[Tuple[List[Tuple], datetime]]:
+        return None
+
+    async def seed(self, user_id: int, rows: List[Tuple], after: datetime) -> None:
+        pass
+
+    async def append(self, row: Tuple) -> None:
+        pass
+
+    async def clear(self) -> None:
+        pass
+
+
+class MemoryHistoryCache(HistoryCache):
+    """
+    Per worker cache of recent battles
+
+    A worker only appends battles which it committed, so a user expires ttl seconds after it was seeded. The default ttl
+    is the staleness of history reads, so it is never staler than the stale read which it replaces.
+    It is for a single worker, a delete of battle histories only clears the cache of the worker which handles it.
+    """
+
+    def __init__(self, size: int = BATTLE_HISTORY_CACHE_SIZE, max_users: int = BATTLE_HISTORY_CACHE_USERS, ttl: float = battle_history_delay) -> None:
+        super().__init__(size)
+        self.max_users = max_users
+        self.ttl = ttl
+        # NOTE: user id to (seeded at, after, rows in ascending order, battle history ids)
+        self._users: "OrderedDict[int, Tuple[float, datetime, List[Tuple], set]]" = OrderedDict()
+        self._lock = Lock()
+
+    async def get(self, user_id: int) -> Optional[Tuple[List[Tuple], datetime]]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            seeded_at, after, rows, _ = entry
+            if monotonic() - seeded_at > self.ttl:
+                del self._users[user_id]
+                return None
+            self._users.move_to_end(user_id)
+            # NOTE: battles older than the oldest cached one may have been dropped when the cache was full
+            return rows[::-1], max(after, rows[0][5]) if len(rows) >= self.size else after
+
+    async def seed(self, user_id: int, rows: List[Tuple], after: datetime) -> None:
+        with self._lock:
+            self._users[user_id] = (monotonic(), after, sorted(rows, key=sort_key), {row[6] for row in rows})
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    async def append(self, row: Tuple) -> None:
+        with self._lock:
+            entry = self._users.get(row[0])
+            if entry is None or row[6] in entry[3]:
+                return
+            _, _, rows, ids = entry
+            # NOTE: commits of concurrent requests finish in any order, and sort of almost sorted rows is O(n)
+            rows.append(row)
+            rows.sort(key=sort_key)
+            ids.add(row[6])
+            while len(rows) > self.size:
+                ids.discard(rows.pop(0)[6])
+
+    async def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+
+class RedisHistoryCache(HistoryCache):
+    """
+    Cache of recent battles shared by workers on Redis
+
+    Every worker appends battles which it committed, so a user is kept until nobody reads or writes it for ttl seconds.
+    A sorted set per user has battles scored by UpdatedAt, and another key has `after` and marks that the user is seeded.
+    Battles are appended to users who are not seeded yet too, and a seed merges its rows into them, so a battle which
+    commits after the seed read and is appended before the seed is not lost.
+    """
+
+    # NOTE: a set without `after` is not answered, so battles of a user who is not seeded are only kept for the seed window
+    APPEND_SCRIPT = """
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+    if redis.call('EXISTS', KEYS[2]) == 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+        return 0
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+    return 1
+    """
+
+    def __init__(self, size: int = BATTLE_HISTORY_CACHE_SIZE, ttl: float = 300, host: str = REDIS_HOST, port: int = REDIS_PORT) -> None:
+        # NOTE: redis is only needed by this backend
+        from redis.asyncio import Redis
+
+        super().__init__(size)
+        self.ttl = int(ttl)
+        self.redis = Redis(host=host, port=port)
+        self._append = self.redis.register_script(self.APPEND_SCRIPT)
+
+    @staticmethod
+    def keys(user_id: int) -> Tuple[str, str]:
+        return f"battle_history:{user_id}", f"battle_history:{user_id}:after"
+
+    @staticmethod
+    def dumps(row: Tuple) -> Tuple[int, str]:
+        micros = [(time - EPOCH) // timedelta(microseconds=1) for time in row[4:6]]
+        return micros[1], dumps([*row[:4], *micros, row[6]])
+
+    @staticmethod
+    def loads(member: bytes) -> Tuple:
+        user_id, character_id, opponent_id, result, created_at, updated_at, battle_history_id = loads(member)
+        return user_id, character_id, opponent_id, result, EPOCH + timedelta(microseconds=created_at), EPOCH + timedelta(microseconds=updated_at), battle_history_id
+
+    async def get(self, user_id: int) -> Optional[Tuple[List[Tuple], datetime]]:
+        rows_key, after_key = self.keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            after, members = await pipeline.get(after_key).zrevrange(rows_key, 0, -1).execute()
+        if after is None:
+            return None
+        rows = [self.loads(member) for member in members]
+        after_at = ALL_HISTORIES if int(after) < 0 else EPOCH + timedelta(microseconds=int(after))
+        return rows, max(after_at, rows[-1][5]) if len(rows) >= self.size else after_at
+
+    async def seed(self, user_id: int, rows: List[Tuple], after: datetime) -> None:
+        rows_key, after_key = self.keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            if rows:
+                pipeline.zadd(rows_key, {member: score for score, member in map(self.dumps, rows)})
+            pipeline.zremrangebyrank(rows_key, 0, -self.size - 1).expire(rows_key, self.ttl)
+            pipeline.set(after_key, -1 if after == ALL_HISTORIES else (after - EPOCH) // timedelta(microseconds=1), ex=self.ttl)
+            await pipeline.execute()
+
+    async def append(self, row: Tuple) -> None:
+        try:
+            score, member = self.dumps(row)
+            await self._append(keys=self.keys(row[0]), args=[score, member, self.size, self.ttl, REDIS_SEED_WINDOW])
+        except Exception:
+            # NOTE: a user without a committed battle must not be answered from the cache
+            logger.exception(f"failed to append a battle history of {row[0]} to the cache")
+            try:
+                await self.redis.delete(*self.keys(row[0]))
+            except Exception:
+                # NOTE: the battle is committed, so the request must not fail by the cache
+                logger.exception(f"failed to invalidate the battle history cache of {row[0]}")
+
+    async def clear(self) -> None:
+        async for key in self.redis.scan_iter(match="battle_history:*", count=1000):
+            await self.redis.delete(key)
+
+
+def create_history_cache(backend: str = BATTLE_HISTORY_CACHE, workers: int = WORKERS) -> HistoryCache:
+    ttl: Dict[str, Any] = {"ttl": float(getenv("BATTLE_HISTORY_CACHE_TTL"))} if getenv("BATTLE_HISTORY_CACHE_TTL") else {}
+    if backend == "memory":
+        if workers > 1:
+            raise ValueError(f"the memory battle history cache is for a single worker, use redis for {workers} workers")
+        return MemoryHistoryCache(**ttl)
+    if backend == "redis":
+        return RedisHistoryCache(**ttl)
+    return NoHistoryCache()
+
+
+history_cache = create_history_cache()
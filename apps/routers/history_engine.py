@@ -0,0 +1,93 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from asyncio import Semaphore, gather
+from datetime import datetime, timedelta, timezone
+from heapq import merge
+from itertools import islice
+from os import getenv
+from typing import Any, Dict, List, Optional, Tuple
+
+from .database import AsyncDatabase
+from .keys import ENTRY_SHARDS
+from .statements import Statement, select_battle_histories
+from .utils import epoch_to_datetime
+
+BattleHistory: str = "BattleHistory"
+# NOTE: the number of queries which a history read is split into by EntryShardId, 1 is a single query over all shards
+HISTORY_SHARD_GROUPS: int = int(getenv("HISTORY_SHARD_GROUPS", "10"))
+# NOTE: the number of queries of a history read which run at the same time
+HISTORY_PARALLELISM: int = int(getenv("HISTORY_PARALLELISM", "10"))
+
+Cursor = Tuple[datetime, int]
+
+
+def sort_key(row: Tuple) -> Tuple[datetime, int]:
+    # NOTE: (UpdatedAt, BattleHistoryId) is unique, so the order is stable between pages
+    return row[5], row[6]
+
+
+def battle_history_query(user_id: int, since: int, until: int, cursor: Optional[Cursor], limit: Optional[int],
+                         shards: Tuple[int, int] = (0, ENTRY_SHARDS - 1)) -> Tuple[Statement, Dict[str, Any]]:
+    """
+    Pick a keyset query of battle histories of a range of EntryShardId and its parameters
+
+    Rows are ordered by (UpdatedAt, BattleHistoryId) descending, so the next page starts right after the last row
+    without OFFSET, and the cost of a page does not grow with the depth of the page.
+    """
+    params = {"ShardFrom": shards[0], "ShardTo": shards[1], "UserId": user_id, "Since": epoch_to_datetime(since), "Until": epoch_to_datetime(until)}
+    if cursor:
+        params["CursorUpdatedAt"], params["CursorId"] = cursor
+    if limit:
+        params["Limit"] = limit
+    return select_battle_histories[cursor is not None, bool(limit)], params
+
+
+def shard_groups(groups: int, shards: int = ENTRY_SHARDS) -> List[Tuple[int, int]]:
+    """Split EntryShardId 0..shards-1 into contiguous ranges of almost the same size"""
+    groups = max(1, min(groups, shards))
+    bounds = [shards * i // groups for i in range(groups + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(groups)]
+
+
+class HistoryEngine:
+    """
+    Read battle histories of a user by concurrent queries per group of EntryShardId
+
+    A single query over all shards seeks each shard of the index one by one in the server. Each group is read by its
+    own query, at most parallelism queries run at once, and all of them read at the same timestamp, so the merged
+    result is the same as one stale query. Each query returns at most limit rows in order, and k-way merge stops
+    as soon as limit rows are taken.
+    """
+
+    def __init__(self, groups: int = HISTORY_SHARD_GROUPS, parallelism: int = HISTORY_PARALLELISM) -> None:
+        self.groups = shard_groups(groups)
+        self.parallelism = max(1, parallelism)
+
+    async def read(self, db: AsyncDatabase, user_id: int, since: int, until: int, cursor: Optional[Cursor], limit: int, staleness: timedelta) -> List[Tuple]:
+        # NOTE: fix the read timestamp once, exact_staleness per query would read each group at a different time
+        read_timestamp = datetime.now(timezone.utc) - staleness
+        # NOTE: create a semaphore per read, because it is bound to the running event loop
+        semaphore = Semaphore(self.parallelism)
+
+        async def _read_group(shards: Tuple[int, int]) -> List[Tuple]:
+            statement, params = battle_history_query(user_id, since, until, cursor, limit, shards)
+            async with semaphore:
+                return await statement.read(db, params, read_timestamp=read_timestamp)
+
+        results = await gather(*[_read_group(shards) for shards in self.groups])
+        return list(islice(merge(*results, key=sort_key, reverse=True), limit))
+
+
+history_engine = HistoryEngine()
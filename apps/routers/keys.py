@@ -0,0 +1,142 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from abc import ABC, abstractmethod
+from itertools import count
+from os import getenv, register_at_fork
+from os.path import abspath, dirname, join
+from random import getrandbits, randrange
+from typing import Any, Dict, Iterator, Optional
+from uuid import uuid4
+
+# NOTE: "bit_reversed" (bit-reversed counters per worker), "prefixed_counter" (counters per worker after a random prefix),
+# "random" (random 63 bits) or "uuid" (uuid4 masked to 63 bits)
+KEY_STRATEGY: str = getenv("KEY_STRATEGY") or "bit_reversed"
+# NOTE: shards of EntryShardId are stored next to the schema, because rows which are written by a shard count must be read by it
+SHARD_CONFIG_PATH: str = getenv("SHARD_CONFIG_PATH") or join(dirname(dirname(abspath(__file__))), "schemas", "shards.json")
+
+# NOTE: keys are positive INT64, a sequence of a worker is its random id in the high bits and a counter in the low bits
+KEY_BITS: int = 63
+COUNTER_BITS: int = 40
+WORKER_BITS: int = KEY_BITS - COUNTER_BITS
+KEY_MASK: int = (1 << KEY_BITS) - 1
+COUNTER_MASK: int = (1 << COUNTER_BITS) - 1
+
+_REVERSED_BYTES = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+
+def reverse_bits(value: int) -> int:
+    """Reverse the order of 63 bits, the lowest bit of a counter becomes the highest bit of a key"""
+    return int.from_bytes(value.to_bytes(8, "little").translate(_REVERSED_BYTES), "big") >> 1
+
+
+def load_shard_config(path: str = SHARD_CONFIG_PATH) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+class KeyGenerator(ABC):
+    """Generate primary keys of INT64 columns"""
+
+    @abstractmethod
+    def next_key(self) -> int:
+        pass
+
+
+class UuidKeys(KeyGenerator):
+    """The previous keys, which read 16 bytes of os.urandom per key"""
+
+    def next_key(self) -> int:
+        return uuid4().int & KEY_MASK
+
+
+class RandomKeys(KeyGenerator):
+    """
+    Random keys by the generator of the random module, which is seeded again in a forked worker
+
+    It is cheaper than uuid4, but collisions are as likely as uuid4 masked to 63 bits.
+    """
+
+    def next_key(self) -> int:
+        return getrandbits(KEY_BITS)
+
+
+class CounterKeys(KeyGenerator):
+    """
+    Keys of a counter per worker after a random worker id
+
+    Keys of a worker are unique without a round trip, and two workers only collide when they draw the same worker id
+    and their counters, which start at random, overlap. The worker id and the counter are drawn again after fork,
+    so workers which are forked from the same master do not share them.
+    """
+
+    def __init__(self, worker_id: Optional[int] = None) -> None:
+        self._worker_id = worker_id
+        self._reset()
+        register_at_fork(after_in_child=self._reset)
+
+    def _reset(self) -> None:
+        self.worker_id = getrandbits(WORKER_BITS) if self._worker_id is None else self._worker_id
+        self._counter: Iterator[int] = count(getrandbits(COUNTER_BITS - 8))
+
+    def sequence(self) -> int:
+        return (self.worker_id << COUNTER_BITS) | (next(self._counter) & COUNTER_MASK)
+
+
+class BitReversedKeys(CounterKeys):
+    """
+    Bit-reversed sequences, like bit-reversed sequences of Spanner
+
+    Consecutive keys of a worker differ in their highest bits, so writes are spread over all splits of a table.
+    """
+
+    def next_key(self) -> int:
+        return reverse_bits(self.sequence())
+
+
+class PrefixedCounterKeys(CounterKeys):
+    """
+    Keys which increase from a random prefix per worker
+
+    Each worker appends to its own range of keys, so recent rows of a worker are close and a table has as many hot spots
+    as workers. It keeps locality of rows which are written together, and relies on Spanner to split hot ranges.
+    """
+
+    def next_key(self) -> int:
+        return self.sequence()
+
+
+KEY_STRATEGIES = {"bit_reversed": BitReversedKeys, "prefixed_counter": PrefixedCounterKeys, "random": RandomKeys, "uuid": UuidKeys}
+
+
+def create_key_generator(strategy: str = KEY_STRATEGY) -> KeyGenerator:
+    if strategy not in KEY_STRATEGIES:
+        raise ValueError(f"unknown key strategy: {strategy}")
+    return KEY_STRATEGIES[strategy]()
+
+
+shard_config: Dict[str, Any] = load_shard_config()
+# NOTE: shards can be added, but not removed, because history reads only read shards below it
+ENTRY_SHARDS: int = int(shard_config["entry_shards"])
+key_generator: KeyGenerator = create_key_generator()
+
+
+def next_key() -> int:
+    return key_generator.next_key()
+
+
+def next_entry_shard_id() -> int:
+    # NOTE: EntryShardId only spreads the index, so it needs no relation to the key of a row
+    return randrange(ENTRY_SHARDS)
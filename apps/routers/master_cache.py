@@ -0,0 +1,266 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from os import getenv
+from random import random, randrange
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from google.cloud.spanner_v1.database import Database
+from loguru import logger
+from prometheus_client import Counter
+
+from .database import AsyncDatabase
+from .statements import INT64, TIMESTAMP, Statement
+from .utils import character_master_delay, opponent_master_delay
+
+MASTER_CACHE_SIZE: int = int(getenv("MASTER_CACHE_SIZE", "100000"))
+# NOTE: seconds between reads of all keys of a master table to drop rows which were deleted by other workers
+MASTER_CACHE_KEY_SWEEP: float = float(getenv("MASTER_CACHE_KEY_SWEEP", "60"))
+
+master_cache_requests = Counter("master_cache_requests", "Lookups of master data cache", ["table", "result"])
+
+
+class MasterCache:
+    """
+    Per worker cache of a master table
+
+    Rows are bulk-loaded by a snapshot and refreshed at least every ttl seconds, so they are never staler than
+    the stale read which the api allowed for master data. A refresh reads rows updated since the previous one
+    by the index of UpdatedAt, and all keys of the table are read every MASTER_CACHE_KEY_SWEEP seconds to drop rows
+    which were deleted. A row which was deleted before the next sweep can be dropped by discard.
+    Rows beyond max_size are read on demand and the least recently used row is evicted.
+    """
+
+    def __init__(self, table: str, columns: Tuple[str, ...], ttl: float, max_size: int = MASTER_CACHE_SIZE, weight_column: Optional[str] = None) -> None:
+        self.table = table
+        self.columns = columns
+        self.key = columns[0]
+        self.ttl = ttl
+        self.max_size = max_size
+        self.weight = columns.index(weight_column) if weight_column else None
+        self._rows: "OrderedDict[int, Tuple]" = OrderedDict()
+        # NOTE: array of keys for O(1) random pick and O(1) removal by swapping with the last key
+        self._keys: List[int] = []
+        self._positions: Dict[int, int] = {}
+        # NOTE: alias table of Vose's alias method for O(1) weighted random pick and the keys which it was built from,
+        # it is rebuilt by loads after keys or weights change, and picks skip keys which were removed since then
+        self._alias: Optional[Tuple[List[float], List[int], List[int]]] = None
+        self._changes: int = 0
+        self._alias_changes: int = 0
+        self._loaded_at: float = 0.0
+        self._swept_at: float = 0.0
+        # NOTE: (UpdatedAt, key) of the last row which was loaded
+        self._watermark: Optional[Tuple[datetime, int]] = None
+        self._lock = Lock()
+        self._loading = Lock()
+        self._stopped = Event()
+        select = f"SELECT {', '.join(columns)} FROM {table}"
+        # NOTE: UpdatedAt is the last column of loaded rows, it is a commit timestamp and the next watermark
+        load = f"SELECT {', '.join(columns)}, UpdatedAt FROM {table}"
+        self._load_all = Statement(f"load_{table.lower()}", f"{load} LIMIT @Limit", {"Limit": INT64}, service="load_master_cache", target=table.lower())
+        # NOTE: a range read of the index from the watermark, rows of the same UpdatedAt are ordered by the key
+        self._load_updated = Statement(f"load_updated_{table.lower()}", f"SELECT {', '.join(columns)}, UpdatedAt FROM {table}@{{FORCE_INDEX={table}ByUpdatedAt}} "
+                                       f"WHERE UpdatedAt >= @Since AND (UpdatedAt > @Since OR {self.key} > @Key)", {"Since": TIMESTAMP, "Key": INT64}, service="load_master_cache", target=table.lower())
+        self._load_keys = Statement(f"load_keys_{table.lower()}", f"SELECT {self.key} FROM {table}", service="load_master_cache", target=table.lower())
+        self._select = Statement(f"select_{table.lower()}", f"{select} WHERE {self.key}=@Key", {"Key": INT64}, service="read_master_cache", target=table.lower())
+        self._hits = master_cache_requests.labels(table, "hit")
+        self._misses = master_cache_requests.labels(table, "miss")
+
+    @property
+    def expired(self) -> bool:
+        return monotonic() - self._loaded_at > self.ttl
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, database: Database) -> None:
+        """Read rows updated since the previous load by a strong snapshot, concurrent callers wait for the running load"""
+        if not self._loading.acquire(blocking=False):
+            with self._loading:
+                return
+        try:
+            started_at, keys = monotonic(), None
+            full = self._watermark is None
+            sweep = not full and started_at - self._swept_at > MASTER_CACHE_KEY_SWEEP
+            if full:
+                with database.snapshot() as snapshot:
+                    rows = list(self._load_all.stream(snapshot, {"Limit": self.max_size}))
+            else:
+                # NOTE: keys and updated rows are read at the same timestamp, so a row is either deleted or updated
+                with database.snapshot(multi_use=sweep) as snapshot:
+                    if sweep:
+                        snapshot.begin()
+                        keys = {row[0] for row in self._load_keys.stream(snapshot)}
+                    since, key = self._watermark
+                    rows = list(self._load_updated.stream(snapshot, {"Since": since, "Key": key}))
+            # NOTE: a strong read sees every commit before it, so a later commit has a later UpdatedAt than any row read here
+            watermark = max(((row[-1], row[0]) for row in rows), default=self._watermark)
+            with self._lock:
+                if full:
+                    self._rows = OrderedDict((row[0], tuple(row[:-1])) for row in rows)
+                    self._keys = list(self._rows)
+                    self._positions = {key: i for i, key in enumerate(self._keys)}
+                    self._changes += 1
+                else:
+                    deleted = [key for key in self._rows if key not in keys] if keys is not None else []
+                    for key in deleted:
+                        self._remove(key)
+                    for row in rows:
+                        self._put(tuple(row[:-1]))
+                self._watermark, self._loaded_at = watermark, started_at
+                if full or sweep:
+                    self._swept_at = started_at
+            self._build_alias()
+        finally:
+            self._loading.release()
+
+    def _build_alias(self) -> None:
+        """Rebuild the alias table out of the lock, so picks of the event loop do not wait for it"""
+        if self.weight is None:
+            return
+        with self._lock:
+            if self._alias is not None and self._alias_changes == self._changes:
+                return
+            changes, keys = self._changes, list(self._keys)
+            weights = [self._rows[key][self.weight] for key in keys]
+        probabilities, aliases = build_alias(weights)
+        with self._lock:
+            self._alias, self._alias_changes = (probabilities, aliases, keys), changes
+
+    async def refresh(self, db: AsyncDatabase) -> None:
+        """Reload rows before serving them if the background reload fell behind"""
+        if self.expired:
+            await db.run(self.load, db.database)
+
+    def put(self, row: Tuple) -> None:
+        with self._lock:
+            self._put(row)
+
+    def _put(self, row: Tuple) -> None:
+        key = row[0]
+        previous = self._rows.get(key)
+        if previous is None:
+            if len(self._keys) >= self.max_size:
+                self._remove(next(iter(self._rows)))
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._changes += 1
+        elif self.weight is not None and previous[self.weight] != row[self.weight]:
+            self._changes += 1
+        self._rows[key] = row
+        self._rows.move_to_end(key)
+
+    def discard(self, key: int) -> None:
+        """Drop a row which was found deleted, and read all keys by the next refresh"""
+        with self._lock:
+            if key in self._rows:
+                self._remove(key)
+            self._swept_at = 0.0
+
+    def _remove(self, key: int) -> None:
+        del self._rows[key]
+        self._changes += 1
+        position, last = self._positions.pop(key), self._keys.pop()
+        if last != key:
+            self._keys[position], self._positions[last] = last, position
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows, self._keys, self._positions, self._alias = OrderedDict(), [], {}, None
+            self._loaded_at, self._swept_at, self._watermark = 0.0, 0.0, None
+
+    def choice(self) -> Optional[Tuple]:
+        """Pick a row uniformly at random"""
+        with self._lock:
+            row = self._rows[self._keys[randrange(len(self._keys))]] if self._keys else None
+        (self._misses if row is None else self._hits).inc()
+        return row
+
+    def weighted_choice(self) -> Optional[Tuple]:
+        """Pick a row at random in proportion to the weight column of the last load"""
+        if self._alias is None:
+            # NOTE: only before the first load builds it
+            self._build_alias()
+        with self._lock:
+            row = None
+            if self._alias is not None and self._alias[2]:
+                probabilities, aliases, keys = self._alias
+                i = randrange(len(probabilities))
+                row = self._rows.get(keys[i if random() < probabilities[i] else aliases[i]])
+            # NOTE: a key which was removed after the last load is replaced by a uniform pick
+            if row is None and self._keys:
+                row = self._rows[self._keys[randrange(len(self._keys))]]
+        (self._misses if row is None else self._hits).inc()
+        return row
+
+    async def get(self, key: int, db: AsyncDatabase) -> Optional[Tuple]:
+        """Get a row by the primary key, it is read from Spanner with the same staleness when the cache misses"""
+        await self.refresh(db)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self._rows.move_to_end(key)
+        if row is not None:
+            self._hits.inc()
+            return row
+        self._misses.inc()
+        results = await self._select.read(db, {"Key": key}, exact_staleness=timedelta(seconds=self.ttl))
+        if not results:
+            return None
+        row = tuple(results[0])
+        self.put(row)
+        return row
+
+    def start(self, database: Database) -> None:
+        """Reload rows in a background thread, so requests rarely wait for a reload"""
+        def _reload_forever() -> None:
+            while not self._stopped.wait(self.ttl / 2):
+                try:
+                    self.load(database)
+                except Exception:
+                    logger.exception(f"failed to reload master cache of {self.table}")
+
+        self._stopped.clear()
+        Thread(target=_reload_forever, name=f"master-cache-{self.table}", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def build_alias(weights: List[float]) -> Tuple[List[float], List[int]]:
+    """Build an alias table of Vose's alias method in O(n)"""
+    size, total = len(weights), sum(max(weight, 0) for weight in weights)
+    if total <= 0:
+        return [1.0] * size, list(range(size))
+    probabilities = [max(weight, 0) * size / total for weight in weights]
+    aliases = list(range(size))
+    small = [i for i, probability in enumerate(probabilities) if probability < 1.0]
+    large = [i for i, probability in enumerate(probabilities) if probability >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        aliases[less] = more
+        probabilities[more] -= 1.0 - probabilities[less]
+        (small if probabilities[more] < 1.0 else large).append(more)
+    # NOTE: rest of them are 1.0 except rounding errors
+    for i in small + large:
+        probabilities[i] = 1.0
+    return probabilities, aliases
+
+
+character_masters = MasterCache("CharacterMasters", ("CharacterId", "Name", "Kind"), ttl=character_master_delay)
+opponent_masters = MasterCache("OpponentMasters", ("OpponentId", "Name", "Kind", "Strength", "Experience"), ttl=opponent_master_delay, weight_column="Strength")
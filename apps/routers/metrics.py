@@ -0,0 +1,55 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from glob import glob
+from os import getenv, makedirs, remove
+from os.path import join
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, generate_latest,
+                               multiprocess)
+
+# NOTE: gunicorn workers write their metrics to files in this directory, and /metrics aggregates all of them.
+# prometheus_client reads it when it is imported, so it is set by the Dockerfile instead of here
+PROMETHEUS_MULTIPROC_DIR: str = getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+router = APIRouter(tags=["metrics"])
+
+
+def clear_multiprocess_dir() -> None:
+    """Remove metrics of previous runs, it is called by the gunicorn master before it forks workers"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    for path in glob(join(PROMETHEUS_MULTIPROC_DIR, "*.db")):
+        remove(path)
+
+
+def mark_worker_dead(pid: int) -> None:
+    """Drop live gauges of an exited worker, it is called by the gunicorn master"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics() -> Response:
+    """Metrics of all workers in Prometheus text format"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
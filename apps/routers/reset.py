@@ -0,0 +1,265 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from asyncio import CancelledError, Task, create_task, gather, sleep
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+from os import O_CREAT, O_RDWR, close, getenv, makedirs, replace
+from os import open as open_fd
+from os.path import abspath, dirname, exists, join
+from pathlib import Path
+from tempfile import gettempdir
+from typing import Dict, List, Optional, Set, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from .character_cache import character_cache
+from .database import AsyncDatabase
+from .history_cache import history_cache
+from .master_cache import character_masters, opponent_masters
+from .utils import get_async_db, get_uuid
+
+# NOTE: job files are shared by gunicorn workers of an instance, but not by instances, so reset a single instance
+RESET_JOB_DIR: str = getenv("RESET_JOB_DIR") or join(gettempdir(), "spanner-reset-jobs")
+# NOTE: seconds between saves of a running job, a job which is not saved for 3 heartbeats lost its worker
+RESET_JOB_HEARTBEAT: float = float(getenv("RESET_JOB_HEARTBEAT", "10"))
+SCHEMA_PATH: str = getenv("SCHEMA_PATH") or join(dirname(dirname(abspath(__file__))), "schemas", "tables.sql")
+# NOTE: seconds to wait for schema changes of a recreate
+SCHEMA_UPDATE_TIMEOUT: int = int(getenv("SCHEMA_UPDATE_TIMEOUT", "600"))
+
+# NOTE: tables of a stage are deleted in parallel after all tables of the previous stage,
+# children of interleaving and foreign keys are deleted before their parents
+RESET_STAGES: Tuple[Tuple[str, ...], ...] = (("BattleHistory",), ("Characters", "OpponentMasters"), ("Users", "CharacterMasters"))
+
+router = APIRouter(prefix="/reset", tags=["reset"])
+
+# NOTE: keep references of running jobs, the event loop only keeps weak references of tasks
+_tasks: Set[Task] = set()
+
+
+class ResetMode(str, Enum):
+    delete = "delete"
+    recreate = "recreate"
+
+
+class JobState(str, Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class TableStatus(BaseModel):
+    table: str = Field(..., example="Users")
+    state: JobState = Field(..., example="done")
+    rows_deleted: Optional[int] = Field(None, example=1000, description="lower bound of deleted rows by partitioned DML")
+    error: Optional[str] = Field(None, example=None)
+
+
+class ResetJobResponse(BaseModel):
+    job_id: str = Field(..., example="111111111")
+    mode: ResetMode = Field(..., example="delete")
+    state: JobState = Field(..., example="running")
+    tables: List[TableStatus] = Field(...)
+    error: Optional[str] = Field(None, example=None)
+    created_at: datetime = Field(...)
+    finished_at: Optional[datetime] = Field(None)
+    heartbeat_at: Optional[datetime] = Field(None, description="last save of the job by its worker")
+
+    @property
+    def stale(self) -> bool:
+        """The worker of an unfinished job stopped without saving its result, for example by a restart"""
+        if self.state not in (JobState.pending, JobState.running) or self.heartbeat_at is None:
+            return False
+        return datetime.now(timezone.utc) - self.heartbeat_at > timedelta(seconds=3 * RESET_JOB_HEARTBEAT)
+
+
+def read_schema(path: str = SCHEMA_PATH) -> List[str]:
+    """DDL statements of a schema file, update_ddl does not accept comments and semicolons"""
+    lines = [line for line in Path(path).read_text().splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def drop_statements(schema: List[str]) -> List[str]:
+    """DROP statements of indexes and tables of a schema, children are dropped before their parents"""
+    indexes = [statement.split()[2] for statement in schema if statement.upper().startswith("CREATE INDEX")]
+    tables = [statement.split()[2] for statement in schema if statement.upper().startswith("CREATE TABLE")]
+    return [f"DROP INDEX {index}" for index in indexes] + [f"DROP TABLE {table}" for table in reversed(tables)]
+
+
+class ResetJob:
+    """A reset which runs in background of a worker, and writes its status to a file in every change"""
+
+    def __init__(self, mode: ResetMode, job_id: Optional[str] = None) -> None:
+        self.status = ResetJobResponse(job_id=job_id or str(get_uuid()), mode=mode, state=JobState.pending, created_at=datetime.now(timezone.utc),
+                                       tables=[TableStatus(table=table, state=JobState.pending) for stage in RESET_STAGES for table in stage])
+        self._tables: Dict[str, TableStatus] = {table.table: table for table in self.status.tables}
+        self._lock: Optional[int] = None
+
+    @staticmethod
+    def path(job_id: str) -> str:
+        # NOTE: job ids are numbers, so they can not escape the directory
+        return join(RESET_JOB_DIR, f"{int(job_id)}.json")
+
+    def lock(self) -> bool:
+        """Take the lock of resets of the instance, False when another reset has it"""
+        makedirs(RESET_JOB_DIR, exist_ok=True)
+        # NOTE: workers check and start a reset at the same time, and the kernel releases the lock of a worker which died
+        fd = open_fd(join(RESET_JOB_DIR, "reset.lock"), O_CREAT | O_RDWR)
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            close(fd)
+            return False
+        self._lock = fd
+        return True
+
+    def unlock(self) -> None:
+        if self._lock is not None:
+            flock(self._lock, LOCK_UN)
+            close(self._lock)
+            self._lock = None
+
+    def save(self) -> None:
+        makedirs(RESET_JOB_DIR, exist_ok=True)
+        self.status.heartbeat_at = datetime.now(timezone.utc)
+        path = self.path(self.status.job_id)
+        with open(path + ".tmp", "w") as f:
+            f.write(self.status.json())
+        # NOTE: readers never see a partially written file
+        replace(path + ".tmp", path)
+
+    async def run(self, db: AsyncDatabase) -> None:
+        self.status.state = JobState.running
+        self.save()
+        heartbeat = create_task(self._heartbeat())
+        try:
+            if self.status.mode == ResetMode.recreate:
+                await self._recreate(db)
+            else:
+                for stage in RESET_STAGES:
+                    await gather(*[self._delete(db, table) for table in stage])
+                    if any(self._tables[table].state == JobState.failed for table in stage):
+                        raise RuntimeError(f"failed to delete {', '.join(stage)}")
+            self.status.state = JobState.done
+        except Exception as e:
+            logger.exception("failed to reset the database")
+            self.status.state, self.status.error = JobState.failed, str(e)
+        except CancelledError:
+            # NOTE: the worker is shutting down, statements which were sent may still finish in Spanner
+            logger.warning("reset of the database was cancelled")
+            self.status.state, self.status.error = JobState.failed, "cancelled by shutdown of the worker"
+            raise
+        finally:
+            heartbeat.cancel()
+            self.status.finished_at = datetime.now(timezone.utc)
+            try:
+                self.save()
+            finally:
+                self.unlock()
+            # NOTE: caches of this worker, the others are expired by their ttl or reload
+            await history_cache.clear()
+            character_masters.clear()
+            opponent_masters.clear()
+            character_cache.clear()
+
+    async def _heartbeat(self) -> None:
+        # NOTE: a partitioned DML or a schema change can take minutes without a change of the status
+        while True:
+            await sleep(RESET_JOB_HEARTBEAT)
+            self.save()
+
+    async def _delete(self, db: AsyncDatabase, table: str) -> None:
+        table_status = self._tables[table]
+        table_status.state = JobState.running
+        self.save()
+        try:
+            table_status.rows_deleted = await db.execute_partitioned_dml(f"DELETE FROM {table} WHERE true")
+            table_status.state = JobState.done
+        except Exception as e:
+            table_status.state, table_status.error = JobState.failed, str(e)
+        self.save()
+
+    async def _recreate(self, db: AsyncDatabase) -> None:
+        # NOTE: drop and create tables instead of the database, sessions of the database in every worker stay valid
+        schema = read_schema()
+        for table in self.status.tables:
+            table.state = JobState.running
+        self.save()
+        await db.run(lambda: db.database.update_ddl(drop_statements(schema)).result(SCHEMA_UPDATE_TIMEOUT))
+        await db.run(lambda: db.database.update_ddl(schema).result(SCHEMA_UPDATE_TIMEOUT))
+        for table in self.status.tables:
+            table.state = JobState.done
+
+
+def load_job(job_id: str) -> Optional[ResetJobResponse]:
+    try:
+        path = ResetJob.path(job_id)
+    except ValueError:
+        return None
+    if not exists(path):
+        return None
+    with open(path) as f:
+        job = ResetJobResponse(**json.load(f))
+    if job.stale:
+        job.state, job.error = JobState.failed, "the worker of this reset stopped"
+    return job
+
+
+def running_job() -> Optional[ResetJobResponse]:
+    if not exists(RESET_JOB_DIR):
+        return None
+    for job_file in Path(RESET_JOB_DIR).glob("*.json"):
+        job = load_job(job_file.stem)
+        if job and job.state in (JobState.pending, JobState.running):
+            return job
+    return None
+
+
+@router.post("/", tags=["reset"], response_model=ResetJobResponse, status_code=status.HTTP_202_ACCEPTED, responses={status.HTTP_409_CONFLICT: {"description": "Another reset is running", "content": {"application/json": {"example": {"detail": "Reset 111111111 is running"}}}}})
+async def reset_database(mode: ResetMode = Query(ResetMode.delete, description="delete rows by partitioned DML, or drop and create tables from schemas/tables.sql"),
+                         db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
+    """
+    Start to delete all rows of all tables in background, the progress is returned by GET /reset/{job_id}
+
+    Jobs are tracked by files of the instance, so send the reset and its status requests to a single instance.
+    """
+    job = ResetJob(mode)
+    if not job.lock():
+        current = running_job()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Reset {current.job_id} is running" if current else "Another reset is running")
+    try:
+        job.save()
+    except Exception:
+        job.unlock()
+        raise
+    task = create_task(job.run(db))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=jsonable_encoder(job.status))
+
+
+@router.get("/{job_id}", tags=["reset"], response_model=ResetJobResponse, responses={status.HTTP_404_NOT_FOUND: {"description": "Reset does not found", "content": {"application/json": {"example": {"detail": "This reset did not found"}}}}})
+async def get_reset(job_id: str) -> JSONResponse:
+    """Get the status and deleted rows per table of a reset"""
+    job = load_job(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This reset did not found")
+    return JSONResponse(content=jsonable_encoder(job))
@@ -0,0 +1,31 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing import cpu_count
+from os import getenv
+
+# NOTE: gunicorn settings are resolved here, so modules of routers size themselves by the same workers as settings.py
+ENV: str = getenv("ENV", "local")
+# NOTE: "dev" (a worker which reloads on changes), "stress" (fixed workers for load tests) or "prod" (workers are recycled)
+RUNTIME_PROFILE: str = getenv("RUNTIME_PROFILE") or ("prod" if ENV == "production" else "dev")
+# NOTE: gunicorn settings per profile, an uvicorn worker serves concurrent requests by its event loop,
+# so a worker per core is enough, instead of 2 * cores + 1 of sync workers
+RUNTIME_PROFILES = {
+    "dev": {"workers": 1, "reload": True, "preload_app": False},
+    "stress": {"workers": cpu_count(), "reload": False, "preload_app": True, "keepalive": 75, "backlog": 2048},
+    # NOTE: jitter keeps workers from restarting at the same time
+    "prod": {"workers": cpu_count(), "reload": False, "preload_app": True, "keepalive": 75, "backlog": 2048,
+             "max_requests": 100000, "max_requests_jitter": 10000, "graceful_timeout": 30},
+}
+WORKERS: int = int(getenv("GUNICORN_WORKERS") or RUNTIME_PROFILES[RUNTIME_PROFILE]["workers"])
@@ -0,0 +1,61 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
+                    Sequence, Tuple)
+
+import orjson
+from fastapi.responses import Response
+
+
+class RowEncoder:
+    """
+    Encode Spanner result rows to JSON without pydantic models
+
+    Columns of a row are mapped to keys in order, INT64 ids are written as strings as response models declare,
+    and timestamps are written by isoformat because orjson does not serialize DatetimeWithNanoseconds.
+    Extra columns at the end of a row are ignored.
+    """
+
+    def __init__(self, keys: Sequence[str], int64_as_str: Sequence[str] = (), timestamps: Sequence[str] = ()) -> None:
+        self.keys = tuple(keys)
+        # NOTE: only columns which need a conversion are visited per row
+        self._converted: List[Tuple[int, str, Callable[[Any], Any]]] = [(i, key, str if key in int64_as_str else _isoformat)
+                                                                        for i, key in enumerate(self.keys) if key in int64_as_str or key in timestamps]
+
+    def to_dict(self, row: Sequence[Any]) -> Dict[str, Any]:
+        result = dict(zip(self.keys, row))
+        for i, key, converter in self._converted:
+            if row[i] is not None:
+                result[key] = converter(row[i])
+        return result
+
+    def encode(self, rows: Iterable[Sequence[Any]]) -> bytes:
+        return orjson.dumps([self.to_dict(row) for row in rows])
+
+    def encode_row(self, row: Sequence[Any]) -> bytes:
+        return orjson.dumps(self.to_dict(row))
+
+
+def _isoformat(value: Any) -> str:
+    return value.isoformat()
+
+
+class RowsResponse(Response):
+    """JSON response of Spanner rows, routes keep response_model for OpenAPI docs"""
+
+    media_type = "application/json"
+
+    def __init__(self, rows: Iterable[Sequence[Any]], encoder: RowEncoder, status_code: int = 200, headers: Optional[Mapping[str, str]] = None) -> None:
+        super().__init__(content=encoder.encode(rows), status_code=status_code, headers=headers)
@@ -0,0 +1,164 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from queue import Empty
+from threading import Event, Thread
+from time import monotonic
+from typing import Any, List, Optional, Set
+
+from google.cloud.spanner import BurstyPool, FixedSizePool, PingingPool
+from google.cloud.spanner_v1.pool import AbstractSessionPool
+from google.cloud.spanner_v1.session import Session
+from google.cloud.spanner_v1.snapshot import Snapshot
+from loguru import logger
+from prometheus_client import Counter, Gauge, Histogram
+
+from .database import EXECUTOR_WORKERS
+from .runtime import WORKERS
+
+# NOTE: "pinging" (ping idle sessions by a background thread), "bursty" (create sessions on demand) or "fixed"
+SPANNER_POOL: str = getenv("SPANNER_POOL", "pinging")
+# NOTE: sessions per worker, it is sized from workers and nodes when it is empty
+SPANNER_POOL_SIZE: str = getenv("SPANNER_POOL_SIZE", "")
+# NOTE: seconds to wait for a free session before a request fails
+SPANNER_POOL_TIMEOUT: float = float(getenv("SPANNER_POOL_TIMEOUT", "5"))
+# NOTE: seconds after which an idle session is pinged, sessions are deleted by Spanner after 1 hour of idle
+SPANNER_PING_INTERVAL: int = int(getenv("SPANNER_PING_INTERVAL", "300"))
+SPANNER_NODES: int = int(getenv("SPANNER_NODES", "1"))
+# NOTE: the number of api servers such as Cloud Run instances, which share the sessions of the database
+SPANNER_CLIENTS: int = int(getenv("SPANNER_CLIENTS", "1"))
+# NOTE: sessions which run a query before a worker serves requests, the whole pool when it is empty and none by 0
+SPANNER_WARMUP_SESSIONS: int = int(getenv("SPANNER_WARMUP_SESSIONS") or "-1")
+# NOTE: Spanner allows 10,000 sessions per node
+SESSIONS_PER_NODE: int = 10000
+# NOTE: sessions for background threads such as master cache reloads, group commits and streaming responses
+SESSION_HEADROOM: int = 8
+
+session_pool_wait = Histogram("spanner_session_pool_wait_seconds", "Seconds to check out a session from the pool",
+                              buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+session_pool_exhausted = Counter("spanner_session_pool_exhausted", "Checkouts which timed out because every session was in use")
+session_pool_in_use = Gauge("spanner_session_pool_in_use", "Sessions checked out of the pool", multiprocess_mode="livesum")
+
+
+def pool_size(workers: int = WORKERS, nodes: int = SPANNER_NODES, clients: int = SPANNER_CLIENTS) -> int:
+    """
+    Size a pool per worker
+
+    A worker can not use more sessions than threads which call Spanner at the same time, and all workers of all
+    clients must fit in the session limit of the instance.
+    """
+    if SPANNER_POOL_SIZE:
+        return int(SPANNER_POOL_SIZE)
+    return max(1, min(EXECUTOR_WORKERS + SESSION_HEADROOM, nodes * SESSIONS_PER_NODE // (workers * clients)))
+
+
+class InstrumentedPool:
+    """Mixin to record how long requests wait for a session, and how often the pool is exhausted"""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        # NOTE: bind and ping also put sessions which were not checked out
+        self._checked_out: Set[int] = set()
+        super().__init__(*args, **kwargs)  # type: ignore
+
+    def get(self, *args: Any, **kwargs: Any) -> Session:
+        started_at = monotonic()
+        try:
+            session = super().get(*args, **kwargs)  # type: ignore
+        except Empty:
+            session_pool_exhausted.inc()
+            raise
+        session_pool_wait.observe(monotonic() - started_at)
+        self._checked_out.add(id(session))
+        session_pool_in_use.inc()
+        return session
+
+    def put(self, session: Session) -> None:
+        if id(session) in self._checked_out:
+            self._checked_out.discard(id(session))
+            session_pool_in_use.dec()
+        super().put(session)  # type: ignore
+
+
+class InstrumentedPingingPool(InstrumentedPool, PingingPool):
+    pass
+
+
+class InstrumentedBurstyPool(InstrumentedPool, BurstyPool):
+    pass
+
+
+class InstrumentedFixedSizePool(InstrumentedPool, FixedSizePool):
+    pass
+
+
+def create_pool(strategy: str = SPANNER_POOL, size: Optional[int] = None) -> AbstractSessionPool:
+    size = size or pool_size()
+    if strategy == "bursty":
+        return InstrumentedBurstyPool(target_size=size)
+    if strategy == "fixed":
+        return InstrumentedFixedSizePool(size=size, default_timeout=SPANNER_POOL_TIMEOUT)
+    return InstrumentedPingingPool(size=size, default_timeout=SPANNER_POOL_TIMEOUT, ping_interval=SPANNER_PING_INTERVAL)
+
+
+def warm_up(pool: AbstractSessionPool, sessions: int = SPANNER_WARMUP_SESSIONS) -> int:
+    """
+    Check out sessions at once and run a query by each of them, then return them to the pool
+
+    Sessions of a bursty pool are created, and the gRPC channel of the worker is connected,
+    so the first requests of a worker do not wait for them.
+    """
+    size = getattr(pool, "size", None) or getattr(pool, "target_size", 0)
+    sessions = size if sessions < 0 else min(sessions, size)
+    if sessions <= 0:
+        return 0
+    checked_out: List[Session] = []
+    try:
+        for _ in range(sessions):
+            checked_out.append(pool.get())
+        with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="session-warm-up") as executor:
+            list(executor.map(lambda session: list(Snapshot(session).execute_sql("SELECT 1")), checked_out))
+    finally:
+        for session in checked_out:
+            pool.put(session)
+    return len(checked_out)
+
+
+class SessionPinger:
+    """Ping idle sessions of a PingingPool in a background thread instead of in every request"""
+
+    def __init__(self, pool: AbstractSessionPool, interval: float = SPANNER_PING_INTERVAL / 10) -> None:
+        self.pool = pool
+        self.interval = interval
+        self._stopped = Event()
+
+    def start(self) -> None:
+        # NOTE: other pools have no ping
+        if not isinstance(self.pool, PingingPool):
+            return
+
+        def _ping_forever() -> None:
+            while not self._stopped.wait(self.interval):
+                try:
+                    # NOTE: ping only sends requests for sessions which are idle longer than ping_interval
+                    self.pool.ping()
+                except Exception:
+                    logger.exception("failed to ping sessions")
+
+        self._stopped.clear()
+        Thread(target=_ping_forever, name="session-pinger", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
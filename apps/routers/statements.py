@@ -0,0 +1,225 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from google.api_core.exceptions import from_grpc_status
+from google.cloud import spanner
+from google.cloud.spanner_v1.keyset import KeySet
+from opentelemetry import trace
+from opentelemetry.trace import Span, SpanKind, Status, StatusCode
+from prometheus_client import Counter, Histogram
+
+from .database import AsyncDatabase
+from .utils import create_req_tag
+
+INT64, STRING, BOOL, TIMESTAMP = spanner.param_types.INT64, spanner.param_types.STRING, spanner.param_types.BOOL, spanner.param_types.TIMESTAMP
+
+statement_executions = Counter("spanner_statement_executions", "Executions of a statement", ["statement"])
+statement_latency = Histogram("spanner_statement_latency_seconds", "Seconds to execute a statement and read all rows", ["statement"])
+statement_rows = Histogram("spanner_statement_rows", "Rows which a query returned or a DML statement modified", ["statement"],
+                           buckets=(0, 1, 2, 5, 10, 20, 50, 100, 300, 1000, 5000))
+
+# NOTE: a proxy until settings.setup_trace sets a tracer provider, spans are not recorded without it
+tracer = trace.get_tracer(__name__)
+
+
+@contextmanager
+def client_span(name: str, attributes: Dict[str, Any]) -> Iterator[Span]:
+    """
+    A span of a Spanner call, which is a child of the current span but is not set as the current span
+
+    Streams are read by threads of Starlette one row at a time, so the span must not be attached to the context of a thread.
+    """
+    span = tracer.start_span(name, kind=SpanKind.CLIENT, attributes=attributes)
+    try:
+        yield span
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        span.end()
+
+
+class Statement:
+    """
+    A statement which is declared once with its parameter types and request tag
+
+    Handlers only pass values of parameters, so SQL, types and request options are not built per request.
+    """
+
+    __slots__ = ("name", "sql", "param_types", "request_options", "span_attributes", "_executions", "_latency", "_rows")
+
+    def __init__(self, name: str, sql: str, param_types: Optional[Dict[str, Any]] = None, action: str = "select", service: str = "", target: str = "") -> None:
+        self.name = name
+        self.sql = sql
+        self.param_types = param_types or {}
+        self.request_options = {"request_tag": create_req_tag(action, service or name, target)}
+        self.span_attributes = {"db.system": "spanner", "db.operation": action, "db.statement": sql, "spanner.request_tag": self.request_options["request_tag"]}
+        self._executions = statement_executions.labels(name)
+        self._latency = statement_latency.labels(name)
+        self._rows = statement_rows.labels(name)
+
+    def execute_sql(self, reader: Any, params: Optional[Dict[str, Any]] = None) -> List[Tuple]:
+        """Run the query by a snapshot or a transaction, and read all rows"""
+        return list(self.stream(reader, params))
+
+    def stream(self, reader: Any, params: Optional[Dict[str, Any]] = None) -> Iterator[Tuple]:
+        """Run the query by a snapshot or a transaction, and yield rows as they arrive"""
+        self._executions.inc()
+        started_at, rows = perf_counter(), 0
+        try:
+            with client_span(self.name, self.span_attributes) as span:
+                for row in reader.execute_sql(self.sql, params=params, param_types=self.param_types, request_options=self.request_options):
+                    rows += 1
+                    yield row
+                span.set_attribute("db.rows", rows)
+        finally:
+            self._latency.observe(perf_counter() - started_at)
+            self._rows.observe(rows)
+
+    def execute_update(self, transaction: Any, params: Dict[str, Any]) -> int:
+        self._executions.inc()
+        with self._latency.time(), client_span(self.name, self.span_attributes) as span:
+            row_count = transaction.execute_update(self.sql, params=params, param_types=self.param_types, request_options=self.request_options)
+            span.set_attribute("db.rows", row_count)
+        self._rows.observe(row_count)
+        return row_count
+
+    async def read(self, db: AsyncDatabase, params: Optional[Dict[str, Any]] = None, **snapshot_options: Any) -> List[Tuple]:
+        """Run the query in a single-use snapshot, snapshot_options such as exact_staleness are passed to Database.snapshot"""
+        def _read() -> List[Tuple]:
+            with db.database.snapshot(**snapshot_options) as snapshot:
+                return self.execute_sql(snapshot, params)
+        return await db.run(_read)
+
+
+class StatementBatch:
+    """DML statements which are sent by one batch_update request"""
+
+    __slots__ = ("name", "statements", "request_options", "span_attributes", "_executions", "_latency")
+
+    def __init__(self, name: str, statements: Sequence[Statement], action: str = "batch_update", service: str = "", target: str = "") -> None:
+        self.name = name
+        self.statements = statements
+        self.request_options = {"request_tag": create_req_tag(action, service or name, target)}
+        self.span_attributes = {"db.system": "spanner", "db.operation": action, "spanner.request_tag": self.request_options["request_tag"]}
+        self._executions = statement_executions.labels(name)
+        self._latency = statement_latency.labels(name)
+
+    def execute(self, transaction: Any, params: Sequence[Dict[str, Any]]) -> List[int]:
+        self._executions.inc()
+        for statement in self.statements:
+            statement._executions.inc()
+        with self._latency.time(), client_span(self.name, self.span_attributes):
+            status, row_counts = transaction.batch_update([(statement.sql, values, statement.param_types) for statement, values in zip(self.statements, params)],
+                                                          request_options=self.request_options)
+            for statement, row_count in zip(self.statements, row_counts):
+                statement._rows.observe(row_count)
+            # NOTE: batch_update does not raise, it stops at the failed statement and returns its status
+            if status.code != 0:
+                raise from_grpc_status(status.code, f"{self.statements[len(row_counts)].name}: {status.message}")
+        return row_counts
+
+
+class KeyRead:
+    """
+    A read of rows by primary keys, which is declared once with its columns and request tag
+
+    A read by keys goes to the splits of the keys directly, without planning a query.
+    """
+
+    __slots__ = ("name", "table", "columns", "request_options", "span_attributes", "_executions", "_latency", "_rows")
+
+    def __init__(self, name: str, table: str, columns: Sequence[str], service: str = "", target: str = "") -> None:
+        self.name = name
+        self.table = table
+        self.columns = tuple(columns)
+        self.request_options = {"request_tag": create_req_tag("read", service or name, target)}
+        self.span_attributes = {"db.system": "spanner", "db.operation": "read", "db.sql.table": table, "spanner.request_tag": self.request_options["request_tag"]}
+        self._executions = statement_executions.labels(name)
+        self._latency = statement_latency.labels(name)
+        self._rows = statement_rows.labels(name)
+
+    def execute_read(self, reader: Any, keys: Sequence[Sequence[Any]]) -> List[Tuple]:
+        """Read rows of keys by a snapshot or a transaction"""
+        self._executions.inc()
+        with self._latency.time(), client_span(self.name, self.span_attributes) as span:
+            rows = [tuple(row) for row in reader.read(self.table, self.columns, KeySet(keys=keys), request_options=self.request_options)]
+            span.set_attribute("db.rows", len(rows))
+        self._rows.observe(len(rows))
+        return rows
+
+    async def read(self, db: AsyncDatabase, keys: Sequence[Sequence[Any]], **snapshot_options: Any) -> List[Tuple]:
+        """Read rows of keys in a single-use snapshot, snapshot_options such as exact_staleness are passed to Database.snapshot"""
+        def _read() -> List[Tuple]:
+            with db.database.snapshot(**snapshot_options) as snapshot:
+                return self.execute_read(snapshot, keys)
+        return await db.run(_read)
+
+
+# NOTE: Users
+select_random_users = Statement("select_random_users", "SELECT UserId, Name, Mail From Users TABLESAMPLE RESERVOIR (1000 ROWS)", service="read_random_users", target="users")
+select_user = Statement("select_user", "SELECT UserId, Name, Mail From Users WHERE UserId=@UserId", {"UserId": INT64}, service="read_user", target="users")
+insert_user = Statement("insert_user", "INSERT Users (UserId, Name, Mail, Password, CreatedAt, UpdatedAt) VALUES (@UserId, @Name, @Mail, @Password, PENDING_COMMIT_TIMESTAMP(), PENDING_COMMIT_TIMESTAMP())",
+                        {"UserId": INT64, "Name": STRING, "Mail": STRING, "Password": STRING}, action="insert", service="create_user", target="users")
+
+# NOTE: Characters
+select_random_characters = Statement("select_random_characters", """SELECT Id, Users.Name, CharacterMasters.Name, Kind, Characters.Name, Level, Experience, Strength FROM Characters TABLESAMPLE RESERVOIR (300 ROWS)
+              INNER JOIN Users ON Characters.UserId=Users.UserId
+              INNER JOIN CharacterMasters ON Characters.CharacterId=CharacterMasters.CharacterId""", service="read_random_characters", target="characters")
+select_user_characters = Statement("select_user_characters", """SELECT Id, Users.Name, CharacterMasters.Name, Kind, Characters.Name, Level, Experience, Strength FROM Characters
+              INNER JOIN Users ON Characters.UserId=Users.UserId
+              INNER JOIN CharacterMasters ON Characters.CharacterId=CharacterMasters.CharacterId WHERE Characters.UserId=@UserId""",
+                                   {"UserId": INT64}, service="read_character", target="characters")
+count_user_characters = Statement("count_user_characters", "SELECT COUNT(*) FROM Characters WHERE UserId=@UserId", {"UserId": INT64}, service="read_characters_per_user", target="characters")
+insert_character = Statement("insert_character", """INSERT Characters (Id, UserId, CharacterId, Name, Level, Experience, Strength, CreatedAt, UpdatedAt)
+              VALUES (@Id, @UserId, @CharacterId, @Name, @Level, @Experience, @Strength, PENDING_COMMIT_TIMESTAMP(), PENDING_COMMIT_TIMESTAMP())""",
+                             {"Id": INT64, "UserId": INT64, "CharacterId": INT64, "Name": STRING, "Level": INT64, "Experience": INT64, "Strength": INT64},
+                             action="insert", service="create_character", target="characters")
+
+# NOTE: Battles
+select_battle_character = Statement("select_battle_character", "SELECT Id, UserId, Level, Experience, Strength FROM Characters WHERE Id=@Id", {"Id": INT64}, service="run_battle", target="characters")
+# NOTE: a direct lookup by the primary key of the interleaved table, when the owner of the character is known
+read_battle_character = KeyRead("read_battle_character", "Characters", ("Id", "UserId", "Level", "Experience", "Strength"), service="run_battle", target="characters")
+update_battle_character = Statement("update_battle_character", "UPDATE Characters SET Level=@Level, Experience=@Experience, Strength=@Strength, UpdatedAt=PENDING_COMMIT_TIMESTAMP() WHERE Id=@Id AND UserId=@UserId",
+                                    {"Level": INT64, "Experience": INT64, "Strength": INT64, "Id": INT64, "UserId": INT64}, action="update", service="run_battle", target="characters")
+insert_battle_history = Statement("insert_battle_history", """INSERT BattleHistory (BattleHistoryId, UserId, Id, OpponentId, Result, EntryShardId, CreatedAt, UpdatedAt)
+              VALUES (@BattleHistoryId, @UserId, @Id, @OpponentId, @Result, @EntryShardId, PENDING_COMMIT_TIMESTAMP(), PENDING_COMMIT_TIMESTAMP())""",
+                                  {"BattleHistoryId": INT64, "UserId": INT64, "Id": INT64, "OpponentId": INT64, "Result": BOOL, "EntryShardId": INT64},
+                                  action="insert", service="run_battle", target="battlehistories")
+battle_batch = StatementBatch("run_battle_batch", (update_battle_character, insert_battle_history), service="run_battle", target="characters")
+
+
+def _battle_history(cursor: bool, limit: bool) -> Statement:
+    # NOTE: force to use index in select, and rows are ordered by (UpdatedAt, BattleHistoryId) for keyset pagination
+    sql = """SELECT UserId, Id, OpponentId, Result, CreatedAt, UpdatedAt, BattleHistoryId FROM BattleHistory@{FORCE_INDEX=BattleHistoryByUserId}
+              WHERE EntryShardId BETWEEN @ShardFrom AND @ShardTo AND UserId=@UserId AND UpdatedAt BETWEEN @Since AND @Until"""
+    param_types = {"ShardFrom": INT64, "ShardTo": INT64, "UserId": INT64, "Since": TIMESTAMP, "Until": TIMESTAMP}
+    if cursor:
+        sql += " AND (UpdatedAt < @CursorUpdatedAt OR (UpdatedAt = @CursorUpdatedAt AND BattleHistoryId < @CursorId))"
+        param_types.update({"CursorUpdatedAt": TIMESTAMP, "CursorId": INT64})
+    sql += " ORDER BY UpdatedAt DESC, BattleHistoryId DESC"
+    if limit:
+        sql += " LIMIT @Limit"
+        param_types["Limit"] = INT64
+    name = "select_battle_histories" + ("_after_cursor" if cursor else "") + ("_with_limit" if limit else "")
+    return Statement(name, sql, param_types, service="battlehistories", target="battlehistory")
+
+
+# NOTE: (has a cursor, has a limit) to a statement
+select_battle_histories: Dict[Tuple[bool, bool], Statement] = {(cursor, limit): _battle_history(cursor, limit) for cursor in (False, True) for limit in (False, True)}
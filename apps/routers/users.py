@@ -16,12 +16,17 @@ from typing import List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from google.cloud import spanner
-from google.cloud.spanner_v1.database import Database
 from pydantic import BaseModel, EmailStr, Field, SecretStr
 
-from .utils import create_req_tag, get_db, get_password_hash, get_uuid
+from .database import AsyncDatabase
+from .group_commit import GROUP_COMMIT, group_commit_writer
+from .hashing import PasswordHashQueueFull, password_hasher
+from .history_cache import history_cache
+from .serialization import RowEncoder, RowsResponse
+from .statements import insert_user, select_random_users, select_user
+from .utils import get_async_db, get_uuid
 
 TABLE: str = "Users"
 
@@ -40,23 +45,20 @@ class UserResponse(BaseModel):
     mail: EmailStr = Field(..., example="hoge@example.com")
 
 
+user_encoder = RowEncoder(tuple(UserResponse.__fields__), int64_as_str=("user_id",))
+
+
 @router.get("/", tags=["users"], response_model=List[UserResponse])
-def get_random_users(db: Database = Depends(get_db)) -> JSONResponse:
+async def get_random_users(db: AsyncDatabase = Depends(get_async_db)) -> Response:
     """Get 1,000 random users for tests initial requests"""
-    with db.snapshot() as snapshot:
-        query = f"SELECT UserId, Name, Mail From {TABLE} TABLESAMPLE RESERVOIR (1000 ROWS)"
-        results = list(snapshot.execute_sql(query))
-    return JSONResponse(content=jsonable_encoder([UserResponse(**dict(zip(UserResponse.__fields__.keys(), result))).dict() for result in results]))
+    results = await select_random_users.read(db)
+    return RowsResponse(results, user_encoder)
 
 
 @router.get("/{user_id}", tags=["users"], response_model=UserResponse, responses={status.HTTP_404_NOT_FOUND: {"description": "User does not found", "content": {"application/json": {"example": {"detail": "This user does not found"}}}}})
-def get_user(user_id: str, db: Database = Depends(get_db)) -> JSONResponse:
+async def get_user(user_id: str, db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
     """Get a user"""
-    with db.snapshot() as snapshot:
-        query = f"SELECT UserId, Name, Mail From {TABLE} WHERE UserId=@UserId"
-        params, params_type = {"UserId": user_id}, {"UserId": spanner.param_types.INT64}
-        request_options = {"request_tag": create_req_tag("select", "read_user", "users")}
-        results = list(snapshot.execute_sql(query, params=params, param_types=params_type, request_options=request_options))
+    results = await select_user.read(db, {"UserId": user_id})
 
     if not results:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="This character did not found")
@@ -64,26 +66,32 @@ def get_user(user_id: str, db: Database = Depends(get_db)) -> JSONResponse:
     return JSONResponse(content=jsonable_encoder(UserResponse(user_id=results[0][0], name=results[0][1], mail=results[0][2])))
 
 
-@router.post("/", tags=["users"], response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def create_user(user: User, db: Database = Depends(get_db)) -> JSONResponse:
+@router.post("/", tags=["users"], response_model=UserResponse, status_code=status.HTTP_201_CREATED, responses={status.HTTP_503_SERVICE_UNAVAILABLE: {"description": "Queue of password hashing is full", "content": {"application/json": {"example": {"detail": "Too many users are being created"}}}}})
+async def create_user(user: User, db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
     """Create a user"""
     def create_user_repository(transaction):
-        query = f"INSERT {TABLE} ( UserId, Name, Mail, Password, CreatedAt, UpdatedAt ) VALUES ( @UserId, @Name, @Mail, @Password, PENDING_COMMIT_TIMESTAMP(), PENDING_COMMIT_TIMESTAMP() )"
-        params = {"UserId": user_id, "Name": user.name, "Mail": user.mail, "Password": hashed_password}
-        params_type = {"UserId": spanner.param_types.INT64, "Name": spanner.param_types.STRING, "Password": spanner.param_types.STRING}
-        request_options = {"request_tag": create_req_tag("insert", "create_user", "users")}
-        transaction.execute_update(query, params=params, param_types=params_type, request_options=request_options)
+        insert_user.execute_update(transaction, {"UserId": user_id, "Name": user.name, "Mail": user.mail, "Password": hashed_password})
 
     user_id = get_uuid()
-    hashed_password = get_password_hash(user.password.get_secret_value())
-
-    db.run_in_transaction(create_user_repository)
+    try:
+        # NOTE: bcrypt is CPU bound, so it must not run on the event loop
+        hashed_password = await password_hasher.hash(user.password.get_secret_value())
+    except PasswordHashQueueFull:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many users are being created")
+
+    if GROUP_COMMIT:
+        columns = ("UserId", "Name", "Mail", "Password", "CreatedAt", "UpdatedAt")
+        await group_commit_writer.insert(TABLE, columns, (user_id, user.name, user.mail, hashed_password, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP))
+    else:
+        await db.run_in_transaction(create_user_repository)
 
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=jsonable_encoder(UserResponse(user_id=user_id, name=user.name, mail=user.mail)))
 
 
 @router.delete("/", tags=["users"], response_model=Optional[dict])
-def delete_all_users(db: Database = Depends(get_db)) -> JSONResponse:
+async def delete_all_users(db: AsyncDatabase = Depends(get_async_db)) -> JSONResponse:
     """Delete all users"""
-    db.execute_partitioned_dml(f"DELETE FROM {TABLE} WHERE UserId > 0")
+    await db.execute_partitioned_dml(f"DELETE FROM {TABLE} WHERE UserId > 0")
+    # NOTE: battle histories are deleted with users by ON DELETE CASCADE
+    await history_cache.clear()
     return JSONResponse(content=jsonable_encoder({}))
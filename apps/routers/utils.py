@@ -12,69 +12,114 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from datetime import datetime
-from os import environ, getenv
-from time import time_ns
-from typing import Any, Dict, Tuple
-from uuid import uuid4
+from datetime import datetime, timezone
+from os import environ, getenv, getpid
+from threading import Lock
+from typing import Optional, cast
 
-from google.cloud.spanner import Client, PingingPool
+from google.cloud.spanner import Client
 from google.cloud.spanner_v1.database import Database
-from passlib.context import CryptContext
+from google.cloud.spanner_v1.pool import AbstractSessionPool
 
-context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-num_shards = 100
+from .database import AsyncDatabase
+from .keys import next_entry_shard_id, next_key
+from .session_pool import SPANNER_WARMUP_SESSIONS, SessionPinger, create_pool, warm_up
 
 # NOTE: Spanner Settings
 PROJECT: str = getenv("GOOGLE_CLOUD_PROJECT", "test-local")
 INSTANCE: str = getenv("INSTANCE_NAME", "spanner-demo")
 DATABASE: str = getenv("DATABASE_NAME", "sample-game")
 
-client = Client(project=PROJECT)
-instance = client.instance(INSTANCE)
-pool = PingingPool(size=100, default_timeout=5, ping_interval=300)
-database = instance.database(DATABASE, pool=pool)
-
 # NOTE: stale read settings
 character_master_delay: int = 3
 opponent_master_delay: int = 3
 battle_history_delay: int = 15
 
-# NOTE: set host path to spanner own emulator in local env
-if getenv("ENV", "local") == "local":
-    environ["SPANNER_EMULATOR_HOST"] = "localhost:9010"
+
+class SpannerProvider:
+    """
+    The client, the session pool and the database of this process
+
+    They are created on first use, or by the post_fork hook of gunicorn, and created again in a forked process,
+    because gRPC channels and sessions must not be shared by processes. Nothing connects to Spanner at import.
+    """
+
+    def __init__(self) -> None:
+        self.client: Optional[Client] = None
+        self.pool: Optional[AbstractSessionPool] = None
+        self.database: Optional[Database] = None
+        self.async_database: Optional[AsyncDatabase] = None
+        self.session_pinger: Optional[SessionPinger] = None
+        self._pid: Optional[int] = None
+        self._lock = Lock()
+
+    def connect(self) -> "SpannerProvider":
+        # NOTE: set host path to spanner own emulator in local env, the client reads it when it is created
+        if getenv("ENV", "local") == "local":
+            environ.setdefault("SPANNER_EMULATOR_HOST", "localhost:9010")
+        client = Client(project=PROJECT)
+        pool = create_pool()
+        # NOTE: sessions of the pool are created here
+        self.use(client.instance(INSTANCE).database(DATABASE, pool=pool), pool)
+        self.client = client
+        return self
+
+    def use(self, database: Database, pool: Optional[AbstractSessionPool] = None) -> "SpannerProvider":
+        """Use a database in this process, such as a fake of tests instead of connecting to Spanner"""
+        self.client = None
+        self.pool = pool
+        self.database = database
+        self.async_database = AsyncDatabase(database)
+        self.session_pinger = SessionPinger(pool)
+        self._pid = getpid()
+        return self
+
+    def get(self) -> "SpannerProvider":
+        if self._pid != getpid():
+            with self._lock:
+                if self._pid != getpid():
+                    self.connect()
+        return self
+
+    def warm_up(self, sessions: int = SPANNER_WARMUP_SESSIONS) -> int:
+        """Run a query by sessions of the pool, it is called before a worker starts to serve requests"""
+        provider = self.get()
+        return warm_up(provider.pool, sessions) if provider.pool is not None else 0
+
+
+spanner_provider = SpannerProvider()
+
+
+def connect() -> None:
+    """Connect to Spanner in this process, it is called by the post_fork hook of gunicorn"""
+    spanner_provider.connect()
 
 
 def get_db() -> Database:
-    pool.ping()
-    return database
+    # NOTE: idle sessions are pinged by session_pinger, not by requests
+    return cast(Database, spanner_provider.get().database)
+
+
+async def get_async_db() -> AsyncDatabase:
+    return cast(AsyncDatabase, spanner_provider.get().async_database)
 
 
-def get_password_hash(password):
-    return context.hash(password)
+def get_session_pinger() -> SessionPinger:
+    return cast(SessionPinger, spanner_provider.get().session_pinger)
 
 
 def get_uuid() -> int:
-    return uuid4().int & (1 << 63) - 1
+    # NOTE: keys are generated by KEY_STRATEGY of routers.keys
+    return next_key()
 
 
 def get_entry_shard_id(user_id: int) -> int:
-
-    now: int = time_ns() // 1000
-    return (user_id + now + get_uuid()) % num_shards
+    return next_entry_shard_id()
 
 
 def epoch_to_datetime(epoch: int) -> str:
-    # TODO: consider how to handle timestamp
-    return datetime.fromtimestamp(epoch).isoformat() + "Z"
-
-
-def build_insert_query(transaction: Any, table: str, columns: Tuple[str], values: Tuple[int, str], request_options: Dict[str, str]) -> None:
-    # TODO: change to build sql smarter then now
-    str_columns: str = str(columns).replace("'", "")
-    str_values: str = str(values).replace("'PENDING_COMMIT_TIMESTAMP()'", "PENDING_COMMIT_TIMESTAMP()")
-    query = f"INSERT {table} {str_columns} VALUES {str_values}"
-    transaction.execute_update(query, request_options=request_options)
+    # NOTE: UTC regardless of the local time zone, the same as the window of the battle history cache
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
 
 
 def create_req_tag(action: str, service: str, target: str) -> str:
@@ -74,4 +74,9 @@ CREATE TABLE BattleHistory (
 ),
 INTERLEAVE IN PARENT Users ON DELETE CASCADE;
 
-CREATE INDEX BattleHistoryByUserId ON BattleHistory(EntryShardId, UserId, UpdatedAt DESC);
\ No newline at end of file
+CREATE INDEX BattleHistoryByUserId ON BattleHistory(EntryShardId, UserId, UpdatedAt DESC);
+
+-- NOTE: master caches of workers read rows updated since their previous refresh by these indexes, masters are rarely written
+CREATE INDEX CharacterMastersByUpdatedAt ON CharacterMasters(UpdatedAt) STORING (Name, Kind);
+
+CREATE INDEX OpponentMastersByUpdatedAt ON OpponentMasters(UpdatedAt) STORING (Name, Kind, Strength, Experience);
\ No newline at end of file
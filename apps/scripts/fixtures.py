@@ -0,0 +1,191 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from argparse import ArgumentParser
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from multiprocessing import cpu_count, get_context
+from os.path import abspath, dirname, exists, join
+from random import choice, randint, random
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from faker import Faker
+
+from main import MUTATION_LIMIT, add_spanner_arguments, chunks, connect_database, get_uuid
+
+# NOTE: the same as routers.characters.CHARACTER_LIMIT of the api server
+CHARACTER_LIMIT: int = 300
+# NOTE: shards of EntryShardId of the api server, the image of scripts does not have schemas, so pass --shards there
+SHARD_CONFIG_PATH: str = join(dirname(dirname(abspath(__file__))), "schemas", "shards.json")
+NUM_SHARDS: int = 100
+# NOTE: bcrypt hash of "password" with 4 rounds, hashing per user would take longer than writing it
+PASSWORD: str = "$2b$04$puxH3s3naDCLO6FqfqZKrONfsr6bQJs9fmb63RwdJA1eoK/oLoXPK"
+
+USER_COLUMNS: Tuple[str, ...] = ("UserId", "Name", "Mail", "Password", "CreatedAt", "UpdatedAt")
+CHARACTER_COLUMNS: Tuple[str, ...] = ("Id", "UserId", "CharacterId", "Name", "Level", "Experience", "Strength", "CreatedAt", "UpdatedAt")
+BATTLE_HISTORY_COLUMNS: Tuple[str, ...] = ("BattleHistoryId", "UserId", "Id", "OpponentId", "Result", "EntryShardId", "CreatedAt", "UpdatedAt")
+# NOTE: an index counts a mutation per its columns and per primary key column of the table. A foreign key whose columns are not
+# a prefix of the primary key is backed by such an index, and so is a referenced key which is not the primary key
+INDEX_MUTATIONS: Dict[str, int] = {
+    # NOTE: FOREIGN KEY (CharacterId), and the unique index of Id which FOREIGN KEY (Id) of BattleHistory references
+    "Characters": (1 + 2) + (1 + 2),
+    # NOTE: BattleHistoryByUserId, FOREIGN KEY (Id) and FOREIGN KEY (OpponentId)
+    "BattleHistory": (3 + 4) + (1 + 4) + (1 + 4),
+}
+MUTATIONS_PER_ROW: Dict[str, int] = {"Users": len(USER_COLUMNS), "Characters": len(CHARACTER_COLUMNS) + INDEX_MUTATIONS["Characters"],
+                                     "BattleHistory": len(BATTLE_HISTORY_COLUMNS) + INDEX_MUTATIONS["BattleHistory"]}
+
+fake = Faker('jp-JP')
+
+# NOTE: set per process by init_worker
+database: Any = None
+masters: Tuple[List[int], List[int]] = ([], [])
+
+
+def read_masters(args: Any) -> Tuple[List[int], List[int]]:
+    db = connect_database(args)
+    with db.snapshot(multi_use=True) as snapshot:
+        # NOTE: google-cloud-spanner 3.14 needs an explicit begin to run more than one query in a snapshot
+        snapshot.begin()
+        character_ids = [row[0] for row in snapshot.execute_sql("SELECT CharacterId FROM CharacterMasters")]
+        opponent_ids = [row[0] for row in snapshot.execute_sql("SELECT OpponentId FROM OpponentMasters")]
+    return character_ids, opponent_ids
+
+
+def init_worker(args: Any, master_ids: Tuple[List[int], List[int]]) -> None:
+    global database, masters
+    database = connect_database(args)
+    masters = master_ids
+
+
+def read_num_shards(path: str = SHARD_CONFIG_PATH) -> int:
+    if not exists(path):
+        return NUM_SHARDS
+    with open(path) as f:
+        return int(json.load(f)["entry_shards"])
+
+
+def generate(users: int, characters_per_user: int, histories_per_character: int, days: int, shards: int) -> Dict[str, List[Tuple]]:
+    """Generate rows of users, their characters and battle histories, which are sorted by primary keys"""
+    from google.cloud import spanner
+
+    character_ids, opponent_ids = masters
+    now = datetime.now(timezone.utc)
+    rows: Dict[str, List[Tuple]] = {"Users": [], "Characters": [], "BattleHistory": []}
+    for _ in range(users):
+        user_id = get_uuid()
+        rows["Users"].append((user_id, fake.name()[:32], fake.email()[:64], PASSWORD, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP))
+        for _ in range(characters_per_user):
+            character_id = get_uuid()
+            rows["Characters"].append((character_id, user_id, choice(character_ids), fake.first_kana_name()[:16], randint(1, 100), randint(0, pow(10, 5)), randint(1, pow(10, 5)),
+                                       spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP))
+            for _ in range(histories_per_character):
+                # NOTE: spread histories over the past days, so since/until of history reads hit a realistic number of rows
+                updated_at = now - timedelta(seconds=random() * days * 86400)
+                rows["BattleHistory"].append((get_uuid(), user_id, character_id, choice(opponent_ids), random() < 0.5, randint(0, shards - 1), updated_at, updated_at))
+    # NOTE: rows of a batch are close in key order, so a commit touches as few splits as possible
+    rows["Users"].sort(key=lambda row: row[0])
+    rows["Characters"].sort(key=lambda row: (row[1], row[0]))
+    rows["BattleHistory"].sort(key=lambda row: (row[1], row[2], row[3], row[0]))
+    return rows
+
+
+def write(task: Tuple[int, int, int, int, int]) -> Tuple[Counter, List[Tuple[int, str]]]:
+    """Generate and write rows of a task, parents are committed before children because of interleaving and foreign keys"""
+    rows = generate(*task)
+    columns = {"Users": USER_COLUMNS, "Characters": CHARACTER_COLUMNS, "BattleHistory": BATTLE_HISTORY_COLUMNS}
+    for table in ("Users", "Characters", "BattleHistory"):
+        for batch_rows in chunks(rows[table], MUTATION_LIMIT // MUTATIONS_PER_ROW[table]):
+            with database.batch() as batch:
+                batch.insert(table=table, columns=columns[table], values=batch_rows)
+    return Counter({table: len(table_rows) for table, table_rows in rows.items()}), [(row[0], row[1]) for row in rows["Users"]]
+
+
+def export_users(path: str, users: Sequence[Tuple[int, str]]) -> None:
+    """Write SET commands of user ids in the Redis protocol, to load them by `redis-cli --pipe` as locust does by create_fake_user"""
+    with open(path, "wb") as f:
+        for user_id, name in users:
+            args = [b"SET", str(user_id).encode(), name.encode()]
+            f.write(b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args))
+
+
+def write_user_ids(path: str, users: Sequence[Tuple[int, str]]) -> None:
+    """Write user ids per line, which locust loads by USER_POOL_FILE"""
+    with open(path, "w") as f:
+        f.writelines(f"{user_id}\n" for user_id, _ in users)
+
+
+def push_users(host: str, port: int, users: Sequence[Tuple[int, str]]) -> None:
+    from redis import StrictRedis
+
+    redis = StrictRedis(host=host, port=port)
+    for batch_users in chunks(list(users), 10000):
+        pipeline = redis.pipeline(transaction=False)
+        for user_id, name in batch_users:
+            pipeline.set(str(user_id), name)
+        pipeline.execute()
+
+
+def create_fixtures(args: Any) -> None:
+    if args.characters > CHARACTER_LIMIT:
+        raise ValueError(f"characters per user must be at most {CHARACTER_LIMIT}")
+    master_ids = read_masters(args)
+    if not all(master_ids):
+        raise ValueError("no character or opponent masters, create them by main.py first")
+
+    tasks = [(min(args.chunk, args.users - i), args.characters, args.histories, args.days, args.shards) for i in range(0, args.users, args.chunk)]
+    written: Counter = Counter()
+    users: List[Tuple[int, str]] = []
+    started_at = perf_counter()
+    # NOTE: spawn processes, a gRPC channel of the parent must not be shared by forked children
+    with get_context("spawn").Pool(processes=args.processes, initializer=init_worker, initargs=(args, master_ids)) as pool:
+        for counts, task_users in pool.imap_unordered(write, tasks):
+            written.update(counts)
+            users.extend(task_users)
+            elapsed = perf_counter() - started_at
+            print(", ".join(f"{table}: {count} rows" for table, count in written.items()) + f", {sum(written.values()) / elapsed:.0f} rows/sec")
+
+    print(f"==== finish to create {sum(written.values())} rows in {perf_counter() - started_at:.2f}s ===")
+    if args.export:
+        export_users(args.export, users)
+        print(f"exported {len(users)} user ids to {args.export}")
+    if args.user_ids:
+        write_user_ids(args.user_ids, users)
+        print(f"wrote {len(users)} user ids to {args.user_ids}")
+    if args.redis_host:
+        push_users(args.redis_host, args.redis_port, users)
+        print(f"pushed {len(users)} user ids to redis {args.redis_host}:{args.redis_port}")
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> Any:
+    parser = ArgumentParser(description="generate users, characters and battle histories directly in Spanner for stress test")
+    parser.add_argument('-u', '--users', default=10000, type=int, help='number of users')
+    parser.add_argument('-c', '--characters', default=3, type=int, help=f'characters per user, at most {CHARACTER_LIMIT}')
+    parser.add_argument('-b', '--histories', default=10, type=int, help='battle histories per character')
+    parser.add_argument('-d', '--days', default=30, type=int, help='days in the past which battle histories are spread over')
+    parser.add_argument('-s', '--shards', default=read_num_shards(), type=int, help='shards of EntryShardId, entry_shards of schemas/shards.json of the api server')
+    parser.add_argument('-P', '--processes', default=cpu_count(), type=int, help='worker processes which generate and write rows')
+    parser.add_argument('--chunk', default=100, type=int, help='users per task of a worker process')
+    parser.add_argument('-o', '--export', default="", type=str, help='file to write SET commands of user ids for `redis-cli --pipe`')
+    parser.add_argument('--user-ids', default="", type=str, help='file to write user ids per line for USER_POOL_FILE of locust')
+    parser.add_argument('--redis-host', default="", type=str, help='redis which locust reads user ids from')
+    parser.add_argument('--redis-port', default=6379, type=int, help='redis port')
+    add_spanner_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    create_fixtures(parse_args())
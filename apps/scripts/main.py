@@ -12,16 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os import environ, getenv
 from random import randint
-from typing import Dict
+from time import perf_counter
+from typing import Any, Dict, List, Sequence, Tuple
+from uuid import uuid4
 
-import requests
+import aiohttp
 from faker import Faker
 from pydantic import BaseModel
 
 fake = Faker('jp-JP')
 
+# NOTE: Spanner allows 20,000 mutations per commit, a mutation is counted per column of a row
+MUTATION_LIMIT: int = 20000
+CHARACTER_MASTER_COLUMNS: Tuple[str, ...] = ("CharacterId", "Name", "Kind", "CreatedAt", "UpdatedAt")
+OPPONENT_MASTER_COLUMNS: Tuple[str, ...] = ("OpponentId", "Name", "Kind", "Strength", "Experience", "CreatedAt", "UpdatedAt")
+
 
 class CharacterMaster(BaseModel):
     name: str
@@ -35,29 +45,105 @@ class OpponentMaster(BaseModel):
     experience: int
 
 
-def create_masters(args):
-    # TODO: run faster than now, for example to use asyncio
-    API_VERSION = args.version
+def get_uuid() -> int:
+    # NOTE: the same as "uuid" of routers.keys of the api server
+    return uuid4().int & (1 << 63) - 1
+
+
+def fake_character_master() -> CharacterMaster:
+    return CharacterMaster(name=fake.first_kana_name(), kind="fake")
+
+
+def fake_opponent_master() -> OpponentMaster:
+    return OpponentMaster(name=fake.first_kana_name(), kind="fake", strength=randint(1, pow(10, 5)), experience=randint(1, pow(10, 5)))
+
+
+async def post_masters(session: aiohttp.ClientSession, url: str, masters: Sequence[BaseModel], concurrency: int) -> int:
+    """Post masters by `concurrency` workers, which share connections of the session, and return the number of failures"""
+    queue: asyncio.Queue = asyncio.Queue()
+    for master in masters:
+        queue.put_nowait(master.json())
+    failures = 0
+
+    async def _worker() -> None:
+        nonlocal failures
+        while not queue.empty():
+            data = queue.get_nowait()
+            try:
+                async with session.post(url, data=data) as res:
+                    if res.status != 201:
+                        failures += 1
+                        print(res.status, await res.text())
+            except aiohttp.ClientError as e:
+                failures += 1
+                print(e)
+
+    await asyncio.gather(*[_worker() for _ in range(concurrency)])
+    return failures
+
+
+async def create_masters_by_api(args: Any) -> None:
     headers: Dict[str, str] = {"Content-Type": "application/json"}
     host = args.target + ":" + args.port
-    # NOTE: add character masters
-    print("==== start to creare character masters ===")
-    for _ in range(args.line):
-        try:
-            fake_character_master = CharacterMaster(name=fake.first_kana_name(), kind="fake")
-            res = requests.post(url=f"{host}/api/{API_VERSION}/character_master/", headers=headers, data=fake_character_master.json())
-            print(res.json())
-        except Exception as e:
-            print(e)
-    # NOTE: add opponent masters
-    print("==== start to creare opponent masters ===")
-    for _ in range(args.line):
-        try:
-            fake_opponent_master = OpponentMaster(name=fake.first_kana_name(), kind="fake", strength=randint(1, pow(10, 5)), experience=randint(1, pow(10, 5)))
-            res = requests.post(url=f"{host}/api/{API_VERSION}/opponent_master/", headers=headers, data=fake_opponent_master.json())
-            print(res.json())
-        except Exception as e:
-            print(e)
+    # NOTE: the connector keeps at most `concurrency` connections alive and reuses them between requests
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout) as session:
+        for name, path, create in (("character masters", "character_master", fake_character_master), ("opponent masters", "opponent_master", fake_opponent_master)):
+            print(f"==== start to create {name} ===")
+            started_at = perf_counter()
+            failures = await post_masters(session, f"{host}/api/{args.version}/{path}/", [create() for _ in range(args.line)], args.concurrency)
+            print(f"created {args.line - failures} {name} in {perf_counter() - started_at:.2f}s, {failures} failures")
+
+
+def chunks(rows: List[Tuple], size: int) -> List[List[Tuple]]:
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+def connect_database(args: Any) -> Any:
+    if args.emulator_host:
+        # NOTE: the client reads the emulator host when it is created
+        environ["SPANNER_EMULATOR_HOST"] = args.emulator_host
+    from google.cloud import spanner
+
+    return spanner.Client(project=args.project).instance(args.instance).database(args.database)
+
+
+def add_spanner_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument('--project', default=getenv("GOOGLE_CLOUD_PROJECT", "test-local"), type=str, help='Google Cloud project')
+    parser.add_argument('--instance', default=getenv("INSTANCE_NAME", "spanner-demo"), type=str, help='Spanner instance')
+    parser.add_argument('--database', default=getenv("DATABASE_NAME", "sample-game"), type=str, help='Spanner database')
+    parser.add_argument('--emulator-host', default=getenv("SPANNER_EMULATOR_HOST", ""), type=str, help='Spanner emulator host such as localhost:9010')
+
+
+def create_masters_by_spanner(args: Any) -> None:
+    """Write masters directly to Spanner by batches which are as large as the mutation limit allows"""
+    from google.cloud import spanner
+
+    database = connect_database(args)
+    character_masters = [(get_uuid(), master.name, master.kind, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP)
+                         for master in (fake_character_master() for _ in range(args.line))]
+    opponent_masters = [(get_uuid(), master.name, master.kind, master.strength, master.experience, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP)
+                        for master in (fake_opponent_master() for _ in range(args.line))]
+
+    def _insert(table: str, columns: Tuple[str, ...], rows: List[Tuple]) -> None:
+        with database.batch() as batch:
+            batch.insert(table=table, columns=columns, values=rows)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for table, columns, rows in (("CharacterMasters", CHARACTER_MASTER_COLUMNS, character_masters), ("OpponentMasters", OPPONENT_MASTER_COLUMNS, opponent_masters)):
+            print(f"==== start to create {table} ===")
+            started_at = perf_counter()
+            # NOTE: list() raises the first error of batches
+            list(executor.map(lambda batch: _insert(table, columns, batch), chunks(rows, MUTATION_LIMIT // len(columns))))
+            print(f"created {len(rows)} {table} in {perf_counter() - started_at:.2f}s")
+
+
+def create_masters(args: Any) -> None:
+    if args.mode == "spanner":
+        create_masters_by_spanner(args)
+    else:
+        asyncio.run(create_masters_by_api(args))
     print("==== finish to create masters ===")
 
 
@@ -67,4 +153,8 @@ if __name__ == "__main__":
     parser.add_argument('-p', '--port', default='8000', type=str, help='target port')
     parser.add_argument('-l', '--line', default=300, type=int, help='number of master data')
     parser.add_argument('-v', '--version', default="v1", type=str, help='target api version')
+    parser.add_argument('-m', '--mode', default="api", choices=("api", "spanner"), help='post masters to the api server, or write them directly to Spanner')
+    parser.add_argument('-c', '--concurrency', default=32, type=int, help='requests in flight in api mode, or commits in flight')
+    parser.add_argument('--timeout', default=30, type=float, help='seconds to wait for a response in api mode')
+    add_spanner_arguments(parser)
     create_masters(parser.parse_args())
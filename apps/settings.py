@@ -12,12 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import logging
-from json import dumps
-from multiprocessing import cpu_count
-from os import getenv
-from sys import stdout
+import traceback
+from os import getenv, getpid, register_at_fork
+from queue import Empty, SimpleQueue
+from random import random
+from sys import stderr, stdout
+from threading import Thread
+from time import monotonic
 
+import orjson
 import stackprinter
 from gunicorn.app.base import BaseApplication
 from gunicorn.glogging import Logger
@@ -29,22 +34,46 @@ from opentelemetry.propagate import set_global_textmap
 from opentelemetry.propagators.cloud_trace_propagator import \
     CloudTraceFormatPropagator
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export import (BatchSpanProcessor,
+                                            ConsoleSpanExporter, SpanExporter)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from prometheus_client import Counter
+from routers.metrics import clear_multiprocess_dir, mark_worker_dead
+from routers.runtime import ENV, RUNTIME_PROFILE, RUNTIME_PROFILES, WORKERS
+from routers.utils import connect
 
 # NOTE: settings from env values
-ENV = getenv("ENV", "local")
 PROJECT = getenv("GOOGLE_CLOUD_PROJECT", "local")
 LOG_LEVEL = logging.getLevelName(getenv("LOG_LEVEL", "DEBUG"))
-WORKERS = 2 * cpu_count() + 1
+# NOTE: "cloud_trace", "otlp" (OTEL_EXPORTER_OTLP_ENDPOINT), "file" (TRACE_FILE), "console" or "none"
+TRACE_EXPORTER = getenv("TRACE_EXPORTER") or ("cloud_trace" if ENV == "production" else "none")
+# NOTE: ratio of traces which are sampled at the root, spans of a request follow the sampling decision of its parent
+TRACE_SAMPLE_RATIO = float(getenv("TRACE_SAMPLE_RATIO") or "1")
+# NOTE: spans are written in JSON lines per worker, to {TRACE_FILE}.{pid}
+TRACE_FILE = getenv("TRACE_FILE") or "traces.jsonl"
+# NOTE: records are put on a queue and serialized by a thread per worker, instead of the thread which logs them
+LOG_ENQUEUE = (getenv("LOG_ENQUEUE") or "true").lower() == "true"
+# NOTE: max records waiting for the log writer thread per worker, records are dropped while it is full
+LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE") or "10000")
+# NOTE: ratio of access logs of successful requests which are written, access logs of errors are always written
+ACCESS_LOG_SAMPLE_RATIO = float(getenv("ACCESS_LOG_SAMPLE_RATIO") or "1")
+# NOTE: max access logs of successful requests per second per worker after sampling, 0 is unlimited
+ACCESS_LOG_MAX_PER_SECOND = int(getenv("ACCESS_LOG_MAX_PER_SECOND") or "0")
 
 
 class InterceptHandler(logging.Handler):
+    # NOTE: loguru levels by levelname of logging, logger.level takes a lock per lookup
+    _levels: dict = {}
+
     def emit(self, record):
         # Get corresponding Loguru level if it exists
-        try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = record.levelno
+        level = self._levels.get(record.levelname)
+        if level is None:
+            try:
+                level = logger.level(record.levelname).name
+            except ValueError:
+                level = record.levelno
+            self._levels[record.levelname] = level
 
         # Find caller from where originated the logged message
         frame, depth = logging.currentframe(), 2
@@ -56,6 +85,32 @@ class InterceptHandler(logging.Handler):
             level, record.getMessage())
 
 
+class AccessLogSampler(logging.Filter):
+    """Drop access logs of successful requests by ACCESS_LOG_SAMPLE_RATIO and ACCESS_LOG_MAX_PER_SECOND before they are intercepted"""
+
+    def __init__(self, ratio: float = ACCESS_LOG_SAMPLE_RATIO, max_per_second: int = ACCESS_LOG_MAX_PER_SECOND) -> None:
+        super().__init__()
+        self.ratio = ratio
+        self.max_per_second = max_per_second
+        self._second = 0
+        self._count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # NOTE: args of uvicorn.access are (client_addr, method, full_path, http_version, status_code)
+        args = record.args
+        if isinstance(args, tuple) and len(args) == 5 and isinstance(args[4], int) and args[4] >= 400:
+            return True
+        if self.ratio < 1 and random() >= self.ratio:
+            return False
+        if self.max_per_second:
+            second = int(monotonic())
+            if second != self._second:
+                self._second, self._count = second, 0
+            self._count += 1
+            return self._count <= self.max_per_second
+        return True
+
+
 class StubbedGunicornLogger(Logger):
     def setup(self, cfg):
         handler = logging.NullHandler()
@@ -87,19 +142,49 @@ class StandaloneApplication(BaseApplication):
         return self.application
 
 
+def create_span_exporter(name: str = TRACE_EXPORTER) -> SpanExporter:
+    if name == "cloud_trace":
+        return CloudTraceSpanExporter()
+    if name == "otlp":
+        # NOTE: an optional dependency for offline runs with a local collector such as Jaeger
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import \
+            OTLPSpanExporter
+        return OTLPSpanExporter()
+    if name == "file":
+        return ConsoleSpanExporter(out=open(f"{TRACE_FILE}.{getpid()}", "a"), formatter=lambda span: span.to_json(indent=None) + "\n")
+    if name == "console":
+        return ConsoleSpanExporter()
+    raise ValueError(f"unknown trace exporter: {name}")
+
+
+def create_tracer_provider(ratio: float = TRACE_SAMPLE_RATIO) -> TracerProvider:
+    # NOTE: spans which are not sampled are not recorded, so a low ratio costs little more than no tracing
+    return TracerProvider(sampler=ParentBased(TraceIdRatioBased(ratio)))
+
+
 def setup_trace() -> None:
-    if ENV == "production":
+    # NOTE: it is called per worker, the thread of BatchSpanProcessor does not survive fork
+    if TRACE_EXPORTER == "none":
+        return
+    if TRACE_EXPORTER == "cloud_trace":
         # NOTE: Cloud Trace settings
         set_global_textmap(CloudTraceFormatPropagator())
-        tracer_provider = TracerProvider()
-        cloud_trace_exporter = CloudTraceSpanExporter()
-        tracer_provider.add_span_processor(BatchSpanProcessor(cloud_trace_exporter))
-        trace.set_tracer_provider(tracer_provider)
-        trace.get_tracer(__name__)
+    tracer_provider = create_tracer_provider()
+    tracer_provider.add_span_processor(BatchSpanProcessor(create_span_exporter()))
+    trace.set_tracer_provider(tracer_provider)
 
 
-def serialize(record):
-    # NOTE: Serialize Cloud Logging format
+def patch(record):
+    # NOTE: the span of a request is only known on the thread which logs a record, before it is enqueued
+    span_context = trace.get_current_span().get_span_context()
+    if span_context.is_valid:
+        record["extra"]["trace_id"] = format(span_context.trace_id, "032x")
+        record["extra"]["span_id"] = format(span_context.span_id, "016x")
+        record["extra"]["trace_sampled"] = span_context.trace_flags.sampled
+
+
+def log_entry(record) -> dict:
+    # NOTE: Cloud Logging format
     # ref: https://loguru.readthedocs.io/en/stable/resources/recipes.html#serializing-log-messages-using-a-custom-function
     entry = {
         "time": record["time"].strftime("%Y-%m-%dT%H:%M:%SZ"),
@@ -111,15 +196,78 @@ def serialize(record):
     if record["exception"]:
         # ref: https://loguru.readthedocs.io/en/stable/resources/recipes.html#customizing-the-formatting-of-exceptions
         entry["extra"] = stackprinter.format(record["exception"])
-    # TODO: add trace id to conbine cloud trace
-    # entry["logging.googleapis.com/trace"] = xxx
-    return dumps(entry)
+    extra = record["extra"]
+    if "trace_id" in extra:
+        # ref: https://cloud.google.com/logging/docs/structured-logging#special-payload-fields
+        entry["logging.googleapis.com/trace"] = f"projects/{PROJECT}/traces/{extra['trace_id']}"
+        entry["logging.googleapis.com/spanId"] = extra["span_id"]
+        entry["logging.googleapis.com/trace_sampled"] = extra["trace_sampled"]
+    return entry
+
+
+def serialize(record):
+    return orjson.dumps(log_entry(record))
 
 
 def sink(message):
     # NOTE: Change sync to customize log format for Cloud Logging
     # ref: https://loguru.readthedocs.io/en/stable/resources/recipes.html#serializing-log-messages-using-a-custom-function
-    print(serialize(message.record))
+    stdout.buffer.write(serialize(message.record) + b"\n")
+    stdout.flush()
+
+
+log_records_dropped = Counter("log_records_dropped", "Log records which were dropped because the queue of the log writer was full")
+
+
+class BackgroundSink:
+    """
+    A sink which only puts records on a queue, a thread of the worker serializes and writes them
+
+    enqueue of loguru pickles records to a multiprocessing queue, which costs more on the thread which logs them than writing them.
+    The thread is started again in a forked worker, and records in the queue are written at exit.
+    The queue is bounded, so records are dropped and counted instead of growing memory when the writer falls behind.
+    """
+
+    def __init__(self, max_size: int = LOG_QUEUE_SIZE) -> None:
+        self.max_size = max_size
+        self._start()
+        register_at_fork(after_in_child=self._start)
+        atexit.register(self.stop)
+
+    def __call__(self, message) -> None:
+        # NOTE: qsize of SimpleQueue takes no lock, the queue may exceed max_size by records of threads which log at the same time
+        if self._queue.qsize() >= self.max_size:
+            log_records_dropped.inc()
+            return
+        self._queue.put(message.record)
+
+    def _start(self) -> None:
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread = Thread(target=self._write_forever, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def _write_forever(self) -> None:
+        while True:
+            records = [self._queue.get()]
+            # NOTE: write records which arrived while the previous ones were written at once
+            try:
+                while len(records) < 1000:
+                    records.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            stop = None in records
+            try:
+                stdout.buffer.write(b"".join(serialize(record) + b"\n" for record in records if record is not None))
+                stdout.flush()
+            except Exception:
+                # NOTE: the batch is lost, but the thread keeps writing the next ones, and logger would put the error on this queue again
+                traceback.print_exc(file=stderr)
+            if stop:
+                return
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
 
 
 def setup_gunicorn() -> dict:
@@ -143,19 +291,28 @@ def setup_gunicorn() -> dict:
         if name not in seen:
             seen.add(name.split(".")[0])
             logging.getLogger(name).handlers = [intercept_handler]
+            # NOTE: a record of uvicorn.access was written by handlers of uvicorn and root too
+            logging.getLogger(name).propagate = False
+    # NOTE: filters of a logger run before its handlers, so dropped access logs do not cost the walk of frames
+    logging.getLogger("uvicorn.access").addFilter(AccessLogSampler())
 
     if ENV == "production":
-        handlers = [{"sink": sink, "serialize": True}]
+        handlers = [{"sink": BackgroundSink() if LOG_ENQUEUE else sink, "format": "{message}"}]
     else:
         handlers = [{"sink": stdout}]
-    logger.configure(handlers=handlers)
+    logger.configure(handlers=handlers, patcher=patch)
 
     return {
+        **RUNTIME_PROFILES[RUNTIME_PROFILE],
         "bind": "0.0.0.0",
-        "workers": 2 * cpu_count() + 1,
+        "workers": WORKERS,
         "accesslog": "-",
         "errorlog": "-",
+        # NOTE: it runs on uvloop and httptools when they are installed
         "worker_class": "uvicorn.workers.UvicornWorker",
         "logger_class": StubbedGunicornLogger,
-        "reload": True,
+        "on_starting": lambda server: clear_multiprocess_dir(),
+        # NOTE: the app is loaded by the master, so Spanner is connected in each worker
+        "post_fork": lambda server, worker: connect(),
+        "child_exit": lambda server, worker: mark_worker_dead(worker.pid),
     }
@@ -0,0 +1,60 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from routers import character_cache as module
+from routers.character_cache import CharacterCache
+
+
+class TestCharacterCache:
+    def test_disabled(self):
+        cache = CharacterCache(size=0)
+        cache.put((1, 10, 1, 100, 50))
+
+        assert cache.get(1) is None
+
+    def test_get(self):
+        cache = CharacterCache(size=2)
+        cache.put((1, 10, 1, 100, 50))
+        cache.put((1, 10, 2, 200, 60))
+
+        # NOTE: the values of the last battle
+        assert cache.get(1) == (1, 10, 2, 200, 60)
+        assert cache.get(1, 10) == (1, 10, 2, 200, 60)
+        # NOTE: a character of another user is not found
+        assert cache.get(1, 11) is None
+        assert cache.get(2) is None
+
+    def test_lru(self):
+        cache = CharacterCache(size=2)
+        cache.put((1, 10, 1, 100, 50))
+        cache.put((2, 10, 1, 100, 50))
+        cache.get(1)
+        cache.put((3, 10, 1, 100, 50))
+
+        assert cache.get(1) is not None
+        assert cache.get(2) is None
+        assert cache.get(3) is not None
+
+        cache.clear()
+        assert cache.get(1) is None
+
+    def test_ttl(self, monkeypatch):
+        cache = CharacterCache(size=2, ttl=5)
+        monkeypatch.setattr(module, "monotonic", lambda: 100.0)
+        cache.put((1, 10, 1, 100, 50))
+
+        monkeypatch.setattr(module, "monotonic", lambda: 105.0)
+        assert cache.get(1) is not None
+        monkeypatch.setattr(module, "monotonic", lambda: 105.1)
+        assert cache.get(1) is None
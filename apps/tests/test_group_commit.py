@@ -0,0 +1,86 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import Future
+
+import pytest
+from google.api_core.exceptions import AlreadyExists, DeadlineExceeded
+from routers.group_commit import GroupCommitWriter
+
+
+class FakeBatch:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if args[0] is None:
+            self.database.commit(self.rows)
+
+    def insert(self, table, columns, values):
+        self.rows.extend(values)
+
+
+class FakeDatabase:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.committed = []
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def commit(self, rows):
+        error = self.errors.pop(0) if self.errors else None
+        # NOTE: an ambiguous error is returned after the rows were written
+        if error is None or isinstance(error, DeadlineExceeded):
+            for row in rows:
+                if row in self.committed:
+                    raise AlreadyExists("row exists")
+                self.committed.append(row)
+        if error is not None:
+            raise error
+
+
+def commit(database, rows):
+    pending = [("Tests", ("Id",), row, Future()) for row in rows]
+    GroupCommitWriter(database)._commit(pending)
+    return [future for _, _, _, future in pending]
+
+
+class TestGroupCommitWriter:
+    def test_commit(self):
+        database = FakeDatabase([])
+
+        assert [future.result() for future in commit(database, [(1,), (2,)])] == [1, 2]
+        assert database.committed == [(1,), (2,)]
+
+    def test_ambiguous_error(self):
+        database = FakeDatabase([DeadlineExceeded("deadline")])
+
+        # NOTE: the batch was committed, so the retries of each row succeed
+        assert [future.result() for future in commit(database, [(1,), (2,)])] == [1, 2]
+        assert database.committed == [(1,), (2,)]
+
+    def test_bad_row(self):
+        database = FakeDatabase([AlreadyExists("row exists")])
+        database.committed.append((2,))
+
+        futures = commit(database, [(1,), (2,)])
+        assert futures[0].result() == 1
+        # NOTE: a duplicate key is an error when the batch was not committed
+        with pytest.raises(AlreadyExists):
+            futures[1].result()
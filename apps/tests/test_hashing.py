@@ -0,0 +1,52 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os import environ
+from pathlib import Path
+from subprocess import run
+from sys import executable
+
+from routers.hashing import PasswordHasher, get_password_hash
+
+APPS_DIR = Path(__file__).parents[1]
+
+# NOTE: the same as main.py, it imports Spanner clients and creates the pool in the main block
+MAIN = """
+import google.cloud.spanner  # noqa: F401
+from routers.hashing import PasswordHasher
+
+if __name__ == "__main__":
+    hasher = PasswordHasher(backend="process", workers=1)
+    print(hasher.executor.submit(eval, "'google.cloud.spanner' in __import__('sys').modules").result())
+    hasher.shutdown()
+"""
+
+
+class TestPasswordHasher:
+    def test_process(self):
+        hasher = PasswordHasher(backend="process", workers=1)
+        try:
+            hashed_password, _ = hasher.executor.submit(get_password_hash, "password", 0).result()
+        finally:
+            hasher.shutdown()
+
+        assert hashed_password.startswith("$2b$")
+
+    def test_process_without_main(self, tmp_path):
+        main = tmp_path / "main.py"
+        main.write_text(MAIN)
+        result = run([executable, str(main)], capture_output=True, text=True, env={**environ, "PYTHONPATH": str(APPS_DIR)}, timeout=60)
+
+        # NOTE: processes of the pool do not run main.py again, so Spanner clients are not imported
+        assert result.stdout.strip() == "False", result.stderr
@@ -0,0 +1,114 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from asyncio import run
+from datetime import datetime, timedelta, timezone
+from time import tzset
+
+import pytest
+from routers import statements
+from routers.history_cache import (ALL_HISTORIES, MemoryHistoryCache,
+                                   NoHistoryCache, RedisHistoryCache,
+                                   create_history_cache, select)
+from routers.history_engine import sort_key
+
+base = datetime(2022, 10, 28, tzinfo=timezone.utc)
+
+
+def create_row(seconds: int, battle_history_id: int, user_id: int = 1):
+    updated_at = base + timedelta(seconds=seconds)
+    return (user_id, 2, 3, True, updated_at, updated_at, battle_history_id)
+
+
+class TestHistoryCache:
+    def test_select(self):
+        rows = [create_row(i, i) for i in range(10, 0, -1)]
+
+        assert select(rows, ALL_HISTORIES, base, base + timedelta(seconds=100), None, 3) == rows[:3]
+        assert select(rows, ALL_HISTORIES, base + timedelta(seconds=5), base + timedelta(seconds=8), None, 10) == rows[2:6]
+        assert select(rows, ALL_HISTORIES, base, base + timedelta(seconds=100), sort_key(rows[2]), 2) == rows[3:5]
+        # NOTE: rows before `after` may not be cached
+        assert select(rows, base + timedelta(seconds=4), base, base + timedelta(seconds=100), None, 3) == rows[:3]
+        assert select(rows, base + timedelta(seconds=4), base, base + timedelta(seconds=100), None, 10) is None
+
+    def test_seed_and_append(self):
+        cache = MemoryHistoryCache(size=3, max_users=10, ttl=15)
+        run(cache.append(create_row(1, 1)))
+        assert run(cache.get(1)) is None
+
+        run(cache.seed(1, [create_row(2, 2), create_row(1, 1)], ALL_HISTORIES))
+        run(cache.append(create_row(4, 4)))
+        run(cache.append(create_row(3, 3)))
+        run(cache.append(create_row(3, 3)))
+        rows, after = run(cache.get(1))
+
+        assert rows == [create_row(i, i) for i in (4, 3, 2)]
+        assert after == base + timedelta(seconds=2)
+
+    def test_expire_and_clear(self):
+        cache = MemoryHistoryCache(size=3, max_users=1, ttl=15)
+        run(cache.seed(1, [create_row(1, 1)], ALL_HISTORIES))
+        run(cache.seed(2, [create_row(1, 1, user_id=2)], ALL_HISTORIES))
+        assert run(cache.get(1)) is None
+
+        run(cache.clear())
+        assert run(cache.get(2)) is None
+
+        cache.ttl = -1
+        run(cache.seed(1, [create_row(1, 1)], ALL_HISTORIES))
+        assert run(cache.get(1)) is None
+
+    def test_hit_and_miss(self, monkeypatch):
+        rows = [create_row(i, i) for i in range(10, 0, -1)]
+
+        async def read(self, db, params=None, **snapshot_options):
+            # NOTE: rows of all shards are returned by the query of the first group
+            if params["ShardFrom"] != 0:
+                return []
+            since, until = datetime.fromisoformat(params["Since"]), datetime.fromisoformat(params["Until"])
+            return [row for row in rows if since <= row[5] <= until][:params.get("Limit")]
+
+        # NOTE: the local time zone must not shift the window of a read from Spanner
+        monkeypatch.setenv("TZ", "Asia/Tokyo")
+        tzset()
+        monkeypatch.setattr(statements.Statement, "read", read)
+        since, until = int((base + timedelta(seconds=3)).timestamp()), int((base + timedelta(seconds=7)).timestamp())
+        try:
+            missed = run(NoHistoryCache().read(None, 1, since, until, None, 10, timedelta(0)))
+            hit = run(MemoryHistoryCache(size=20).read(None, 1, since, until, None, 10, timedelta(0)))
+        finally:
+            monkeypatch.undo()
+            tzset()
+
+        assert missed == rows[3:8]
+        assert hit == missed
+
+    def test_redis_unreachable(self):
+        # NOTE: the battle is committed, so an append must not fail the request even if the invalidation fails too
+        cache = RedisHistoryCache(port=1)
+
+        run(cache.append(create_row(1, 1)))
+
+    def test_off(self):
+        cache = create_history_cache("off")
+        run(cache.seed(1, [create_row(1, 1)], ALL_HISTORIES))
+
+        assert isinstance(cache, NoHistoryCache)
+        assert run(cache.get(1)) is None
+
+    def test_memory_with_workers(self):
+        assert isinstance(create_history_cache("memory", workers=1), MemoryHistoryCache)
+        # NOTE: a delete of battle histories can not clear caches of the other workers
+        with pytest.raises(ValueError):
+            create_history_cache("memory", workers=2)
@@ -0,0 +1,57 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from routers.keys import (COUNTER_BITS, ENTRY_SHARDS, KEY_BITS,
+                          KEY_STRATEGIES, BitReversedKeys, PrefixedCounterKeys,
+                          create_key_generator, next_entry_shard_id,
+                          reverse_bits)
+
+
+class TestKeys:
+    def test_reverse_bits(self):
+        assert reverse_bits(1) == 1 << (KEY_BITS - 1)
+        assert reverse_bits(0b110) == 0b011 << (KEY_BITS - 3)
+        assert reverse_bits(reverse_bits(123456789)) == 123456789
+
+    @pytest.mark.parametrize("strategy", list(KEY_STRATEGIES))
+    def test_keys(self, strategy):
+        generator = create_key_generator(strategy)
+        keys = [generator.next_key() for _ in range(1000)]
+
+        assert len(set(keys)) == len(keys)
+        assert all(0 <= key < 1 << KEY_BITS for key in keys)
+
+    def test_bit_reversed_keys(self):
+        generator = BitReversedKeys(worker_id=1)
+        first, second = generator.next_key(), generator.next_key()
+
+        # NOTE: consecutive keys of a worker differ in the highest bit
+        assert (first ^ second) >> (KEY_BITS - 1) == 1
+        # NOTE: counters start at random, so workers which draw the same id do not generate the same keys
+        assert BitReversedKeys(worker_id=1).next_key() != BitReversedKeys(worker_id=1).next_key()
+
+    def test_prefixed_counter_keys(self):
+        generator = PrefixedCounterKeys(worker_id=1)
+        first, second = generator.next_key(), generator.next_key()
+
+        assert second == first + 1
+        assert first >> COUNTER_BITS == 1
+
+    def test_unknown_strategy(self):
+        with pytest.raises(ValueError):
+            create_key_generator("sequence")
+
+    def test_entry_shard_id(self):
+        assert all(0 <= next_entry_shard_id() < ENTRY_SHARDS for _ in range(1000))
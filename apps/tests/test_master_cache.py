@@ -0,0 +1,152 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import Counter
+from datetime import datetime, timezone
+
+from routers import master_cache
+from routers.master_cache import MasterCache, build_alias
+
+
+class FakeSnapshot:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def begin(self):
+        pass
+
+    def execute_sql(self, sql, params=None, param_types=None, request_options=None):
+        if sql.startswith("SELECT Id FROM"):
+            return [(row[0],) for row in self.table]
+        if params and "Since" in params:
+            return [row for row in self.table if (row[-1], row[0]) > (params["Since"], params["Key"])]
+        return list(self.table)
+
+
+class FakeDatabase:
+    def __init__(self, table):
+        self.table = table
+
+    def snapshot(self, **kwargs):
+        return FakeSnapshot(self.table)
+
+
+class TestMasterCache:
+    def test_put_and_choice(self):
+        cache = MasterCache("TestMasters", ("Id", "Name"), ttl=3, max_size=10)
+        rows = [(i, f"test_{i}") for i in range(5)]
+        for row in rows:
+            cache.put(row)
+
+        assert len(cache) == 5
+        for _ in range(20):
+            assert cache.choice() in rows
+
+    def test_evict_least_recently_used(self):
+        cache = MasterCache("TestMasters", ("Id", "Name"), ttl=3, max_size=3)
+        for i in range(4):
+            cache.put((i, f"test_{i}"))
+
+        assert len(cache) == 3
+        assert sorted(cache.choice()[0] for _ in range(50))[0] > 0
+
+    def test_clear(self):
+        cache = MasterCache("TestMasters", ("Id", "Name"), ttl=3, max_size=3)
+        cache.put((1, "test_1"))
+        cache.clear()
+
+        assert cache.choice() is None
+        assert cache.expired
+
+    def test_load(self, monkeypatch):
+        monkeypatch.setattr(master_cache, "MASTER_CACHE_KEY_SWEEP", 0)
+        at = [datetime(2022, 1, 1, second=i, tzinfo=timezone.utc) for i in range(4)]
+        table = [(1, "test_1", at[0]), (2, "test_2", at[1])]
+        database = FakeDatabase(table)
+        cache = MasterCache("TestMasters", ("Id", "Name"), ttl=3, max_size=10)
+        cache.load(database)
+
+        assert len(cache) == 2
+        assert cache._watermark == (at[1], 2)
+
+        # NOTE: an update and an insert are read by UpdatedAt, and a deletion is found by keys
+        table[:] = [(2, "updated_2", at[2]), (3, "test_3", at[3])]
+        cache.load(database)
+
+        assert len(cache) == 2
+        assert sorted(cache._rows.values()) == [(2, "updated_2"), (3, "test_3")]
+        assert cache._watermark == (at[3], 3)
+
+    def test_load_without_sweep(self):
+        at = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        table = [(1, "test_1", at), (2, "test_2", at)]
+        database = FakeDatabase(table)
+        cache = MasterCache("TestMasters", ("Id", "Name"), ttl=3, max_size=10)
+        cache.load(database)
+
+        # NOTE: a deletion is not read until the next sweep of keys, but discard drops it and requests the sweep
+        del table[0]
+        cache.load(database)
+        assert len(cache) == 2
+        cache.discard(1)
+        assert len(cache) == 1
+        table.append((3, "test_3", at))
+        cache.load(database)
+        assert sorted(cache._rows) == [2, 3]
+
+    def test_alias_rebuilt_by_load(self):
+        at = [datetime(2022, 1, 1, second=i, tzinfo=timezone.utc) for i in range(3)]
+        table = [(1, 1, at[0]), (2, 9, at[0])]
+        database = FakeDatabase(table)
+        cache = MasterCache("TestMasters", ("Id", "Strength"), ttl=3, max_size=10, weight_column="Strength")
+        cache.load(database)
+        alias = cache._alias
+
+        # NOTE: a row whose weight did not change keeps the alias table
+        table[0] = (1, 1, at[1])
+        cache.load(database)
+        assert cache._alias is alias
+
+        table[0] = (1, 0, at[2])
+        cache.load(database)
+        assert cache._alias is not alias
+        assert all(cache.weighted_choice()[0] == 2 for _ in range(100))
+
+    def test_weighted_choice(self):
+        cache = MasterCache("TestMasters", ("Id", "Strength"), ttl=3, max_size=10, weight_column="Strength")
+        cache.put((1, 1))
+        cache.put((2, 0))
+        cache.put((3, 9))
+
+        counts = Counter(cache.weighted_choice()[0] for _ in range(2000))
+
+        assert counts[2] == 0
+        assert counts[3] > counts[1] * 3
+
+
+def test_build_alias():
+    probabilities, aliases = build_alias([1, 2, 3, 0])
+
+    # NOTE: probability of each index is sum of own and aliased probabilities divided by the size
+    expected = [0.0] * 4
+    for i, probability in enumerate(probabilities):
+        expected[i] += probability / 4
+        expected[aliases[i]] += (1 - probability) / 4
+    assert [round(e, 6) for e in expected] == [round(w / 6, 6) for w in [1, 2, 3, 0]]
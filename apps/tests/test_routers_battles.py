@@ -12,15 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from asyncio import run
+from datetime import datetime, timezone
 from random import choice
 from time import sleep, time
+from types import SimpleNamespace
 from typing import List, Tuple
 
-from fastapi import status
+from fastapi import HTTPException, status
 from fastapi.testclient import TestClient
 from main import app
-from pytest import fixture
-from routers.battles import BattleResponse, Battles
+from pytest import fixture, raises
+from routers.battles import (NEXT_CURSOR_HEADER, BattleResponse, Battles,
+                             BattleWriteMode, HistoryFormat, decode_cursor,
+                             stream_battle_histories)
 from routers.characters import CreateCharacterResponse
 from routers.opponent_master import OpponentMasterResponse
 from routers.users import UserResponse
@@ -34,6 +39,7 @@ from tests.test_routers_users import create_test_users, delete_all_users
 
 API_PATH_BATTLE = "/api/v1/battles/"
 API_PATH_BATTLE_HISTORIES = "/api/v1/battles/history"
+API_PATH_BATTLE_HISTORIES_STREAM = "/api/v1/battles/history/stream"
 
 test_data_num = 10
 
@@ -53,6 +59,42 @@ def delete_all_battle_histories() -> None:
     client.delete(API_PATH_BATTLE_HISTORIES)
 
 
+class FakeSnapshot:
+    def __init__(self):
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+    def execute_sql(self, sql, **kwargs):
+        updated_at = datetime(2022, 10, 28, tzinfo=timezone.utc)
+        return iter([(1, 2, 3, True, updated_at, updated_at, i) for i in range(3)])
+
+
+class TestStreamBattleHistories:
+    def test_disconnect(self):
+        snapshot = FakeSnapshot()
+        db = SimpleNamespace(database=SimpleNamespace(snapshot=lambda **kwargs: snapshot))
+        response = stream_battle_histories(1, 0, int(time()), cursor=None, limit=None, format=HistoryFormat.ndjson, db=db)
+
+        async def disconnect():
+            await response.body_iterator.__anext__()
+            assert not snapshot.closed
+            # NOTE: Starlette runs the background task when the client disconnected in the middle of the stream
+            await response.background()
+
+        run(disconnect())
+        assert snapshot.closed
+
+    def test_invalid_cursor(self):
+        for cursor in ["hoge", "OTk5OTk5OTk5OTk5OTk5OTk5OTkuMQ=="]:
+            with raises(HTTPException):
+                decode_cursor(cursor)
+
+
 class TestBattles:
     @fixture(scope="class", autouse=True)
     def delete_test_data(self):
@@ -95,6 +137,38 @@ class TestBattles:
         assert res.status_code == status.HTTP_200_OK
         assert len(res.json()) == test_data_num
 
+    def test_get_battle_histories_by_cursor(self):
+        current_epoch_time = int(time())
+        query_strins = f"user_id={self.test_users[0].user_id}&since={current_epoch_time - 72000}&until={current_epoch_time + 72000}&limit=3"
+        # NOTE: Wait to get data, because this method use stale read
+        sleep(float(battle_history_delay) + 0.5)
+
+        histories, cursor = [], ""
+        for _ in range(test_data_num):
+            res = client.get(f"{API_PATH_BATTLE_HISTORIES}?{query_strins}&cursor={cursor}")
+            assert res.status_code == status.HTTP_200_OK
+            histories.extend(res.json())
+            cursor = res.headers.get(NEXT_CURSOR_HEADER, "")
+            if not cursor:
+                break
+
+        assert len(histories) == test_data_num
+        assert [history["updated_at"] for history in histories] == sorted([history["updated_at"] for history in histories], reverse=True)
+
+    def test_stream_battle_histories(self):
+        current_epoch_time = int(time())
+        query_strins = f"user_id={self.test_users[0].user_id}&since={current_epoch_time - 72000}&until={current_epoch_time + 72000}"
+        # NOTE: Wait to get data, because this method use stale read
+        sleep(float(battle_history_delay) + 0.5)
+
+        res = client.get(f"{API_PATH_BATTLE_HISTORIES_STREAM}?{query_strins}")
+        assert res.status_code == status.HTTP_200_OK
+        assert len(res.text.splitlines()) == test_data_num
+
+        res = client.get(f"{API_PATH_BATTLE_HISTORIES_STREAM}?{query_strins}&format=json")
+        assert res.status_code == status.HTTP_200_OK
+        assert len(res.json()) == test_data_num
+
     def test_battle(self):
         created_users = [{"character_id": choice(self.test_characters).id}, {"hoge": "hoge"}, {"character_id": 10}]
 
@@ -108,6 +182,28 @@ class TestBattles:
             elif i == 2:
                 assert res.status_code == status.HTTP_404_NOT_FOUND
 
+    def test_battle_write_modes(self):
+        for write_mode in [mode.value for mode in BattleWriteMode]:
+            for i, character_id in enumerate([choice(self.test_characters).id, 10]):
+                res = client.post(f"{API_PATH_BATTLE}?write_mode={write_mode}", json={"character_id": character_id}, headers={"Content-Type": "application/json", "User-Agent": "unit-test-agent"})
+
+                if i == 0:
+                    assert res.status_code == status.HTTP_201_CREATED
+                else:
+                    assert res.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_battle_by_user_id(self):
+        character = choice(self.test_characters)
+        for write_mode in [mode.value for mode in BattleWriteMode]:
+            # NOTE: a character of another user is not found by its key
+            for i, user_id in enumerate([character.user_id, 10]):
+                res = client.post(f"{API_PATH_BATTLE}?write_mode={write_mode}", json={"user_id": user_id, "character_id": character.id}, headers={"Content-Type": "application/json", "User-Agent": "unit-test-agent"})
+
+                if i == 0:
+                    assert res.status_code == status.HTTP_201_CREATED
+                else:
+                    assert res.status_code == status.HTTP_404_NOT_FOUND
+
     def test_delete_user(self):
         res = client.delete(API_PATH_BATTLE_HISTORIES)
 
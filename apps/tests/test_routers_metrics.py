@@ -0,0 +1,33 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from fastapi import status
+from fastapi.testclient import TestClient
+from main import app
+from tests.test_routers_users import create_test_users, delete_all_users
+
+client = TestClient(app)
+
+
+class TestMetrics:
+    def test_get_metrics(self):
+        create_test_users(1)
+
+        res = client.get("/metrics")
+        assert res.status_code == status.HTTP_200_OK
+        assert res.headers["content-type"].startswith("text/plain")
+        assert 'spanner_transaction_latency_seconds_count{transaction="create_user_repository"}' in res.text
+        assert "spanner_session_pool_wait_seconds_count" in res.text
+
+        delete_all_users()
@@ -0,0 +1,126 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from asyncio import CancelledError, Event, create_task, run, sleep
+from datetime import datetime, timedelta, timezone
+from time import sleep as wait
+
+from fastapi import status
+from fastapi.testclient import TestClient
+from main import app
+from pytest import fixture, raises
+from routers import reset
+from routers.reset import (RESET_STAGES, JobState, ResetJob, ResetMode,
+                           drop_statements, load_job, read_schema,
+                           running_job)
+from tests.test_routers_opponent_master import create_test_opponent_masters
+
+API_PATH = "/api/v1/reset/"
+
+
+@fixture(scope="module")
+def client():
+    # NOTE: a reset is a task of the event loop of the client, which only runs between requests inside `with`
+    with TestClient(app) as client:
+        yield client
+
+
+class BlockingDatabase:
+    def __init__(self):
+        self.started = Event()
+
+    async def execute_partitioned_dml(self, dml):
+        self.started.set()
+        await sleep(60)
+
+
+def wait_for_reset(client: TestClient, job_id: str, timeout: float = 60) -> dict:
+    for _ in range(int(timeout * 10)):
+        res = client.get(f"{API_PATH}{job_id}")
+        assert res.status_code == status.HTTP_200_OK
+        if res.json()["state"] in ("done", "failed"):
+            return res.json()
+        wait(0.1)
+    raise Exception("Reset did not finish")
+
+
+class TestReset:
+
+    def test_drop_statements(self):
+        statements = drop_statements(read_schema())
+
+        assert statements[0] == "DROP INDEX BattleHistoryByUserId"
+        # NOTE: children are dropped before their parents
+        assert statements.index("DROP TABLE BattleHistory") < statements.index("DROP TABLE Characters") < statements.index("DROP TABLE Users")
+        assert len(statements) == 3 + sum(len(stage) for stage in RESET_STAGES)
+
+    def test_reset(self, client):
+        create_test_opponent_masters(3)
+
+        res = client.post(API_PATH)
+        assert res.status_code == status.HTTP_202_ACCEPTED
+        job = wait_for_reset(client, res.json()["job_id"])
+
+        assert job["state"] == "done"
+        assert [table["table"] for table in job["tables"]] == [table for stage in RESET_STAGES for table in stage]
+        assert {table["table"]: table["rows_deleted"] for table in job["tables"]}["OpponentMasters"] >= 3
+
+    def test_cancelled_reset(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(reset, "RESET_JOB_DIR", str(tmp_path))
+
+        async def cancel() -> str:
+            db = BlockingDatabase()
+            job = ResetJob(ResetMode.delete)
+            assert job.lock()
+            task = create_task(job.run(db))
+            await db.started.wait()
+            task.cancel()
+            with raises(CancelledError):
+                await task
+            return job.status.job_id
+
+        # NOTE: a reset which was cancelled by shutdown of the worker does not block the next one
+        assert load_job(run(cancel())).state == JobState.failed
+        assert running_job() is None
+        job = ResetJob(ResetMode.delete)
+        assert job.lock()
+        job.unlock()
+
+    def test_lock(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(reset, "RESET_JOB_DIR", str(tmp_path))
+        first, second = ResetJob(ResetMode.delete), ResetJob(ResetMode.delete)
+
+        assert first.lock()
+        # NOTE: a reset of another worker can not start until the first one finishes
+        assert not second.lock()
+        first.unlock()
+        assert second.lock()
+        second.unlock()
+
+    def test_stale_reset(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(reset, "RESET_JOB_DIR", str(tmp_path))
+        job = ResetJob(ResetMode.delete)
+        job.status.state = JobState.running
+        job.save()
+        assert running_job() is not None
+
+        job.status.heartbeat_at = datetime.now(timezone.utc) - timedelta(seconds=3 * reset.RESET_JOB_HEARTBEAT + 1)
+        with open(ResetJob.path(job.status.job_id), "w") as f:
+            f.write(job.status.json())
+        assert load_job(job.status.job_id).state == JobState.failed
+        assert running_job() is None
+
+    def test_get_unknown_reset(self, client):
+        res = client.get(f"{API_PATH}1")
+        assert res.status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,36 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from datetime import datetime, timezone
+
+from routers.serialization import RowEncoder, RowsResponse
+
+
+class TestSerialization:
+    def test_encode(self):
+        encoder = RowEncoder(("user_id", "name", "created_at"), int64_as_str=("user_id",), timestamps=("created_at",))
+        created_at = datetime(2022, 10, 28, tzinfo=timezone.utc)
+
+        # NOTE: extra columns such as BattleHistoryId are ignored
+        assert json.loads(encoder.encode([(1 << 62, "user", created_at, 100)])) == [{"user_id": str(1 << 62), "name": "user", "created_at": created_at.isoformat()}]
+        assert json.loads(encoder.encode_row((1, None, None))) == {"user_id": "1", "name": None, "created_at": None}
+
+    def test_rows_response(self):
+        encoder = RowEncoder(("id",), int64_as_str=("id",))
+        response = RowsResponse([(1,), (2,)], encoder, headers={"X-Next-Cursor": "cursor"})
+
+        assert response.media_type == "application/json"
+        assert response.headers["X-Next-Cursor"] == "cursor"
+        assert json.loads(response.body) == [{"id": "1"}, {"id": "2"}]
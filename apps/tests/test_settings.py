@@ -0,0 +1,74 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import sleep
+from types import SimpleNamespace
+
+import settings
+from prometheus_client import REGISTRY
+from settings import BackgroundSink
+
+
+class FakeBuffer:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.writes = []
+
+    def write(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("broken pipe")
+        self.writes.append(data)
+
+
+class FakeStdout:
+    def __init__(self, failures: int = 0):
+        self.buffer = FakeBuffer(failures)
+
+    def flush(self):
+        pass
+
+
+def log(sink: BackgroundSink, message: bytes) -> None:
+    sink(SimpleNamespace(record=message))
+
+
+class TestBackgroundSink:
+    def test_write_error(self, monkeypatch):
+        stdout = FakeStdout(failures=1)
+        monkeypatch.setattr(settings, "stdout", stdout)
+        monkeypatch.setattr(settings, "serialize", lambda record: record)
+        sink = BackgroundSink()
+        log(sink, b"lost")
+        for _ in range(50):
+            if not stdout.buffer.failures:
+                break
+            sleep(0.1)
+
+        # NOTE: the thread keeps writing after a batch failed
+        log(sink, b"written")
+        sink.stop()
+        assert b"".join(stdout.buffer.writes) == b"written\n"
+
+    def test_full_queue(self, monkeypatch):
+        stdout = FakeStdout()
+        monkeypatch.setattr(settings, "stdout", stdout)
+        monkeypatch.setattr(settings, "serialize", lambda record: record)
+        dropped = REGISTRY.get_sample_value("log_records_dropped_total")
+        sink = BackgroundSink(max_size=0)
+        log(sink, b"dropped")
+
+        sink.stop()
+        assert b"".join(stdout.buffer.writes) == b""
+        assert REGISTRY.get_sample_value("log_records_dropped_total") == dropped + 1
@@ -0,0 +1,45 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from google.api_core.exceptions import FailedPrecondition
+from google.rpc.code_pb2 import FAILED_PRECONDITION, OK
+from google.rpc.status_pb2 import Status
+from routers.statements import INT64, Statement, StatementBatch
+
+update = Statement("test_update", "UPDATE Tests SET Value=@Value WHERE Id=@Id", {"Value": INT64, "Id": INT64}, action="update")
+insert = Statement("test_insert", "INSERT Tests (Id, Value) VALUES (@Id, @Value)", {"Value": INT64, "Id": INT64}, action="insert")
+batch = StatementBatch("test_batch", (update, insert))
+
+
+class FakeTransaction:
+    def __init__(self, status, row_counts):
+        self.result = status, row_counts
+
+    def batch_update(self, statements, request_options=None):
+        return self.result
+
+
+class TestStatementBatch:
+    def test_execute(self):
+        params = ({"Id": 1, "Value": 2}, {"Id": 2, "Value": 3})
+
+        assert batch.execute(FakeTransaction(Status(code=OK), [1, 1]), params) == [1, 1]
+
+    def test_failed_statement(self):
+        params = ({"Id": 1, "Value": 2}, {"Id": 2, "Value": 3})
+
+        # NOTE: the update succeeded and the insert failed, the transaction must not be committed
+        with pytest.raises(FailedPrecondition, match="test_insert"):
+            batch.execute(FakeTransaction(Status(code=FAILED_PRECONDITION, message="foreign key"), [1]), params)
@@ -0,0 +1,92 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from importlib import reload
+from multiprocessing import cpu_count
+
+from routers import runtime, session_pool, utils
+from routers.utils import SpannerProvider
+
+
+class FakeSnapshot:
+    def __init__(self, session):
+        self.session = session
+
+    def execute_sql(self, sql):
+        self.session.queries.append(sql)
+        return [(1,)]
+
+
+class FakeSession:
+    def __init__(self):
+        self.queries = []
+
+
+class FakePool:
+    def __init__(self, size):
+        self.size = size
+        self.sessions = [FakeSession() for _ in range(size)]
+
+    def get(self):
+        return self.sessions.pop()
+
+    def put(self, session):
+        self.sessions.append(session)
+
+
+class TestSpannerProvider:
+    def test_connect_per_process(self, monkeypatch):
+        provider = SpannerProvider()
+        connected = []
+        monkeypatch.setattr(provider, "connect", lambda: connected.append(1) or provider.use("database"))
+
+        assert provider.get().database == "database"
+        assert provider.get().database == "database"
+        assert len(connected) == 1
+
+        # NOTE: a forked process connects again
+        monkeypatch.setattr(utils, "getpid", lambda: -1)
+        provider.get()
+        assert len(connected) == 2
+
+    def test_use(self):
+        provider = SpannerProvider().use("database")
+
+        assert provider.get().async_database.database == "database"
+        assert provider.warm_up() == 0
+
+    def test_warm_up(self, monkeypatch):
+        monkeypatch.setattr(session_pool, "Snapshot", FakeSnapshot)
+        pool = FakePool(3)
+
+        assert session_pool.warm_up(pool, 10) == 3
+        assert session_pool.warm_up(pool, 2) == 2
+        assert session_pool.warm_up(pool, 0) == 0
+        assert len(pool.sessions) == 3
+        assert sum(len(session.queries) for session in pool.sessions) == 5
+
+
+class TestRuntime:
+    def test_workers(self, monkeypatch):
+        monkeypatch.delenv("GUNICORN_WORKERS", raising=False)
+        try:
+            monkeypatch.setenv("RUNTIME_PROFILE", "dev")
+            assert reload(runtime).WORKERS == 1
+            monkeypatch.setenv("RUNTIME_PROFILE", "stress")
+            assert reload(runtime).WORKERS == cpu_count()
+            monkeypatch.setenv("GUNICORN_WORKERS", "3")
+            assert reload(runtime).WORKERS == 3
+        finally:
+            monkeypatch.undo()
+            reload(runtime)
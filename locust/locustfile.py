@@ -17,22 +17,28 @@ from os import getenv
 from random import choice, randint
 from sys import stdout
 from time import time
-from typing import Dict, Tuple
+from typing import Dict, List, Tuple
 
 # NOTE: need to import to use plugins vis CLI
 import locust_plugins  # noqa: F401
 from faker import Faker
 from google.cloud.logging.handlers import ContainerEngineHandler
 from pydantic import BaseModel, EmailStr, Field
-from redis import ConnectionPool, StrictRedis
+from shapes import LOAD_SHAPE_FILE, ScheduledUser
+from shapes import setup as setup_shapes
+from user_pool import UserPool, setup
 
-from locust import HttpUser, task
+from locust import HttpUser, TaskSet, events, task
+from locust.contrib.fasthttp import FastHttpUser
 
 ENV = getenv("ENV", "local")
 LOG_LEVEL = getenv("LOG_LEVEL", "INFO")
-REDIS_HOST = getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(getenv("REDIS_PORT", "6379"))
-REDIS_CONNECTIONS = int(getenv("REDIS_CONNECTIONS", "3"))
+# NOTE: "dml", "batch_dml" or "mutation" to compare how the api writes a battle, empty means the api default
+BATTLE_WRITE_MODE = getenv("BATTLE_WRITE_MODE", "")
+# NOTE: "http" runs the scenario by HttpUser (python-requests), "fast" by FastHttpUser (geventhttpclient)
+LOCUST_USER_CLASS = getenv("LOCUST_USER_CLASS") or "http"
+# NOTE: fake payloads per process, which tasks pick from instead of calling faker and pydantic per request
+FAKE_DATA_POOL_SIZE = int(getenv("FAKE_DATA_POOL_SIZE", "1000"))
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +49,19 @@ if ENV == "production":
     logger.propagate = False
 
 fake = Faker('jp-JP')
+# NOTE: user ids of this process, which are picked by USER_POOL_DISTRIBUTION
+user_pool = UserPool()
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    setup(environment, user_pool)
+    setup_shapes(environment)
+
+
+if LOAD_SHAPE_FILE:
+    # NOTE: locust runs a shape which is defined in the locustfile, so import it only in arrival rate mode
+    from shapes import ArrivalRateShape  # noqa: F401
 
 
 class User(BaseModel):
@@ -53,6 +72,7 @@ class User(BaseModel):
 
 class Battles(BaseModel):
     character_id: str
+    user_id: str
 
 
 class Character(BaseModel):
@@ -70,44 +90,63 @@ class UpdateCharacters(BaseModel):
     experience: int
 
 
+def create_user_payloads(size: int) -> List[str]:
+    return [User(name=fake.name(), mail=fake.email(), password=fake.password(length=randint(8, 16))).json() for _ in range(size)]
+
+
+def create_character_payloads(size: int) -> List[str]:
+    """JSON of characters without ids and the opening brace, ids are prepended per request by character_payload"""
+    return [Character(user_id="", character_id="", name=fake.first_kana_name(), level=randint(1, 100), experience=randint(1, pow(10, 5)),
+                      strength=randint(1, pow(10, 5))).json(exclude={"user_id", "character_id"})[1:] for _ in range(size)]
+
+
+# NOTE: payloads are validated by models once when they are created
+user_payloads = create_user_payloads(FAKE_DATA_POOL_SIZE)
+character_payloads = create_character_payloads(FAKE_DATA_POOL_SIZE)
+
+
+def character_payload(user_id: str, character_id: str) -> str:
+    return '{"user_id":"%s","character_id":"%s",%s' % (user_id, character_id, choice(character_payloads))
+
+
+def battle_payload(user_id: str, character_id: str) -> str:
+    # NOTE: the owner lets the server read the character by its primary key
+    return '{"user_id":"%s","character_id":"%s"}' % (user_id, character_id)
+
+
 def gen_url_and_report_name(url_tmpl: str, args: Dict[str, str]) -> Tuple[str, str]:
     return url_tmpl.format(**args), url_tmpl.format(**{k: v if k == "api_version" else f"${k}" for k, v in args.items()})
 
 
-class StressScenario(HttpUser):
+class StressTasks(TaskSet):
+    """Tasks of the scenario, which run by HttpUser or FastHttpUser"""
+
     def on_start(self):
         self.version = "v1"
         self.headers: Dict[str, str] = {"Content-Type": "application/json", "User-Agent": fake.chrome()}
-        # TODO: tuning connection pool settings in test
-        pool = ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0, max_connections=REDIS_CONNECTIONS)
-        self.redis: StrictRedis = StrictRedis(connection_pool=pool)
+
+    def pick_user(self) -> str:
+        """a user from the pool, a new user is created when the pool is empty"""
+        return user_pool.choice() or self.create_fake_user()
 
     @task(1)
-    def create_fake_user(self):
+    def create_fake_user(self) -> str:
         """create game user"""
         logger.debug("start create_fake_user")
-        fake_user: User = User(name=fake.name(), mail=fake.email(), password=fake.password(length=randint(8, 16)))
-        res = self.client.post(f"/api/{self.version}/users/", headers=self.headers, data=fake_user.json()).json()
-        self.redis.set(res["user_id"], res["name"])
+        res = self.client.post(f"/api/{self.version}/users/", headers=self.headers, data=choice(user_payloads)).json()
+        user_pool.created(res["user_id"], res["name"])
         logger.debug(f"user: {res}")
         logger.debug("end create_fake_user")
+        return res["user_id"]
 
     @task(3)
     def create_character(self):
         """a random user to get a random character"""
         logger.debug("start create_character")
-        user_id = self.redis.randomkey().decode()
+        user_id = self.pick_user()
         character = self.client.get(f"/api/{self.version}/character_master/", headers=self.headers).json()
         logger.debug(f"character master: {character}")
-        fake_character: Character = Character(
-            user_id=user_id,
-            character_id=character["character_master_id"],
-            name=fake.first_kana_name(),
-            level=randint(1, 100),
-            experience=randint(1, pow(10, 5)),
-            strength=randint(1, pow(10, 5))
-        )
-        res = self.client.post(f"/api/{self.version}/characters/", headers=self.headers, data=fake_character.json()).json()
+        res = self.client.post(f"/api/{self.version}/characters/", headers=self.headers, data=character_payload(user_id, character["character_master_id"])).json()
         logger.debug(f"result: {res}")
         logger.debug("end create_character")
 
@@ -115,28 +154,22 @@ class StressScenario(HttpUser):
     def battle_opponent(self):
         """a random user to battle a random opponent"""
         logger.debug("start battle_opponent")
-        user_id = self.redis.randomkey().decode()
+        user_id = self.pick_user()
         url, report_name = gen_url_and_report_name("/api/{api_version}/characters/{user_id}", {"api_version": self.version, "user_id": user_id})
         characters = list(self.client.get(url, name=report_name, headers=self.headers).json())
         if "detail" in characters:
             logger.debug("re-get character for battle")
             character = self.client.get(f"/api/{self.version}/character_master/", headers=self.headers).json()
-            fake_character: Character = Character(
-                user_id=user_id,
-                character_id=character["character_master_id"],
-                name=fake.first_kana_name(),
-                level=randint(1, 100),
-                experience=randint(1, pow(10, 5)),
-                strength=randint(1, pow(10, 5))
-            )
-            characters = list(self.client.post(f"/api/{self.version}/characters/", headers=self.headers, data=fake_character.json()).json())
+            characters = list(self.client.post(f"/api/{self.version}/characters/", headers=self.headers, data=character_payload(user_id, character["character_master_id"])).json())
         logger.debug(f"characters length: {len(characters)}")
+        if not characters:
+            return
         character = choice(characters)
         logger.debug(f"character: {character}")
-        if not isinstance(type(character), dict):
+        if not isinstance(character, dict):
             return
-        battle = Battles(character_id=character["id"])
-        res = self.client.post(f"/api/{self.version}/battles/", headers=self.headers, data=battle.json()).json()
+        url = f"/api/{self.version}/battles/" + (f"?write_mode={BATTLE_WRITE_MODE}" if BATTLE_WRITE_MODE else "")
+        res = self.client.post(url, headers=self.headers, data=battle_payload(user_id, character["id"])).json()
         logger.debug(f"result: {res}")
         logger.debug("end battle_opponent")
 
@@ -144,7 +177,7 @@ class StressScenario(HttpUser):
     def get_histories(self):
         """get a battle history between random range"""
         logger.debug("start get_histories")
-        user_id = self.redis.randomkey().decode()
+        user_id = self.pick_user()
         until = int(time())
         since = until - randint(60, 1800)
         logger.debug(f"user: {user_id}, since: {since}, until: {until}")
@@ -153,3 +186,13 @@ class StressScenario(HttpUser):
         res = self.client.get(url, name=report_name, headers=self.headers).json()
         logger.debug(f"result: {res}")
         logger.debug("end get_histories")
+
+
+class StressScenario(ScheduledUser, HttpUser):
+    abstract = LOCUST_USER_CLASS != "http"
+    tasks = [StressTasks]
+
+
+class FastStressScenario(ScheduledUser, FastHttpUser):
+    abstract = LOCUST_USER_CLASS != "fast"
+    tasks = [StressTasks]
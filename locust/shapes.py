@@ -0,0 +1,136 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+from math import ceil
+from os import getenv
+from random import random
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from locust import LoadTestShape
+from locust.stats import RequestStats, print_percentile_stats, print_stats
+
+# NOTE: a JSON file of stages, the test runs in arrival rate mode when it is set, otherwise LOCUST_USERS run back to back
+LOAD_SHAPE_FILE = getenv("LOAD_SHAPE_FILE", "")
+
+PROFILES = ("constant", "ramp", "step", "spike")
+
+logger = logging.getLogger(__name__)
+
+
+def load_config(path: str) -> Dict[str, Any]:
+    """
+    Read stages of a load shape, for example
+
+    {"rate_per_user": 1, "spawn_rate": 100, "stages": [
+        {"profile": "ramp", "duration": 300, "rps": 500},
+        {"profile": "spike", "duration": 60, "rps": 2000},
+        {"profile": "step", "duration": 600, "rps": 1000, "steps": 5}]}
+
+    rps is task starts per second, which are split by weights of tasks.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for stage in config["stages"]:
+        if stage.get("profile", "constant") not in PROFILES:
+            raise ValueError(f"unknown profile: {stage['profile']}")
+    return config
+
+
+def target_rps(stages: List[Dict[str, Any]], run_time: float) -> Optional[float]:
+    """Task starts per second at run_time, each stage starts from the rps where the previous one ended, None after the last stage"""
+    start, previous = 0.0, 0.0
+    for stage in stages:
+        profile, duration, rps = stage.get("profile", "constant"), stage["duration"], stage["rps"]
+        if run_time < start + duration:
+            progress = (run_time - start) / duration
+            if profile == "ramp":
+                return previous + (rps - previous) * progress
+            if profile == "step":
+                steps = stage.get("steps", 1)
+                return previous + (rps - previous) * min(int(progress * steps) + 1, steps) / steps
+            return rps
+        start += duration
+        # NOTE: a spike returns to the previous rps after it
+        previous = previous if profile == "spike" else rps
+    return None
+
+
+config: Dict[str, Any] = load_config(LOAD_SHAPE_FILE) if LOAD_SHAPE_FILE else {"stages": []}
+rate_per_user = float(config.get("rate_per_user", 1))
+# NOTE: latencies from intended start times, they are kept apart from locust stats not to count requests twice
+corrected_stats = RequestStats()
+
+
+class ArrivalRateShape(LoadTestShape):
+    """
+    Open model load which follows stages of LOAD_SHAPE_FILE
+
+    Each user starts a task every 1 / rate_per_user seconds on a fixed schedule, so the number of users sets the arrival rate.
+    Users must be enough for tasks to start on time when the api slows down, so keep rate_per_user below 1 / latency.
+    """
+
+    def tick(self) -> Optional[Tuple[int, float]]:
+        rps = target_rps(config["stages"], self.get_run_time())
+        if rps is None:
+            return None
+        users = ceil(rps / rate_per_user)
+        return users, float(config.get("spawn_rate", max(users, 1)))
+
+
+class ScheduledUser:
+    """
+    Mixin of users to start tasks on a schedule and record how late they start
+
+    A request of a task which started late waited for the previous one, so its latency is corrected by the delay.
+    It is not scheduled without LOAD_SHAPE_FILE.
+    """
+
+    scheduled_delay: float = 0.0
+    _next_start: Optional[float] = None
+
+    def wait_time(self) -> float:
+        if not LOAD_SHAPE_FILE:
+            return 0
+        now = time()
+        interval = 1 / rate_per_user
+        # NOTE: spread the first start of users, or all of them start at once
+        self._next_start = (self._next_start or now + random() * interval) + interval
+        self.scheduled_delay = max(0.0, now - self._next_start)
+        corrected_stats.log_request("SCHEDULE", "start delay", self.scheduled_delay * 1000, 0)
+        return max(0.0, self._next_start - now)
+
+    def context(self) -> Dict[str, Any]:
+        return {"scheduled_delay": self.scheduled_delay}
+
+
+def on_request(request_type: str, name: str, response_time: float, response_length: int, context: Optional[Dict[str, Any]] = None, **kwargs: Any) -> None:
+    delay = (context or {}).get("scheduled_delay", 0.0)
+    corrected_stats.log_request(request_type, name, response_time + delay * 1000, response_length or 0)
+
+
+def on_test_stop(**kwargs: Any) -> None:
+    logger.info("latencies from intended start times")
+    print_stats(corrected_stats, current=False)
+    print_percentile_stats(corrected_stats)
+
+
+def setup(environment: Any) -> None:
+    """Record corrected latencies in arrival rate mode, it is called in the init event of locust"""
+    if not LOAD_SHAPE_FILE:
+        return
+    environment.events.request.add_listener(on_request)
+    environment.events.test_stop.add_listener(on_test_stop)
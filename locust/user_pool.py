@@ -0,0 +1,165 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from bisect import insort
+from os import getenv
+from os.path import exists
+from random import random, randrange
+from typing import Any, Iterable, List, Optional, Set, Tuple
+
+import gevent
+
+from locust.runners import MasterRunner, WorkerRunner
+
+# NOTE: "uniform", "zipf" (a few users get most requests) or "hotspot" (a fixed share of requests go to a fixed share of users)
+USER_POOL_DISTRIBUTION = getenv("USER_POOL_DISTRIBUTION") or "uniform"
+USER_POOL_ZIPF_S = float(getenv("USER_POOL_ZIPF_S", "1.1"))
+# NOTE: hotspot sends USER_POOL_HOT_TRAFFIC of requests to USER_POOL_HOT_KEYS of users
+USER_POOL_HOT_KEYS = float(getenv("USER_POOL_HOT_KEYS", "0.01"))
+USER_POOL_HOT_TRAFFIC = float(getenv("USER_POOL_HOT_TRAFFIC", "0.9"))
+# NOTE: a file of user ids per line, such as one written by apps/scripts/fixtures.py --user-ids
+USER_POOL_FILE = getenv("USER_POOL_FILE", "")
+# NOTE: "messages" shares created users between workers through the locust master, "redis" through Redis
+USER_POOL_SYNC = getenv("USER_POOL_SYNC") or "messages"
+USER_POOL_SYNC_INTERVAL = float(getenv("USER_POOL_SYNC_INTERVAL", "1"))
+REDIS_HOST = getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(getenv("REDIS_PORT", "6379"))
+
+USER_IDS_MESSAGE = "user_ids"
+REDIS_CREATED_USERS = "user_pool:created"
+
+logger = logging.getLogger(__name__)
+
+
+class UserPool:
+    """
+    User ids which a locust worker picks from without a round trip per request
+
+    Ids are kept in key order, so ranks of zipf and hot users of hotspot are contiguous ranges of UserId.
+    Requests of hot users go to the same splits of Spanner, which reproduces hot-spotting.
+    """
+
+    def __init__(self, distribution: str = USER_POOL_DISTRIBUTION, zipf_s: float = USER_POOL_ZIPF_S,
+                 hot_keys: float = USER_POOL_HOT_KEYS, hot_traffic: float = USER_POOL_HOT_TRAFFIC) -> None:
+        if distribution not in ("uniform", "zipf", "hotspot"):
+            raise ValueError(f"unknown user pool distribution: {distribution}")
+        self.distribution = distribution
+        self.zipf_s = zipf_s
+        self.hot_keys = hot_keys
+        self.hot_traffic = hot_traffic
+        self._ids: List[int] = []
+        self._known: Set[int] = set()
+        # NOTE: users created by this worker which are not shared yet, they are kept only when they are shared
+        self.shared = False
+        self._pending: List[Tuple[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, user_ids: Iterable[Any]) -> int:
+        """Add user ids, which are known or not, and return the number of new ones"""
+        added = 0
+        for user_id in user_ids:
+            key = int(user_id)
+            if key not in self._known:
+                self._known.add(key)
+                insort(self._ids, key)
+                added += 1
+        return added
+
+    def created(self, user_id: str, name: str) -> None:
+        self.add((user_id,))
+        if self.shared:
+            self._pending.append((user_id, name))
+
+    def take_pending(self) -> List[Tuple[str, str]]:
+        pending, self._pending = self._pending, []
+        return pending
+
+    def load_file(self, path: str) -> int:
+        with open(path) as f:
+            return self.add(line.split("\t")[0] for line in f if line.strip())
+
+    def choice(self) -> Optional[str]:
+        n = len(self._ids)
+        if not n:
+            return None
+        return str(self._ids[self._index(n)])
+
+    def _index(self, n: int) -> int:
+        if self.distribution == "zipf":
+            # NOTE: inverse of the continuous approximation of the CDF of 1/k^s on [1, n+1)
+            u = random()
+            if self.zipf_s == 1:
+                rank = (n + 1) ** u
+            else:
+                rank = (((n + 1) ** (1 - self.zipf_s) - 1) * u + 1) ** (1 / (1 - self.zipf_s))
+            return min(int(rank) - 1, n - 1)
+        if self.distribution == "hotspot":
+            hot = max(1, int(n * self.hot_keys))
+            if random() < self.hot_traffic or hot == n:
+                return randrange(hot)
+            return randrange(hot, n)
+        return randrange(n)
+
+
+def setup(environment: Any, pool: UserPool) -> None:
+    """Load user ids and share users which are created by workers, it is called in the init event of locust"""
+    if USER_POOL_FILE and exists(USER_POOL_FILE):
+        logger.info(f"loaded {pool.load_file(USER_POOL_FILE)} user ids from {USER_POOL_FILE}")
+
+    runner = environment.runner
+    if USER_POOL_SYNC == "redis":
+        _setup_redis(runner, pool)
+    elif isinstance(runner, MasterRunner):
+        # NOTE: the master forwards ids of a worker to every worker
+        runner.register_message(USER_IDS_MESSAGE, lambda environment, msg, **kwargs: runner.send_message(USER_IDS_MESSAGE, msg.data))
+    elif isinstance(runner, WorkerRunner):
+        runner.register_message(USER_IDS_MESSAGE, lambda environment, msg, **kwargs: pool.add(msg.data))
+
+        def _send_forever() -> None:
+            while True:
+                gevent.sleep(USER_POOL_SYNC_INTERVAL)
+                pending = pool.take_pending()
+                if pending:
+                    runner.send_message(USER_IDS_MESSAGE, [user_id for user_id, _ in pending])
+
+        pool.shared = True
+        gevent.spawn(_send_forever)
+
+
+def _setup_redis(runner: Any, pool: UserPool) -> None:
+    if isinstance(runner, MasterRunner):
+        return
+    from redis import StrictRedis
+
+    redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
+
+    def _sync_forever() -> None:
+        # NOTE: all keys are scanned once, after that only ids which are appended to the list by workers are read
+        pool.add(key for key in redis.scan_iter(count=10000) if key.isdigit())
+        offset = redis.llen(REDIS_CREATED_USERS)
+        while True:
+            gevent.sleep(USER_POOL_SYNC_INTERVAL)
+            pending = pool.take_pending()
+            if pending:
+                # NOTE: keys are kept for fixtures and older scenarios which read users by RANDOMKEY
+                redis.pipeline(transaction=False).mset(dict(pending)).rpush(REDIS_CREATED_USERS, *[user_id for user_id, _ in pending]).execute()
+            created = redis.lrange(REDIS_CREATED_USERS, offset, -1)
+            offset += len(created)
+            pool.add(created)
+
+    pool.shared = True
+    gevent.spawn(_sync_forever)